@@ -0,0 +1,169 @@
+""" HTTP load test for the API on a synthetic dataset
+
+Serves `get_app` with werkzeug's server and sends requests to it from
+--concurrency client threads for --duration seconds, each with its own
+keep-alive connection. Requests are a mix of the
+endpoints a client browsing users and repositories would call. Reports
+requests per second and p50/p99 latency per endpoint and overall.
+
+Without --db a dataset of --users users and --repos repositories is built
+in a temporary file, see benchmarks/dataset.py to build a full size one.
+With --snapshot the API is served from a snapshot of the database, like
+`github-scraper api --snapshot`.
+
+Usage:
+    python benchmarks/api_load.py [--db=<path>] [--users=<number>]
+                                  [--repos=<number>] [--snapshot]
+                                  [--concurrency=<number>]
+                                  [--duration=<sec>]
+"""
+from github_scraper.api import get_app
+from github_scraper.storage.sqlite import SnapshotStorage, SQLiteStorage
+
+from dataset import LANGUAGES, WORDS, load, print_rates, sample_logins
+from storage import percentile
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import argparse
+import collections
+import http.client
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log(self, *args):
+        pass
+
+
+def get_requests(users: int, count: int, seed=3) -> list:
+    """ Returns (endpoint, path) of `count` random requests
+    """
+    rnd = random.Random(seed)
+    logins = sample_logins(users, count, seed=seed)
+    paths = {
+        'user': lambda login: '/users/{}'.format(login),
+        'repos': lambda login: '/users/{}/repos'.format(login),
+        'repos?language': lambda login: '/users/{}/repos?language={}'.format(
+            login, rnd.choice(LANGUAGES)),
+        'repos?description': lambda login:
+            '/users/{}/repos?description={}'.format(login, rnd.choice(WORDS)),
+        'users?since': lambda login: '/users?since={}'.format(
+            rnd.randint(0, users)),
+        'stats': lambda login: '/stats',
+    }
+    endpoints = rnd.choices(list(paths), weights=[30, 30, 10, 10, 15, 5],
+                            k=count)
+    return [(endpoint, paths[endpoint](login))
+            for endpoint, login in zip(endpoints, logins)]
+
+
+def run_client(port: int, requests: list, deadline: float, results: list):
+    """ Sends requests until deadline and appends (endpoint, seconds) of each
+        to results
+    """
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    i = 0
+    while time.perf_counter() < deadline:
+        endpoint, path = requests[i % len(requests)]
+        i += 1
+        started = time.perf_counter()
+        conn.request('GET', path)
+        response = conn.getresponse()
+        response.read()
+        elapsed = time.perf_counter() - started
+        if response.status not in (200, 404):
+            raise RuntimeError('{} returned {}'.format(path, response.status))
+        results.append((endpoint, elapsed))
+        if response.will_close:
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.close()
+
+
+def print_times(name: str, times: list, elapsed: float):
+    times.sort()
+    print('{:<20} {:8} reqs {:8.1f} req/s {:8.2f} ms p50 {:8.2f} ms p99'
+          .format(name, len(times), len(times) / elapsed,
+                  percentile(times, 50) * 1000,
+                  percentile(times, 99) * 1000))
+
+
+def run(storage, users: int, concurrency: int, duration: float, *,
+        threaded: bool = False):
+    """ Serves the API from storage and prints the results of `concurrency`
+        clients sending requests for `duration` seconds
+    """
+    server = make_server('127.0.0.1', 0, get_app(storage),
+                         threaded=threaded, request_handler=QuietHandler)
+    results = []
+    deadline = time.perf_counter() + duration
+    clients = [threading.Thread(target=run_client, args=(
+        server.server_port, get_requests(users, 10000, seed=i), deadline,
+        results)) for i in range(concurrency)]
+
+    elapsed = []
+
+    def wait_clients():
+        for client in clients:
+            client.join()
+        elapsed.append(time.perf_counter() - started)
+        server.shutdown()
+
+    started = time.perf_counter()
+    for client in clients:
+        client.start()
+    threading.Thread(target=wait_clients).start()
+    # served from this thread, which opened the storage connection
+    server.serve_forever()
+
+    by_endpoint = collections.defaultdict(list)
+    for endpoint, seconds in results:
+        by_endpoint[endpoint].append(seconds)
+    for endpoint, times in sorted(by_endpoint.items()):
+        print_times(endpoint, times, elapsed[0])
+    print_times('total', [seconds for _, seconds in results], elapsed[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--repos', type=int, default=2000000)
+    parser.add_argument('--snapshot', action='store_true')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10)
+    args = parser.parse_args()
+
+    path = tempfile.mkdtemp()
+    try:
+        if args.db is None:
+            args.db = os.path.join(path, 'data.sqlite')
+            with SQLiteStorage(args.db) as storage:
+                print_rates(load(storage, args.users, args.repos))
+
+        if args.snapshot:
+            snapshot = os.path.join(path, 'snapshot.sqlite')
+            with SQLiteStorage(args.db) as storage:
+                storage.publish_snapshot(snapshot)
+            storage = SnapshotStorage(snapshot)
+        else:
+            storage = SQLiteStorage(args.db)
+        users = storage.get_progress()['users']
+        # a SQLiteStorage connection can only be used by the thread that
+        # opened it, so requests are served one at a time like with
+        # Flask's single-threaded server, snapshots are served by threads
+        run(storage, users, args.concurrency, args.duration,
+            threaded=args.snapshot)
+        storage.close()
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
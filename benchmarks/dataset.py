@@ -0,0 +1,139 @@
+""" Synthetic dataset generator for the storage and API benchmarks
+
+Fills a SQLite database with users and their repositories. Repositories per
+user and languages follow a skewed distribution, like on GitHub: most users
+have a few repositories and a few languages account for most of them. Data
+is generated from a fixed seed, so datasets of the same size are identical.
+
+The full size dataset (1M users, 20M repositories) takes a while to build,
+generate it once and pass it to the other benchmarks with --db.
+
+Usage:
+    python benchmarks/dataset.py <path> [--users=<number>] [--repos=<number>]
+                                 [--chunk-size=<number>]
+"""
+from github_scraper.models import Batch, Repo, User
+from github_scraper.storage.sqlite import SQLiteStorage
+
+import argparse
+import os
+import random
+import time
+
+
+LANGUAGES = [
+    'JavaScript', 'Python', 'Java', 'Ruby', 'PHP', 'C++', 'C', 'Go',
+    'TypeScript', 'Shell', 'C#', 'Objective-C', 'Swift', 'Rust', 'Scala',
+    'Perl', 'Haskell', 'Lua', 'Clojure', 'Elixir', 'R', 'Erlang',
+]
+# Zipf-like weights, the first languages are the most common
+LANGUAGE_WEIGHTS = [1 / rank for rank in range(1, len(LANGUAGES) + 1)]
+
+WORDS = [
+    'simple', 'fast', 'async', 'library', 'framework', 'tool', 'client',
+    'server', 'api', 'parser', 'web', 'cli', 'plugin', 'scraper', 'github',
+    'database', 'json', 'http', 'test', 'config', 'dotfiles', 'game', 'bot',
+    'theme', 'example', 'tutorial', 'wrapper', 'engine', 'toolkit', 'demo',
+]
+
+DEFAULT_USERS = 1000000
+DEFAULT_REPOS = 20000000
+
+
+def get_login(user_id: int) -> str:
+    return 'user{}'.format(user_id)
+
+
+def generate(users: int, repos: int, *, chunk_size: int = 10000, seed=0):
+    """ Yields (users, repos) batches of about `chunk_size` users, for
+        `users` users with `repos` repositories in total
+    """
+    rnd = random.Random(seed)
+    # exponential counts around the mean keep the total close to `repos`
+    mean = repos / users if users else 0
+    repo_id = 0
+    for start in range(1, users + 1, chunk_size):
+        user_batch = Batch(User)
+        repo_batch = Batch(Repo)
+        for user_id in range(start, min(start + chunk_size, users + 1)):
+            login = get_login(user_id)
+            user_url = 'https://github.com/{}'.format(login)
+            user_batch.append((user_id, login, user_url))
+            count = round(rnd.expovariate(1 / mean)) if mean else 0
+            languages = rnd.choices(LANGUAGES, LANGUAGE_WEIGHTS, k=count)
+            for n, language in enumerate(languages):
+                repo_id += 1
+                name = '{}-{}'.format(rnd.choice(WORDS), n)
+                description = None
+                if rnd.random() < 0.7:
+                    description = ' '.join(rnd.sample(WORDS, 4))
+                if rnd.random() < 0.1:
+                    language = None
+                repo_batch.append((repo_id, user_id,
+                                   '{}/{}'.format(user_url, name), name,
+                                   description, language))
+        yield user_batch, repo_batch
+
+
+def load(storage: SQLiteStorage, users: int, repos: int, *,
+         chunk_size: int = 10000, report=None) -> dict:
+    """ Puts a generated dataset in storage and returns the time spent
+        writing users and repositories, and their counts
+    """
+    stats = {'users': 0, 'repos': 0, 'users_time': 0.0, 'repos_time': 0.0}
+    for user_batch, repo_batch in generate(users, repos,
+                                           chunk_size=chunk_size):
+        started = time.perf_counter()
+        storage.put_users(user_batch)
+        stats['users_time'] += time.perf_counter() - started
+
+        started = time.perf_counter()
+        storage.put_repos(repo_batch)
+        stats['repos_time'] += time.perf_counter() - started
+
+        stats['users'] += len(user_batch)
+        stats['repos'] += len(repo_batch)
+        if report is not None:
+            report(stats)
+    return stats
+
+
+def print_rates(stats: dict):
+    for kind in ('users', 'repos'):
+        elapsed = stats[kind + '_time']
+        print('put_{:<12} {:>10} rows {:8.1f} s {:10.0f} rows/s'.format(
+            kind, stats[kind], elapsed,
+            stats[kind] / elapsed if elapsed else 0))
+
+
+def sample_logins(users: int, count: int, seed=1) -> list:
+    """ Returns random logins of a dataset of `users` users
+    """
+    rnd = random.Random(seed)
+    return [get_login(rnd.randint(1, users)) for _ in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path')
+    parser.add_argument('--users', type=int, default=DEFAULT_USERS)
+    parser.add_argument('--repos', type=int, default=DEFAULT_REPOS)
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    if os.path.exists(args.path):
+        parser.error('{} already exists'.format(args.path))
+
+    def report(stats):
+        print('\r{users} users, {repos} repos'.format(**stats), end='',
+              flush=True)
+
+    with SQLiteStorage(args.path) as storage:
+        stats = load(storage, args.users, args.repos,
+                     chunk_size=args.chunk_size, report=report)
+    print()
+    print_rates(stats)
+
+
+if __name__ == '__main__':
+    main()
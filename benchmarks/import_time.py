@@ -0,0 +1,66 @@
+""" Startup benchmark for the command line entry points
+
+Measures the wall time of short-lived invocations, and with -X importtime
+the cumulative import time of the modules each entry point loads.
+
+Usage:
+    python benchmarks/import_time.py [--runs=<number>] [--top=<number>]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+
+COMMANDS = [
+    ('--version', ['-m', 'github_scraper', '--version']),
+    ('import cli', ['-c', 'import github_scraper.cli']),
+    ('import scraper', ['-c', 'import github_scraper.scraper']),
+    ('import api', ['-c', 'import github_scraper.api']),
+]
+
+
+def bench(args: list, runs: int) -> float:
+    """ Returns median wall time in milliseconds of running python with args
+    """
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable] + args, stdout=subprocess.DEVNULL,
+                       check=True)
+        times.append((time.perf_counter() - started) * 1000)
+    return statistics.median(times)
+
+
+def get_import_times(args: list) -> list:
+    """ Returns (cumulative microseconds, module) of top-level imports
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + args,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # top-level imports are not indented
+        if cumulative.strip().isdigit() and not name.startswith('  '):
+            times.append((int(cumulative), name.strip()))
+    return sorted(times, reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=5)
+    args = parser.parse_args()
+
+    for name, command in COMMANDS:
+        print('{:<16} {:8.1f} ms'.format(name, bench(command, args.runs)))
+        for cumulative, module in get_import_times(command)[:args.top]:
+            print('    {:<28} {:8.1f} ms'.format(module, cumulative / 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+""" Microbenchmark for the query shape cache of SQLiteStorage
+
+Measures the per-call overhead of the `get_user` lookup done by every API
+request, with and without the query cache and sqlite3 statement cache.
+
+Usage:
+    python benchmarks/query_cache.py [--users=<number>] [--calls=<number>]
+"""
+from github_scraper.models import User
+from github_scraper.storage import Q
+from github_scraper.storage.sqlite import LocMemStorage
+
+import argparse
+import random
+import timeit
+
+
+def get_storage(users: int, **kwargs) -> LocMemStorage:
+    # user cache disabled, so lookups hit the query and statement caches
+    storage = LocMemStorage(user_cache_size=0, **kwargs)
+    storage.put_users(User(i, 'user{}'.format(i),
+                           'https://github.com/user{}'.format(i))
+                      for i in range(1, users + 1))
+    return storage
+
+
+def bench(storage: LocMemStorage, users: int, calls: int) -> float:
+    """ Returns microseconds per get_user call
+    """
+    logins = ['user{}'.format(random.randint(1, users))
+              for _ in range(calls)]
+    it = iter(logins)
+
+    def lookup():
+        storage.get_user(Q('login') == next(it))
+
+    return timeit.timeit(lookup, number=calls) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--calls', type=int, default=100000)
+    args = parser.parse_args()
+
+    variants = [
+        ('no caches', {'query_cache_size': 0, 'cached_statements': 0}),
+        ('statement cache', {'query_cache_size': 0}),
+        ('query + statement cache', {}),
+    ]
+    for name, kwargs in variants:
+        storage = get_storage(args.users, **kwargs)
+        result = bench(storage, args.users, args.calls)
+        print('{:<25} {:8.2f} us/call  {}'.format(
+            name, result, storage.query_cache_stats))
+        storage.close()
+
+
+if __name__ == '__main__':
+    main()
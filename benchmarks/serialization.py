@@ -0,0 +1,65 @@
+""" Benchmark for the JSON serialization of API list endpoints
+
+Compares the previous serialization path (model objects, `_asdict()` and the
+stdlib json module) with the current one (row batches and
+`api.serializers.dumps`), and measures `/users/<user>/repos` end to end.
+
+Usage:
+    python benchmarks/serialization.py [--repos=<number>] [--runs=<number>]
+"""
+from github_scraper.api import get_app
+from github_scraper.api.serializers import dumps
+from github_scraper.models import Repo, User
+from github_scraper.storage.sqlite import LocMemStorage
+
+import argparse
+import json
+import timeit
+
+
+def get_storage(repos: int) -> LocMemStorage:
+    storage = LocMemStorage()
+    storage.put_user(User(1, 'user', 'https://github.com/user'))
+    storage.put_repos(Repo(i, 1, 'https://github.com/user/repo{}'.format(i),
+                           'repo{}'.format(i), 'Repository {}'.format(i),
+                           'Python' if i % 3 else None)
+                      for i in range(1, repos + 1))
+    return storage
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repos', type=int, default=5000)
+    parser.add_argument('--runs', type=int, default=50)
+    args = parser.parse_args()
+
+    storage = get_storage(args.repos)
+    client = get_app(storage).test_client()
+
+    def previous():
+        repos = storage.list_repos({'user_id': 1})
+        return json.dumps([r._asdict() for r in repos]).encode() + b'\n'
+
+    def current():
+        return dumps(storage.list_repos({'user_id': 1}, batch=True)
+                     .to_dicts())
+
+    def request(**headers):
+        def get():
+            client.get('/users/user/repos', headers=headers)
+        return get
+
+    benchmarks = [
+        ('previous serialization', previous),
+        ('current serialization', current),
+        ('request', request()),
+        ('request (gzip)', request(**{'Accept-Encoding': 'gzip'})),
+        ('request (br)', request(**{'Accept-Encoding': 'br'})),
+    ]
+    for name, func in benchmarks:
+        result = timeit.timeit(func, number=args.runs) / args.runs * 1000
+        print('{:<25} {:8.2f} ms'.format(name, result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+""" Benchmark for the SQLite storage on a synthetic dataset
+
+Measures bulk insert rates while building the dataset, and the latency of
+the lookups done by the API: `get_user` by login, `list_repos` by user,
+language and description, and how listing pages gets slower the deeper the
+page is, with OFFSET and with `id > since` (keyset) pagination.
+
+Without --db a dataset of --users users and --repos repositories is built
+in a temporary file, see benchmarks/dataset.py to build a full size one.
+
+Usage:
+    python benchmarks/storage.py [--db=<path>] [--users=<number>]
+                                 [--repos=<number>] [--calls=<number>]
+"""
+from github_scraper.storage import Q
+from github_scraper.storage.sqlite import SQLiteStorage
+
+from dataset import LANGUAGES, WORDS, load, print_rates, sample_logins
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+
+def percentile(values: list, p: float) -> float:
+    """ Returns the `p` percentile of sorted `values`, nearest-rank, or NaN
+        if there are none
+    """
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def bench(func, args: list) -> list:
+    """ Returns sorted seconds per call of func for each of args
+    """
+    times = []
+    for arg in args:
+        started = time.perf_counter()
+        func(arg)
+        times.append(time.perf_counter() - started)
+    return sorted(times)
+
+
+def print_times(name: str, times: list):
+    print('{:<32} {:9.1f} us p50 {:9.1f} us p99 {:9.0f} ops/s'.format(
+        name, percentile(times, 50) * 1e6, percentile(times, 99) * 1e6,
+        len(times) / sum(times) if sum(times) else float('nan')))
+
+
+def get_depths(count: int) -> list:
+    """ Returns page offsets to measure: 0 and powers of 10 from 1000 up to
+        count
+    """
+    depths = [0]
+    depth = 1000
+    while depth < count:
+        depths.append(depth)
+        depth *= 10
+    return depths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--repos', type=int, default=2000000)
+    parser.add_argument('--calls', type=int, default=10000)
+    args = parser.parse_args()
+
+    path = None
+    if args.db is None:
+        path = tempfile.mkdtemp()
+        args.db = os.path.join(path, 'data.sqlite')
+        with SQLiteStorage(args.db) as storage:
+            print_rates(load(storage, args.users, args.repos))
+
+    rnd = random.Random(2)
+    try:
+        # user cache disabled, so lookups hit the database
+        storage = SQLiteStorage(args.db, user_cache_size=0)
+        progress = storage.get_progress()
+        users, repos = progress['users'], progress['repos']
+        print('{} users, {} repos'.format(users, repos))
+
+        logins = sample_logins(users, args.calls)
+        user_ids = [rnd.randint(1, users) for _ in range(args.calls)]
+        languages = rnd.choices(LANGUAGES, k=args.calls)
+        words = rnd.choices(WORDS, k=args.calls)
+
+        def list_repos(*lookup):
+            return storage.list_repos(*lookup, limit=30, batch=True)
+
+        benchmarks = [
+            ('get_user login', logins, lambda login: storage.get_user(
+                Q('login') == login)),
+            ('list_repos user', user_ids, lambda user_id: storage.list_repos(
+                Q('user_id') == user_id, batch=True)),
+            ('list_repos language', languages, lambda language: list_repos(
+                Q('language') == language)),
+            ('list_repos language since', languages, lambda language:
+                list_repos(Q('language') == language,
+                           Q('id') > repos // 2)),
+            ('list_repos user description', list(zip(user_ids, words)),
+                lambda arg: storage.list_repos(
+                    Q('user_id') == arg[0],
+                    Q('description').contains(arg[1]), batch=True)),
+            ('list_repos description', words, lambda word: list_repos(
+                Q('description').contains(word))),
+        ]
+        for name, values, func in benchmarks:
+            print_times(name, bench(func, values))
+
+        # deep pages are slow to scan, a few calls are enough
+        calls = max(1, args.calls // 100)
+        for kind, count, method in [('users', users, storage.list_users),
+                                    ('repos', repos, storage.list_repos)]:
+            for depth in get_depths(count):
+                print_times('list_{} offset {}'.format(kind, depth), bench(
+                    lambda _: method(offset=depth, limit=30, batch=True),
+                    range(calls)))
+                print_times('list_{} since {}'.format(kind, depth), bench(
+                    lambda _: method(Q('id') > depth, limit=30, batch=True),
+                    range(calls)))
+        storage.close()
+    finally:
+        if path is not None:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
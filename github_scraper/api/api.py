@@ -1,7 +1,7 @@
 from flask import Flask
 from flask_restful import abort, reqparse
 
-from ..storage import Storage, Q
+from ..storage import Storage, Q, QGroup
 
 from .lib import Api, Resource
 
@@ -15,6 +15,12 @@ def get_app(storage: Storage) -> Flask:
     api.add_resource(UserList, '/users')
     api.add_resource(User, '/users/<user>')
     api.add_resource(RepoList, '/users/<user>/repos')
+    api.add_resource(UserBatch, '/users:batch')
+    api.add_resource(RepoBatch, '/repos:batch')
+    api.add_resource(ChangeList, '/changes')
+    api.add_resource(Progress, '/stats')
+    api.add_resource(LanguageStatsList, '/stats/languages')
+    api.add_resource(TopUserList, '/stats/users/top')
 
     return app
 
@@ -23,7 +29,7 @@ class User(Resource):
     """ User API endpoint: /users/<user>
     """
     def get(self, user):
-        user = self.storage.get_user({'login': user})
+        user = self.storage.get_user(Q('login') == user)
         if not user:
             abort(404, message='user not found')
         return self.to_dict(user)
@@ -40,7 +46,8 @@ class UserList(Resource):
         since = lookup.pop('since')
         return self.to_list(self.storage.list_users(Q('id') > since,
                                                     lookup,
-                                                    limit=30))
+                                                    limit=30,
+                                                    batch=True))
 
     def get_lookup(self):
         parser = reqparse.RequestParser()
@@ -54,17 +61,179 @@ class RepoList(Resource):
     Available filters:
     * description=<text> filters repositories by description
     * language=<text> filters repositories by language
+    * languages=<text>,<text> only display repositories in these languages
+    * since=<int> only display repositories with id higher than the specified
     """
     def get(self, user):
-        user = self.storage.get_user({'login': user})
+        user = self.storage.get_user(Q('login') == user)
         if not user:
             abort(404, message='user not found')
         repo_lookup = self.get_lookup()
-        repo_lookup['user_id'] = user.id
-        return self.to_list(self.storage.list_repos(repo_lookup))
+        clauses = [Q('user_id') == user.id]
+        since = repo_lookup.pop('since', None)
+        if since is not None:
+            clauses.append(Q('id') > since)
+        languages = repo_lookup.pop('languages', None)
+        if languages is not None:
+            clauses.append(Q('language').in_(languages.split(',')))
+        return self.to_list(self.storage.list_repos(repo_lookup, *clauses,
+                                                    batch=True))
 
     def get_lookup(self):
         parser = reqparse.RequestParser()
         parser.add_argument('description', type=str, store_missing=False)
         parser.add_argument('language', type=str, store_missing=False)
+        parser.add_argument('languages', type=str, store_missing=False)
+        parser.add_argument('since', type=int, store_missing=False)
+        return parser.parse_args()
+
+
+# keeps IN (...) lists under SQLite's default limit of 999 variables
+MAX_BATCH_SIZE = 500
+
+
+class BatchResource(Resource):
+    """ Base class for batch endpoints, which take lists of keys in a JSON
+        body and look all of them up with a single query
+
+    :attr keys: list of (argument, column, type) accepted in the body
+    """
+    keys = []
+
+    def get_lookup(self) -> dict:
+        """ Returns {column: values} from the JSON body
+        """
+        parser = reqparse.RequestParser()
+        for key, _, type_ in self.keys:
+            parser.add_argument(key, type=type_, action='append',
+                                location='json', store_missing=False)
+        args = parser.parse_args()
+
+        if not args:
+            abort(400, message='one of {} is required'.format(
+                ', '.join(key for key, _, _ in self.keys)))
+        if sum(len(values) for values in args.values()) > MAX_BATCH_SIZE:
+            abort(400, message='at most {} keys are allowed'.format(
+                MAX_BATCH_SIZE))
+        return {column: args[key]
+                for key, column, _ in self.keys if key in args}
+
+    def build_query(self, lookup: dict) -> QGroup:
+        """ Returns query matching any of the values in lookup
+        """
+        return QGroup(QGroup.OR, [Q(column).in_(values)
+                                  for column, values in lookup.items()])
+
+
+class UserBatch(BatchResource):
+    """ User batch API endpoint: POST /users:batch
+
+    JSON body with any of:
+    * logins=[<text>, ...] users with these logins
+    * ids=[<int>, ...] users with these ids
+    """
+    keys = [('logins', 'login', str), ('ids', 'id', int)]
+
+    def post(self):
+        query = self.build_query(self.get_lookup())
+        return self.to_list(self.storage.list_users(query, batch=True))
+
+
+class RepoBatch(BatchResource):
+    """ Repository batch API endpoint: POST /repos:batch
+
+    JSON body with any of:
+    * logins=[<text>, ...] repositories of users with these logins
+    * user_ids=[<int>, ...] repositories of users with these ids
+    * ids=[<int>, ...] repositories with these ids
+    """
+    keys = [('logins', 'login', str),
+            ('user_ids', 'user_id', int),
+            ('ids', 'id', int)]
+
+    def post(self):
+        lookup = self.get_lookup()
+        logins = lookup.pop('login', None)
+        if logins:
+            users = self.storage.list_users(Q('login').in_(logins),
+                                            batch=True)
+            user_ids = lookup.setdefault('user_id', [])
+            user_ids.extend(row[0] for row in users.rows)
+        query = self.build_query(lookup)
+        return self.to_list(self.storage.list_repos(query, batch=True))
+
+
+class ChangeList(Resource):
+    """ Change feed endpoint: /changes
+
+    Returns users and repositories written after a sequence number, in the
+    order they were written. Objects appear only once, with their last
+    sequence number. Pass `next` as `since` to get the following changes.
+
+    Available filters:
+    * since=<int> only display changes after this sequence number
+    * limit=<int> maximum number of changes, up to 500 (default: 100)
+    """
+    def get(self):
+        lookup = self.get_lookup()
+        limit = min(max(lookup.limit, 0), MAX_BATCH_SIZE)
+        changes = self.storage.list_changes(lookup.since, limit)
+        return {
+            'changes': [{
+                'seq': change.seq,
+                'type': change.kind,
+                'id': change.id,
+                'deleted': change.deleted,
+                'object': self.to_dict(change.obj) if change.obj else None,
+            } for change in changes],
+            'next': changes[-1].seq if changes else lookup.since,
+        }
+
+    def get_lookup(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument('since', type=int, default=0)
+        parser.add_argument('limit', type=int, default=100)
+        return parser.parse_args()
+
+
+class Progress(Resource):
+    """ Scraping progress endpoint: /stats
+    """
+    def get(self):
+        return self.storage.get_progress()
+
+
+class LanguageStatsList(Resource):
+    """ Repositories per language endpoint: /stats/languages
+
+    Available filters:
+    * limit=<int> maximum number of languages, defaults to all
+    """
+    def get(self):
+        lookup = self.get_lookup()
+        limit = lookup.limit
+        if limit is not None:
+            limit = max(limit, 0)
+        return self.to_list(self.storage.list_language_stats(limit))
+
+    def get_lookup(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument('limit', type=int, default=None)
+        return parser.parse_args()
+
+
+class TopUserList(Resource):
+    """ Users with most repositories endpoint: /stats/users/top
+
+    Available filters:
+    * limit=<int> maximum number of users, up to 100 (default: 30)
+    """
+    def get(self):
+        lookup = self.get_lookup()
+        limit = min(max(lookup.limit, 0), 100)
+        return self.to_list(self.storage.list_top_users(limit))
+
+    def get_lookup(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument('limit', type=int, default=30)
         return parser.parse_args()
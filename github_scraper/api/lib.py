@@ -1,12 +1,16 @@
 from flask_restful import Api as BaseApi, Resource as BaseResource
 
+from ..models import Batch
 from ..storage import Storage
 
+from .serializers import output_json
+
 
 class Api(BaseApi):
     def __init__(self, storage: Storage, *args, **kwargs):
         self.storage = storage
         super(Api, self).__init__(*args, **kwargs)
+        self.representations = {'application/json': output_json}
 
     def add_resource(self, resource, url):
         kwargs = {
@@ -21,6 +25,8 @@ class Resource(BaseResource):
         super(Resource, self).__init__(*args, **kwargs)
 
     def to_list(self, obj_list) -> list:
+        if isinstance(obj_list, Batch):
+            return obj_list.to_dicts()
         return [self.to_dict(obj) for obj in obj_list]
 
     def to_dict(self, obj) -> dict:
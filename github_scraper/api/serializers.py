@@ -0,0 +1,69 @@
+from flask import make_response, request
+
+import gzip
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+
+# responses smaller than this are not worth compressing
+COMPRESS_MIN_SIZE = 1024
+
+
+def dumps(data) -> bytes:
+    """ Returns data encoded as JSON bytes, using orjson when available
+    """
+    if orjson is not None:
+        return orjson.dumps(data) + b'\n'
+    return json.dumps(data, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+def get_encoding(accept_encoding: str) -> str:
+    """ Returns the preferred supported encoding from an Accept-Encoding
+        header, or None
+    """
+    accepted = set()
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        if params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00'):
+            accepted.add(name.lower())
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=5)
+
+
+def output_json(data, code, headers=None):
+    """ Makes a Flask response from data, compressed according to the
+        request's Accept-Encoding. Used as the API representation for
+        application/json.
+    """
+    body = dumps(data)
+    encoding = None
+    if len(body) >= COMPRESS_MIN_SIZE:
+        encoding = get_encoding(request.headers.get('Accept-Encoding', ''))
+        if encoding is not None:
+            body = compress(body, encoding)
+
+    response = make_response(body, code)
+    response.headers.extend(headers or {})
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Vary'] = 'Accept-Encoding'
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    return response
@@ -2,15 +2,29 @@
 github-scraper
 
 Usage:
-    github-scraper scrape [--db=<path>] [--verbosity=<number>]
-    github-scraper api [--db=<path>]
+    github-scraper scrape [--db=<path>] [--archive=<path>]
+                          [--engine=<engine>] [--token=<token>]
+                          [--snapshot=<path>] [--snapshot-interval=<sec>]
+                          [--uvloop] [--verbosity=<number>]
+    github-scraper api [--db=<path> | --snapshot=<path>]
     github-scraper -h | --help
     github-scraper --version
 
 Options:
     -h --help                   Show this screen.
     --version                   Show version.
-    --db=<path>                 Database path [default: ./data.sqlite]
+    --db=<path>                 Database path or postgresql:// URL
+                                [default: ./data.sqlite]
+    --archive=<path>            Keep raw responses in this directory
+    --engine=<engine>           API used to fetch repositories, rest or
+                                graphql [default: rest]
+    --token=<token>             GitHub token, required by the graphql
+                                engine, defaults to $GITHUB_TOKEN
+    --snapshot=<path>           Publish read-only copies of the SQLite
+                                database to this path when scraping, or
+                                serve the API from it
+    --snapshot-interval=<sec>   Seconds between snapshots [default: 60]
+    --uvloop                    Use uvloop's faster event loop
     -v --verbosity=<number>     Verbosity level [default: 1]
                                 -v 0 (silent)
                                 -v 1 (minimum)
@@ -18,20 +32,74 @@ Options:
 
 """
 from . import __version__
-from .storage.sqlite import SQLiteStorage
-from .scraper import run_scraper
-from .api import get_app
+from .storage import get_storage
 
 from docopt import docopt
 
+import os
+import sys
+
+
+# subcommands import what they need in main, so that short-lived
+# invocations, like --version or a scrape from cron, don't pay for
+# importing Flask or aiohttp when they don't use them
+ENGINES = ('rest', 'graphql')
+
+
+def get_engine(name: str) -> type:
+    """ Returns scraper class of the given engine
+    """
+    if name == 'graphql':
+        from .scraper import GraphQLScraper
+        return GraphQLScraper
+    else:
+        from .scraper import Scraper
+        return Scraper
+
 
 def main():
     options = docopt(__doc__, version=__version__)
     database = options['--db']
     verbosity = int(options['--verbosity'])
 
-    with SQLiteStorage(database) as storage:
+    if options.get('api') and options['--snapshot']:
+        from .storage.sqlite import SnapshotStorage
+        try:
+            storage = SnapshotStorage(options['--snapshot'])
+        except FileNotFoundError:
+            sys.exit('Snapshot not found: {}'.format(options['--snapshot']))
+    else:
+        storage = get_storage(database)
+
+    with storage:
         if options.get('scrape'):
-            run_scraper(storage=storage, verbosity=verbosity)
+            if options['--engine'] not in ENGINES:
+                sys.exit('Unknown engine: {}'.format(options['--engine']))
+            token = options['--token'] or os.environ.get('GITHUB_TOKEN')
+            if options['--engine'] == 'graphql' and not token:
+                sys.exit('The graphql engine requires a token, use --token '
+                         'or set GITHUB_TOKEN')
+
+            if options['--snapshot']:
+                from .storage.sqlite import SQLiteStorage
+                if not isinstance(storage, SQLiteStorage):
+                    sys.exit('Snapshots require a SQLite database')
+
+            from .scraper import Archive, run_scraper
+            archive = None
+            if options['--archive']:
+                archive = Archive(options['--archive'])
+            try:
+                run_scraper(storage=storage, verbosity=verbosity,
+                            archive=archive, token=token,
+                            scraper_class=get_engine(options['--engine']),
+                            uvloop=options['--uvloop'],
+                            snapshot=options['--snapshot'],
+                            snapshot_interval=float(
+                                options['--snapshot-interval']))
+            finally:
+                if archive is not None:
+                    archive.close()
         elif options.get('api'):
+            from .api import get_app
             get_app(storage).run()
@@ -1,4 +1,4 @@
-from typing import NamedTuple
+from typing import Iterator, List, NamedTuple
 
 
 class User(NamedTuple):
@@ -14,3 +14,51 @@ class Repo(NamedTuple):
     name: str
     description: str
     language: str
+
+
+class LanguageStats(NamedTuple):
+    language: str
+    repos: int
+
+
+class UserStats(NamedTuple):
+    id: int
+    login: str
+    repos: int
+
+
+class Change(NamedTuple):
+    seq: int
+    kind: str
+    id: int
+    deleted: bool
+    obj: tuple
+
+
+class Batch:
+    """ Compact list of model rows, used for bulk operations. Rows are kept
+        as plain tuples and model objects are only built when iterating.
+
+        :param model: model class of the rows, eg. :class:`User`
+        :param rows: list of row tuples
+    """
+    __slots__ = ('model', 'rows')
+
+    def __init__(self, model, rows: List[tuple] = None):
+        self.model = model
+        self.rows = rows if rows is not None else []
+
+    def append(self, row: tuple):
+        self.rows.append(row)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __iter__(self) -> Iterator:
+        return map(self.model._make, self.rows)
+
+    def to_dicts(self) -> List[dict]:
+        """ Returns rows as dicts, without building model objects
+        """
+        fields = self.model._fields
+        return [dict(zip(fields, row)) for row in self.rows]
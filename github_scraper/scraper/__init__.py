@@ -1 +1,4 @@
+from .archive import Archive  # noqa
+from .limiter import AdaptiveLimiter  # noqa
 from .scraper import Scraper, run_scraper  # noqa
+from .graphql import GraphQLScraper  # noqa
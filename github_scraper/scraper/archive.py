@@ -0,0 +1,160 @@
+import hashlib
+import os
+import sqlite3
+import time
+import zlib
+
+from typing import Iterator, NamedTuple
+
+
+class ArchiveEntry(NamedTuple):
+    url: str
+    fetched_at: float
+    digest: str
+    body: bytes
+
+
+class Archive:
+    """ Append-only archive of raw response bodies. Bodies are deduplicated
+        by their SHA-256 digest and stored zlib-compressed in segment files,
+        while an SQLite index maps every fetch (URL and time) to a digest.
+        This allows replaying responses locally instead of re-crawling.
+
+        :param path: directory holding the segment files and the index
+        :param segment_size: size in bytes after which a new segment file is
+                             started
+    """
+    index_name = 'index.sqlite'
+    segment_name = 'segment-{:06d}.z'
+
+    def __init__(self, path: str, *, segment_size: int = 64 * 1024 * 1024):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.segment_size = segment_size
+        self.conn = sqlite3.connect(os.path.join(path, self.index_name))
+        self.closed = False
+        self.create_tables()
+        self.segment = self._get_last_segment()
+        self.file = None
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.conn.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def create_tables(self):
+        c = self.conn.cursor()
+        c.execute('''
+CREATE TABLE IF NOT EXISTS blob (
+    digest      text        primary key,
+    segment     integer,
+    offset      integer,
+    length      integer
+)
+''')
+        c.execute('''
+CREATE TABLE IF NOT EXISTS fetch (
+    id          integer     primary key,
+    url         text,
+    fetched_at  real,
+    digest      text,
+    FOREIGN KEY (digest) REFERENCES blob (digest)
+)
+''')
+        c.execute('''
+CREATE INDEX IF NOT EXISTS fetch_url ON fetch (url, fetched_at)
+''')
+
+    def put(self, url: str, body: bytes, fetched_at: float = None) -> str:
+        """ Archive body fetched from url and return its digest. Bodies
+            already in the archive are only indexed, not written again.
+        """
+        if fetched_at is None:
+            fetched_at = time.time()
+
+        digest = hashlib.sha256(body).hexdigest()
+        c = self.conn.cursor()
+        c.execute('SELECT 1 FROM blob WHERE digest = ?', (digest,))
+        if c.fetchone() is None:
+            data = zlib.compress(body)
+            segment, offset = self._write(data)
+            c.execute('INSERT INTO blob VALUES (?, ?, ?, ?)',
+                      (digest, segment, offset, len(data)))
+        c.execute('INSERT INTO fetch (url, fetched_at, digest) '
+                  'VALUES (?, ?, ?)', (url, fetched_at, digest))
+        self.conn.commit()
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        """ Returns body for the given digest
+        """
+        c = self.conn.cursor()
+        c.execute('SELECT segment, offset, length FROM blob WHERE digest = ?',
+                  (digest,))
+        row = c.fetchone()
+        if row is None:
+            raise KeyError(digest)
+        segment, offset, length = row
+        with open(self._get_segment_path(segment), 'rb') as f:
+            f.seek(offset)
+            return zlib.decompress(f.read(length))
+
+    def latest(self, url: str) -> bytes:
+        """ Returns the most recently archived body for url, if any
+        """
+        c = self.conn.cursor()
+        c.execute('SELECT digest FROM fetch WHERE url = ? '
+                  'ORDER BY fetched_at DESC LIMIT 1', (url,))
+        row = c.fetchone()
+        return self.get(row[0]) if row else None
+
+    def replay(self, prefix: str = '', *,
+               latest: bool = True) -> Iterator[ArchiveEntry]:
+        """ Iterate archived responses whose URL starts with prefix, in fetch
+            order. When latest is true, only the last fetch of every URL is
+            returned.
+        """
+        if latest:
+            raw = ('SELECT url, MAX(fetched_at), digest FROM fetch '
+                   'WHERE substr(url, 1, ?) = ? GROUP BY url '
+                   'ORDER BY 2, url')
+        else:
+            raw = ('SELECT url, fetched_at, digest FROM fetch '
+                   'WHERE substr(url, 1, ?) = ? ORDER BY fetched_at, id')
+        c = self.conn.cursor()
+        c.execute(raw, (len(prefix), prefix))
+        for url, fetched_at, digest in c.fetchall():
+            yield ArchiveEntry(url, fetched_at, digest, self.get(digest))
+
+    def _write(self, data: bytes) -> tuple:
+        """ Append data to the current segment, starting a new one when it
+            is full, and returns (segment, offset)
+        """
+        if self.file is None:
+            self.file = open(self._get_segment_path(self.segment), 'ab')
+        offset = self.file.tell()
+        if offset and offset + len(data) > self.segment_size:
+            self.file.close()
+            self.segment += 1
+            self.file = open(self._get_segment_path(self.segment), 'ab')
+            offset = self.file.tell()
+        self.file.write(data)
+        self.file.flush()
+        return self.segment, offset
+
+    def _get_last_segment(self) -> int:
+        c = self.conn.cursor()
+        c.execute('SELECT MAX(segment) FROM blob')
+        segment = c.fetchone()[0]
+        return segment if segment is not None else 0
+
+    def _get_segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, self.segment_name.format(segment))
@@ -1,2 +1,24 @@
 class ServerError(Exception):
     pass
+
+
+class Stopped(Exception):
+    """ The scraper is stopping and doesn't start new requests
+    """
+
+
+class RateLimitError(Exception):
+    """ Secondary rate limit, the request can be retried after `retry_after`
+        seconds
+    """
+    def __init__(self, retry_after: float):
+        super(RateLimitError, self).__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class GraphQLError(Exception):
+    """ GraphQL query failed, with the given error messages
+    """
+    def __init__(self, messages: list):
+        super(GraphQLError, self).__init__('; '.join(map(str, messages)))
+        self.messages = messages
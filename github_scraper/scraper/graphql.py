@@ -0,0 +1,193 @@
+import aiohttp
+import hashlib
+import json
+
+from functools import lru_cache
+from typing import List, Tuple
+from tenacity import retry, retry_if_exception_type, wait_exponential
+
+from ..models import Batch, Repo
+
+from .exceptions import GraphQLError, ServerError
+from .scraper import Scraper, loads
+
+
+# the REST user list also has organizations, so logins are looked up as
+# repository owners, which are users or organizations
+USER_REPOS_QUERY = '''
+  u{0}: repositoryOwner(login: $login{0}) {{
+    ... on User {{
+      databaseId
+    }}
+    ... on Organization {{
+      databaseId
+    }}
+    repositories(first: $first, after: $after{0}, privacy: PUBLIC,
+                 ownerAffiliations: OWNER,
+                 orderBy: {{field: CREATED_AT, direction: ASC}}) {{
+      ...repos
+    }}
+  }}'''
+
+REPOS_FRAGMENT = '''
+fragment repos on RepositoryConnection {
+  pageInfo {
+    hasNextPage
+    endCursor
+  }
+  nodes {
+    databaseId
+    url
+    name
+    description
+    primaryLanguage {
+      name
+    }
+  }
+}
+'''
+
+
+class GraphQLScraper(Scraper):
+    """ Scraper which fetches repositories of many users with a single
+        request to the GraphQL API, instead of a request per user. Users are
+        still listed with the REST API, as GraphQL can't list them by id.
+        Like with the REST API, organizations are fetched as users.
+
+        Each query asks for the repositories of `users_per_query` users,
+        aliased as u0, u1, ..., with a cursor per user. Users with more
+        repositories than `repos_per_user` are queried again from their
+        cursor.
+
+        The GraphQL API requires a token, see :class:`Scraper` for the other
+        parameters.
+    """
+    api_graphql_endpoint = 'https://api.github.com/graphql'
+    users_per_query = 25
+    repos_per_user = 100
+
+    async def async_fetch_users_and_repos(self):
+        """ Fetch users, and then their repositories in batches
+        """
+        headers = self.get_headers()
+        async with aiohttp.ClientSession(headers=headers) as session:
+            logins = []
+            async for user in self.async_fetch_user_list(session):
+                logins.append(user.login)
+            await self.async_gather([
+                self.async_fetch_repos_batch(
+                    session, logins[i:i + self.users_per_query])
+                for i in range(0, len(logins), self.users_per_query)])
+
+    async def async_fetch_repos_batch(self,
+                                      session: aiohttp.ClientSession,
+                                      logins: List[str]):
+        """ Fetch repositories of users and put in storage
+        """
+        pending = [(login, None) for login in logins]
+        while pending:
+            query, variables = build_repos_query(pending, self.repos_per_user)
+            result = await self.async_query(session, query, variables)
+            errors = get_field_errors(result)
+
+            batch = Batch(Repo)
+            next_pending = []
+            for i, (login, _) in enumerate(pending):
+                alias = 'u{}'.format(i)
+                user = result['data'].get(alias)
+                if user is None:
+                    # eg. renamed or deleted since it was listed
+                    self.stats['e'] += 1
+                    self.report_error(GraphQLError(errors.get(alias, [
+                        'Could not resolve owner {}'.format(login)])))
+                    continue
+                repos = user['repositories']
+                for repo in repos['nodes']:
+                    language = repo['primaryLanguage']
+                    obj = Repo(
+                        id=repo['databaseId'],
+                        user_id=user['databaseId'],
+                        repo_url=repo['url'],
+                        name=repo['name'],
+                        description=repo['description'],
+                        language=language['name'] if language else None,
+                    )
+                    self.stats['r'] += 1
+                    self.report_obj(obj)
+                    batch.append(obj)
+                if repos['pageInfo']['hasNextPage']:
+                    next_pending.append(
+                        (login, repos['pageInfo']['endCursor']))
+            self.stats['s'] += len(batch) - self.storage.put_repos(batch)
+            pending = next_pending
+
+    @retry(retry=retry_if_exception_type(ServerError),
+           wait=wait_exponential(multiplier=1))
+    async def async_query(self,
+                          session: aiohttp.ClientSession,
+                          query: str,
+                          variables: dict) -> dict:
+        """ POST a GraphQL query and return the response, which has data.
+            Retried like :func:`Scraper.async_get`. Raw response bodies are
+            kept in the archive, if any, see :func:`get_archive_key`.
+        """
+        payload = {'query': query, 'variables': variables}
+        body = await self.async_request(
+            session, 'POST', self.api_graphql_endpoint,
+            data=json.dumps(payload),
+            headers={'Content-Type': 'application/json'})
+        if self.archive is not None:
+            self.archive.put(
+                get_archive_key(self.api_graphql_endpoint, payload), body)
+
+        result = loads(body)
+        if result.get('data') is None:
+            raise GraphQLError([error.get('message')
+                                for error in result.get('errors', [])])
+        # errors about single users, eg. NOT_FOUND, leave them null, see
+        # get_field_errors
+        return result
+
+
+def build_repos_query(pending: List[Tuple[str, str]],
+                      repos_per_user: int) -> Tuple[str, dict]:
+    """ Returns query and variables to fetch repositories of users, given as
+        (login, cursor) pairs
+    """
+    variables = {'first': repos_per_user}
+    for i, (login, cursor) in enumerate(pending):
+        variables['login{}'.format(i)] = login
+        variables['after{}'.format(i)] = cursor
+    return get_repos_query(len(pending)), variables
+
+
+def get_field_errors(result: dict) -> dict:
+    """ Returns error messages of a GraphQL response by the top-level field
+        they are about, eg. {'u1': ['Could not resolve ...']}
+    """
+    errors = {}
+    for error in result.get('errors', []):
+        path = error.get('path')
+        if path:
+            errors.setdefault(path[0], []).append(error.get('message'))
+    return errors
+
+
+def get_archive_key(endpoint: str, payload: dict) -> str:
+    """ Returns the key a GraphQL response is archived with: all queries are
+        sent to the same endpoint, so it's followed by a hash of the query
+        and its variables, eg. https://api.github.com/graphql#<sha1>
+    """
+    data = json.dumps(payload, sort_keys=True, separators=(',', ':'))
+    return '{}#{}'.format(endpoint, hashlib.sha1(data.encode()).hexdigest())
+
+
+@lru_cache(maxsize=None)
+def get_repos_query(users: int) -> str:
+    """ Returns query for the repositories of the given number of users
+    """
+    params = ', '.join('$login{0}: String!, $after{0}: String'.format(i)
+                       for i in range(users))
+    fields = ''.join(USER_REPOS_QUERY.format(i) for i in range(users))
+    return 'query($first: Int!, {}) {{{}\n}}\n{}'.format(
+        params, fields, REPOS_FRAGMENT)
@@ -0,0 +1,161 @@
+import asyncio
+import time
+
+from collections import deque
+from typing import Callable, Tuple
+
+
+class AdaptiveLimiter:
+    """ Limits the number of concurrent requests, adapting the limit to the
+        observed latency with additive increase and multiplicative decrease
+        (AIMD).
+
+        While the limit is in use and latency stays flat, the limit grows by
+        about one for every `limit` successful requests. When the average
+        latency rises above `tolerance` times the baseline latency, or when a
+        request fails with one of `overload_errors`, the limit is multiplied
+        by `backoff`.
+
+        The baseline is the lowest average latency seen, which slowly drifts
+        towards the average so that a slower network is eventually accepted as
+        the new normal. Requests that started before a decrease do not
+        decrease it again, so a burst of slow or failed requests counts once.
+
+        Requests are run with ``async with limiter.slot(): ...``
+
+    :param initial_limit: number of concurrent requests to start with
+    :param min_limit: lower bound for the limit
+    :param max_limit: upper bound for the limit
+    :param backoff: factor applied to the limit when backing off
+    :param tolerance: latency increase, relative to the baseline, that is
+                      taken as a sign of overload
+    :param overload_errors: exceptions that make the limiter back off
+    :param clock: returns the current time in seconds
+    """
+    # weight of a new latency sample in the average and in the baseline
+    latency_weight = 0.2
+    baseline_weight = 0.002
+
+    def __init__(self, initial_limit: int = 8, *,
+                 min_limit: int = 1,
+                 max_limit: int = 128,
+                 backoff: float = 0.7,
+                 tolerance: float = 1.5,
+                 overload_errors: Tuple[type, ...] = (),
+                 clock: Callable[[], float] = time.monotonic):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.overload_errors = overload_errors
+        self.clock = clock
+
+        self.in_flight = 0
+        self.latency = None
+        self.baseline_latency = None
+        self.waiters = deque()
+
+        # slots are numbered to know which ones started after a decrease
+        self.last_slot = 0
+        self.last_decrease = 0
+
+    @property
+    def current_limit(self) -> int:
+        return int(self.limit)
+
+    def slot(self) -> 'Slot':
+        """ Returns an async context manager which waits for the limit to
+            allow one more request, and updates the limit when it exits
+        """
+        return Slot(self)
+
+    async def acquire(self):
+        """ Wait until a request can be started
+        """
+        while self.in_flight >= self.current_limit:
+            waiter = asyncio.get_event_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # let another request take our turn, if we were woken up
+                self.wake()
+                raise
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+        self.in_flight += 1
+
+    def release(self):
+        """ Mark a request as finished
+        """
+        self.in_flight -= 1
+        self.wake()
+
+    def wake(self):
+        """ Wake up as many waiting requests as the limit allows
+        """
+        available = self.current_limit - self.in_flight
+        while available > 0 and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                available -= 1
+
+    def on_success(self, slot: 'Slot', latency: float):
+        """ Update the limit with the latency of a successful request
+        """
+        if self.latency is None:
+            self.latency = self.baseline_latency = latency
+        else:
+            self.latency += self.latency_weight * (latency - self.latency)
+            self.baseline_latency = min(self.latency, self.baseline_latency + (
+                self.baseline_weight * (self.latency - self.baseline_latency)))
+
+        if self.latency > self.baseline_latency * self.tolerance:
+            self.decrease(slot)
+        elif slot.in_flight * 2 >= self.limit:
+            # only grow when the limit is actually in use
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def on_overload(self, slot: 'Slot'):
+        """ Update the limit after a request failed because of overload
+        """
+        self.decrease(slot)
+
+    def decrease(self, slot: 'Slot'):
+        if slot.number > self.last_decrease:
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+            self.last_decrease = self.last_slot
+
+
+class Slot:
+    """ A request running under an :class:`AdaptiveLimiter`
+
+    :param limiter: the limiter the request runs under
+    """
+    __slots__ = ('limiter', 'number', 'in_flight', 'started_at')
+
+    def __init__(self, limiter: AdaptiveLimiter):
+        self.limiter = limiter
+        self.number = None
+        self.in_flight = None
+        self.started_at = None
+
+    async def __aenter__(self):
+        limiter = self.limiter
+        await limiter.acquire()
+        limiter.last_slot += 1
+        self.number = limiter.last_slot
+        self.in_flight = limiter.in_flight
+        self.started_at = limiter.clock()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        limiter = self.limiter
+        if exc_type is None:
+            limiter.on_success(self, limiter.clock() - self.started_at)
+        elif issubclass(exc_type, limiter.overload_errors):
+            limiter.on_overload(self)
+        limiter.release()
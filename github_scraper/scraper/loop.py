@@ -0,0 +1,73 @@
+import asyncio
+
+from typing import Callable
+
+try:
+    import uvloop
+except ImportError:  # pragma: no cover
+    uvloop = None
+
+
+class LagMonitor:
+    """ Measures event loop lag, that is how late callbacks run compared to
+        when they were scheduled. A callback is scheduled every `interval`
+        seconds, and lags of `threshold` seconds or more, which mean that
+        something blocked the loop, eg. a synchronous storage call or a big
+        JSON body being decoded, are passed to `report`.
+
+        Lag stats are kept in `stats`.
+
+    :param interval: seconds between measures
+    :param threshold: lag in seconds from which the loop is considered blocked
+    :param report: called with the lag when the loop was blocked
+    """
+    def __init__(self, *,
+                 interval: float = 0.1,
+                 threshold: float = 0.1,
+                 report: Callable[[float], None] = None):
+        self.interval = interval
+        self.threshold = threshold
+        self.report = report
+        self.stats = {'samples': 0, 'total': 0.0, 'max': 0.0, 'blocked': 0}
+        self.loop = None
+        self.handle = None
+        self.expected = None
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.schedule()
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def schedule(self):
+        self.expected = self.loop.time() + self.interval
+        self.handle = self.loop.call_at(self.expected, self.tick)
+
+    def tick(self):
+        lag = max(0.0, self.loop.time() - self.expected)
+        self.stats['samples'] += 1
+        self.stats['total'] += lag
+        self.stats['max'] = max(self.stats['max'], lag)
+        if lag >= self.threshold:
+            self.stats['blocked'] += 1
+            if self.report is not None:
+                self.report(lag)
+        self.schedule()
+
+    @property
+    def mean_lag(self) -> float:
+        if not self.stats['samples']:
+            return 0.0
+        return self.stats['total'] / self.stats['samples']
+
+
+def use_uvloop():
+    """ Make asyncio use uvloop's event loop, which has a lower overhead per
+        callback than the default one
+    """
+    if uvloop is None:
+        raise ImportError('--uvloop requires uvloop')
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
@@ -1,15 +1,26 @@
 import aiohttp
 import asyncio
+import signal
 import sys
 import time
 
-from typing import Iterator
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Iterable, Iterator
 from tenacity import retry, retry_if_exception_type, wait_exponential, TryAgain
 
+try:
+    from orjson import loads
+except ImportError:  # pragma: no cover
+    from json import loads
+
 from ..storage import Storage
-from ..models import User, Repo
+from ..models import Batch, User, Repo
 
-from .exceptions import ServerError
+from .archive import Archive
+from .exceptions import RateLimitError, ServerError, Stopped
+from .limiter import AdaptiveLimiter
+from .loop import LagMonitor, use_uvloop
 
 
 class Scraper:
@@ -20,31 +31,155 @@ class Scraper:
         :param storage: :func:`storage.Storage` object to put fetched users
                         and repositories
         :param verbosity: 0 (silent), 1 (minimum), 2 (verbose)
+        :param archive: optional :func:`archive.Archive` object to keep raw
+                        response bodies
+        :param limiter: optional :func:`limiter.AdaptiveLimiter` object to
+                        limit concurrent requests
+        :param token: optional GitHub token to authenticate requests
+        :param lag_threshold: event loop lag in seconds reported as blocking,
+                              see :class:`loop.LagMonitor`
+        :param snapshot: optional path where a read-only copy of the storage
+                         is published every `snapshot_interval` seconds and
+                         when done, see :func:`Storage.publish_snapshot`
+        :param snapshot_interval: seconds between snapshots
     """
     api_users_endpoint = 'https://api.github.com/users?since={}'
     api_repos_endpoint = 'https://api.github.com/users/{}/repos'
 
-    def __init__(self, storage: Storage, *, verbosity: int):
+    # seconds given to running requests to finish when stopped
+    drain_timeout = 10
+
+    def __init__(self, storage: Storage, *, verbosity: int,
+                 archive: Archive = None,
+                 limiter: AdaptiveLimiter = None,
+                 token: str = None,
+                 lag_threshold: float = 0.1,
+                 snapshot: str = None,
+                 snapshot_interval: float = 60):
+        if limiter is None:
+            limiter = AdaptiveLimiter(
+                overload_errors=(ServerError, RateLimitError))
         self.storage = storage
         self.verbosity = verbosity
-        self.stats = {'u': 0, 'r': 0}
+        self.archive = archive
+        self.limiter = limiter
+        self.token = token
+        self.snapshot = snapshot
+        self.snapshot_interval = snapshot_interval
+        self.lag_monitor = LagMonitor(threshold=lag_threshold,
+                                      report=self.report_lag)
+        self.stats = {'u': 0, 'r': 0, 's': 0, 'e': 0,
+                      'c': limiter.current_limit}
+        self.stopping = False
+        self.task = None
+        self.drain_handle = None
+        self.publishing = None
 
     def run(self):
-        """ Run the scraper
+        """ Run the scraper until it's done, or stopped by SIGINT or SIGTERM
         """
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(self.async_fetch_users_and_repos())
+        asyncio.run(self.async_run())
 
         self.print_stats()
 
+    async def async_run(self):
+        """ Fetch users and repositories, stopping gracefully on SIGINT or
+            SIGTERM, see :func:`Scraper.stop`
+        """
+        loop = asyncio.get_running_loop()
+        self.task = asyncio.ensure_future(self.async_fetch_users_and_repos())
+
+        signals = []
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, self.stop)
+            except (NotImplementedError, RuntimeError):  # pragma: no cover
+                # not supported on Windows, nor outside of the main thread
+                continue
+            signals.append(signum)
+        self.lag_monitor.start(loop)
+        publisher = None
+        if self.snapshot is not None:
+            publisher = asyncio.ensure_future(self.async_publish_snapshots())
+
+        try:
+            await self.task
+        except (asyncio.CancelledError, Stopped):
+            if not self.stopping:
+                raise
+        finally:
+            if publisher is not None:
+                publisher.cancel()
+            self.lag_monitor.stop()
+            if self.drain_handle is not None:
+                self.drain_handle.cancel()
+            for signum in signals:
+                loop.remove_signal_handler(signum)
+
+        if self.snapshot is not None:
+            if self.publishing is not None and not self.publishing.done():
+                # a copy in progress can't be interrupted, wait for it
+                # rather than starting another one next to it
+                try:
+                    await self.publishing
+                except Exception as e:
+                    self.report_error(e)
+            await self.async_publish_snapshot()
+
+    async def async_publish_snapshots(self):
+        """ Publish a snapshot every `snapshot_interval` seconds
+        """
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            await self.async_publish_snapshot()
+
+    async def async_publish_snapshot(self):
+        """ Publish a snapshot of the storage, in a thread so that copying
+            the database doesn't block the loop. Cancelling doesn't stop the
+            copy, which is kept in `publishing`.
+        """
+        loop = asyncio.get_running_loop()
+        self.publishing = loop.run_in_executor(
+            None, self.storage.publish_snapshot, self.snapshot)
+        await asyncio.shield(self.publishing)
+
+    def stop(self):
+        """ Stop the scraper. New requests are not started, while running
+            ones are given `drain_timeout` seconds to finish and store their
+            results. Stopping again cancels running requests right away.
+        """
+        if self.task is None or self.task.done():
+            return
+        if self.stopping:
+            self.task.cancel()
+            return
+
+        self.stopping = True
+        if self.verbosity > 0:
+            log('\n', 'Stopping, waiting for running requests\n')
+        self.drain_handle = asyncio.get_event_loop().call_later(
+            self.drain_timeout, self.task.cancel)
+
     async def async_fetch_users_and_repos(self):
         """ Fetch users and repositories
         """
-        async with aiohttp.ClientSession() as session:
+        headers = self.get_headers()
+        async with aiohttp.ClientSession(headers=headers) as session:
             tasks = []
             async for user in self.async_fetch_user_list(session):
                 tasks.append(self.async_fetch_repos(session, user.login))
-            await asyncio.wait(tasks)
+            await self.async_gather(tasks)
+
+    async def async_gather(self, tasks: Iterable):
+        """ Run tasks concurrently. Failed tasks are reported and don't stop
+            the other ones.
+        """
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception) and \
+                    not isinstance(result, Stopped):
+                self.stats['e'] += 1
+                self.report_error(result)
 
     async def async_fetch_user_list(self,
                                     session: aiohttp.ClientSession,
@@ -53,6 +188,7 @@ class Scraper:
         """
         url = self.api_users_endpoint.format(self.get_last_user_id())
         result = await self.async_get(session, url)
+        batch = Batch(User)
         for user in result:
             obj = User(
                 id=user['id'],
@@ -61,7 +197,9 @@ class Scraper:
             )
             self.stats['u'] += 1
             self.report_obj(obj)
-            self.storage.put_user(obj)
+            batch.append(obj)
+        self.stats['s'] += len(batch) - self.storage.put_users(batch)
+        for obj in batch.rows:
             yield obj
 
     async def async_fetch_repos(self,
@@ -71,6 +209,7 @@ class Scraper:
         """
         url = self.api_repos_endpoint.format(login)
         result = await self.async_get(session, url)
+        batch = Batch(Repo)
         for repo in result:
             obj = Repo(
                 id=repo['id'],
@@ -82,7 +221,8 @@ class Scraper:
             )
             self.stats['r'] += 1
             self.report_obj(obj)
-            self.storage.put_repo(obj)
+            batch.append(obj)
+        self.stats['s'] += len(batch) - self.storage.put_repos(batch)
 
     @retry(retry=retry_if_exception_type(ServerError),
            wait=wait_exponential(multiplier=1))
@@ -91,11 +231,39 @@ class Scraper:
                         url: str) -> dict:
         """ GET request and perform response validation. In case of a
             ServerError, for every retry we will increase time exponentially.
+            Raw response bodies are kept in the archive, if any.
+        """
+        body = await self.async_request(session, 'GET', url)
+        if self.archive is not None:
+            self.archive.put(url, body)
+        return loads(body)
+
+    async def async_request(self,
+                            session: aiohttp.ClientSession,
+                            method: str,
+                            url: str,
+                            **kwargs) -> bytes:
+        """ Perform request and return the validated response body.
+
+            Concurrent requests are limited by the limiter, which backs off on
+            server errors and secondary rate limits. Once the scraper is
+            stopping, new requests raise :class:`exceptions.Stopped`.
         """
-        async with session.get(url) as response:
-            await self.validate_response(response)
-            result = await response.json()
-            return result
+        try:
+            async with self.limiter.slot():
+                if self.stopping:
+                    raise Stopped
+                async with session.request(method, url, **kwargs) as response:
+                    await self.validate_response(response)
+                    return await response.read()
+        except RateLimitError as e:
+            if self.verbosity > 0:
+                log('\n', 'Secondary rate limit, retrying in {}s\n'.format(
+                    e.retry_after))
+            await asyncio.sleep(e.retry_after)
+            raise TryAgain
+        finally:
+            self.stats['c'] = self.limiter.current_limit
 
     async def validate_response(self, response: aiohttp.ClientResponse):
         """ Validate response and look for particular errors
@@ -109,12 +277,25 @@ class Scraper:
             await asyncio.sleep(retry_in)
             raise TryAgain
 
-        if response.status == 500:
+        if response.status == 429 or (response.status == 403 and
+                                      'retry-after' in response.headers):
+            # secondary rate limit, we are sending too many requests at once
+            raise RateLimitError(
+                get_retry_after(response.headers.get('retry-after')))
+
+        if response.status >= 500:
             # looks like the server is having problems
             raise ServerError
 
         response.raise_for_status()
 
+    def get_headers(self) -> dict:
+        """ Returns headers sent with every request
+        """
+        if self.token:
+            return {'Authorization': 'token {}'.format(self.token)}
+        return {}
+
     def get_last_user_id(self) -> int:
         """ Returns last user id we have seen
         """
@@ -135,11 +316,52 @@ class Scraper:
             elif isinstance(obj, Repo):
                 log('r')
 
+    def report_error(self, error: Exception):
+        """ Report a failed task to command line according to verbosity
+        """
+        if self.verbosity > 0:
+            log('\n', 'Error: {!r}\n'.format(error))
+
+    def report_lag(self, lag: float):
+        """ Report a blocked event loop to command line according to
+            verbosity
+        """
+        if self.verbosity > 1:
+            log('Event loop blocked for {:.0f}ms\n'.format(lag * 1000))
+
     def print_stats(self):
         """ Print stats for fetched users and repositories
         """
         if self.verbosity > 0:
-            log('\n', 'Fetched {u} users and {r} repos'.format(**self.stats))
+            message = ('Fetched {u} users and {r} repos, {s} unchanged, '
+                       '{e} errors (concurrency limit {c})')
+            log('\n', message.format(**self.stats))
+
+            lag = self.lag_monitor
+            message = ('\nEvent loop lag: {:.1f}ms mean, {:.0f}ms max, '
+                       'blocked {} times')
+            log(message.format(lag.mean_lag * 1000,
+                               lag.stats['max'] * 1000,
+                               lag.stats['blocked']))
+
+
+def get_retry_after(value: str, default: float = 60) -> float:
+    """ Returns seconds to wait from a Retry-After header, which is either a
+        number of seconds or an HTTP date, or default if it can't be parsed
+    """
+    if value is None:
+        return default
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if date.tzinfo is None:
+        # HTTP dates are in GMT, but parsed as naive from "-0000"
+        date = date.replace(tzinfo=timezone.utc)
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
 
 
 def log(*messages):
@@ -150,16 +372,22 @@ def log(*messages):
     sys.stdout.flush()
 
 
-def run_scraper(*, storage: Storage, verbosity: int):
+def run_scraper(*, storage: Storage, verbosity: int, archive: Archive = None,
+                token: str = None, scraper_class: type = Scraper,
+                uvloop: bool = False, snapshot: str = None,
+                snapshot_interval: float = 60):
     """ Run scraper from command line
     """
+    if uvloop:
+        use_uvloop()
     try:
-        Scraper(storage=storage, verbosity=verbosity).run()
-    except KeyboardInterrupt:
-        asyncio.gather(*asyncio.Task.all_tasks()).cancel()
-
-        loop = asyncio.get_event_loop()
-        loop.stop()
+        scraper_class(storage=storage, verbosity=verbosity, archive=archive,
+                      token=token, snapshot=snapshot,
+                      snapshot_interval=snapshot_interval).run()
+    except KeyboardInterrupt:  # pragma: no cover
+        # signal handlers are not supported on this platform, asyncio.run
+        # already cancelled running tasks
+        pass
     finally:
         if verbosity > 0:
             log('\n')
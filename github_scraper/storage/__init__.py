@@ -1 +1,15 @@
-from .base import Storage, Q  # noqa
+from .base import Storage  # noqa
+from .query import Q, QGroup  # noqa
+
+
+def get_storage(database: str) -> Storage:
+    """ Returns storage for the given database path or URL. URLs starting
+        with postgresql:// use :func:`postgres.PostgresStorage`, anything
+        else is a SQLite database path.
+    """
+    if database.startswith(('postgresql://', 'postgres://')):
+        from .postgres import PostgresStorage
+        return PostgresStorage(database)
+    else:
+        from .sqlite import SQLiteStorage
+        return SQLiteStorage(database)
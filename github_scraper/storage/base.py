@@ -1,24 +1,6 @@
-from typing import List
+from typing import Iterable, List
 
-from ..models import User, Repo
-
-
-class Q:
-    """ Q function allows building basic queries using a pythonic approach
-    """
-    LT = '<'
-    GT = '>'
-
-    def __init__(self, name, op=None, value=None):
-        self.name = name
-        self.op = op
-        self.value = value
-
-    def __gt__(self, value):
-        return Q(self.name, self.GT, value)
-
-    def __lt__(self, value):
-        return Q(self.name, self.LT, value)
+from ..models import Change, LanguageStats, User, UserStats, Repo
 
 
 class Storage:
@@ -33,8 +15,14 @@ class Storage:
     def __exit__(self, *args):
         raise NotImplementedError  # pragma: no cover
 
-    def put_user(self, obj: User):
-        """ Insert or update user
+    def put_user(self, obj: User) -> bool:
+        """ Insert or update user, returns false if it was unchanged
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def put_users(self, objs: Iterable[User]) -> int:
+        """ Insert or update users in bulk, returns the number of users
+            written, unchanged ones are skipped
         """
         raise NotImplementedError  # pragma: no cover
 
@@ -57,8 +45,14 @@ class Storage:
         """
         raise NotImplementedError  # pragma: no cover
 
-    def put_repo(self, obj: Repo):
-        """ Insert or update repo
+    def put_repo(self, obj: Repo) -> bool:
+        """ Insert or update repo, returns false if it was unchanged
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def put_repos(self, objs: Iterable[Repo]) -> int:
+        """ Insert or update repos in bulk, returns the number of repos
+            written, unchanged ones are skipped
         """
         raise NotImplementedError  # pragma: no cover
 
@@ -75,3 +69,29 @@ class Storage:
         """ Returns filtered list of repos
         """
         raise NotImplementedError  # pragma: no cover
+
+    def list_language_stats(self, limit: int = None) -> List[LanguageStats]:
+        """ Returns number of repos per language, most used first
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def list_top_users(self, limit: int = None) -> List[UserStats]:
+        """ Returns users with the most repos
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def get_progress(self) -> dict:
+        """ Returns number of users and repos and the last user id
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def list_changes(self, since: int = 0, limit: int = None) -> List[Change]:
+        """ Returns users and repos written after the change sequence number
+            `since`, in the order they were written
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def publish_snapshot(self, path: str):
+        """ Publish a consistent, read-only copy of the storage to path
+        """
+        raise NotImplementedError  # pragma: no cover
@@ -0,0 +1,81 @@
+from ..models import User
+from .query import Q
+
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional, Tuple
+
+import time
+
+
+class UserCache:
+    """ LRU cache of hot users, indexed by id and login. Entries expire after
+        `ttl` seconds, as other processes may write to the same database.
+
+        :param maxsize: maximum number of cached users, 0 disables the cache
+        :param ttl: seconds an entry is kept
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.by_id = OrderedDict()
+        self.by_login = {}
+        self.stats = {'hits': 0, 'misses': 0}
+        self.lock = Lock()
+
+    def get_key(self, lookup: tuple) -> Optional[Tuple[str, object]]:
+        """ Returns (field, value) if lookup is an exact match on id or
+            login, otherwise None
+        """
+        if self.maxsize <= 0 or len(lookup) != 1:
+            return None
+        clause = lookup[0]
+        if isinstance(clause, Q):
+            if clause.op == Q.EQ and clause.name in ('id', 'login'):
+                return (clause.name, clause.value)
+        elif isinstance(clause, dict) and len(clause) == 1:
+            # strings in dicts are not exact matches
+            value = clause.get('id')
+            if isinstance(value, int):
+                return ('id', value)
+        return None
+
+    def get(self, field: str, value) -> Optional[User]:
+        with self.lock:
+            if field == 'login':
+                value = self.by_login.get(value)
+            entry = self.by_id.get(value)
+            if entry is None or entry[1] < time.monotonic():
+                self.stats['misses'] += 1
+                return None
+            self.by_id.move_to_end(value)
+            self.stats['hits'] += 1
+            return entry[0]
+
+    def put(self, user: User):
+        with self.lock:
+            self._discard(user.id, user.login)
+            self.by_id[user.id] = (user, time.monotonic() + self.ttl)
+            self.by_login[user.login] = user.id
+            while len(self.by_id) > self.maxsize:
+                _, (old, _) = self.by_id.popitem(last=False)
+                self.by_login.pop(old.login, None)
+
+    def discard(self, user_id: int, login: str):
+        """ Remove entries for the user id and the login
+        """
+        with self.lock:
+            self._discard(user_id, login)
+
+    def clear(self):
+        with self.lock:
+            self.by_id.clear()
+            self.by_login.clear()
+
+    def _discard(self, user_id: int, login: str):
+        entry = self.by_id.pop(user_id, None)
+        if entry is not None:
+            self.by_login.pop(entry[0].login, None)
+        other_id = self.by_login.pop(login, None)
+        if other_id is not None:
+            self.by_id.pop(other_id, None)
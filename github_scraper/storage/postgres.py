@@ -0,0 +1,528 @@
+from .sql import SQLStorage, add_row_hashes
+from ..models import User, Repo
+
+from contextlib import contextmanager
+from typing import List
+
+import io
+
+try:
+    from psycopg2.pool import ThreadedConnectionPool
+except ImportError:  # pragma: no cover
+    ThreadedConnectionPool = None
+
+
+class PostgresStorage(SQLStorage):
+    """ PostgreSQL Storage
+
+    Writes are loaded into a temporary staging table, with COPY for bulk
+    writes, and then merged with INSERT ... ON CONFLICT.
+
+    :param dsn: connection URL, eg. postgresql://user@localhost/github
+    :param minconn: minimum number of connections kept in the pool
+    :param maxconn: maximum number of connections in the pool
+    :param query_cache_size: number of query shapes to cache
+    :param user_cache_size: number of users to cache
+    """
+    placeholder = '%s'
+    like_operator = 'ilike'
+    # other collations don't order strings by code point, so prefix ranges
+    # would match the wrong rows
+    prefix_collation = 'C'
+
+    # below this number of rows COPY is not worth the staging table
+    copy_threshold = 100
+
+    # bump when the schema changes, so that existing databases are upgraded
+    # the next time they're opened, see create_tables
+    schema_version = 1
+
+    def __init__(self, dsn: str, *,
+                 minconn: int = 1,
+                 maxconn: int = 10,
+                 query_cache_size: int = 256,
+                 user_cache_size: int = 1024):
+        if ThreadedConnectionPool is None:  # pragma: no cover
+            raise ImportError('PostgresStorage requires psycopg2')
+        super(PostgresStorage, self).__init__(
+            query_cache_size=query_cache_size,
+            user_cache_size=user_cache_size)
+        self.pool = ThreadedConnectionPool(minconn, maxconn, dsn)
+        self.closed = False
+        self.create_tables()
+
+    def close(self):
+        if not self.closed:
+            self.pool.closeall()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @contextmanager
+    def cursor(self):
+        """ Returns a cursor from a pooled connection, committing on success
+        """
+        conn = self.pool.getconn()
+        try:
+            with conn:
+                with conn.cursor() as c:
+                    yield c
+        finally:
+            self.pool.putconn(conn)
+
+    def create_tables(self):
+        """ Create the schema, or upgrade it if it's older than
+            schema_version.
+
+            Replacing triggers locks the tables exclusively, which would
+            block reads and wait for running writes every time a scraper or
+            API process starts. So the schema is only written when it's out
+            of date, by one process at a time.
+        """
+        with self.cursor() as c:
+            if get_schema_version(c) >= self.schema_version:
+                return
+        with self.cursor() as c:
+            c.execute("SELECT pg_advisory_xact_lock(hashtext('schema'))")
+            # another process may have upgraded it while we waited
+            if get_schema_version(c) >= self.schema_version:
+                return
+            self.create_schema(c)
+            c.execute('CREATE TABLE IF NOT EXISTS schema_version '
+                      '(version integer not null)')
+            c.execute('DELETE FROM schema_version')
+            c.execute('INSERT INTO schema_version VALUES (%s)',
+                      [self.schema_version])
+
+    def create_schema(self, c):
+        """ Create or upgrade tables, functions and triggers, in the
+            transaction of cursor c
+        """
+        c.execute('''
+CREATE TABLE IF NOT EXISTS "user" (
+    id          bigint      primary key,
+    login       text,
+    user_url    text
+)
+''')
+        c.execute('''
+CREATE UNIQUE INDEX IF NOT EXISTS user_login ON "user" (login)
+''')
+        # backs login prefix lookups, see prefix_collation
+        c.execute('''
+CREATE INDEX IF NOT EXISTS user_login_c ON "user" (login COLLATE "C")
+''')
+        c.execute('''
+CREATE TABLE IF NOT EXISTS repo (
+    id              bigint      primary key,
+    user_id         bigint,
+    repo_url        text,
+    name            text,
+    description     text,
+    language        text
+)
+''')
+        c.execute('''
+CREATE INDEX IF NOT EXISTS repo_user_id ON repo (user_id)
+''')
+        c.execute('''
+CREATE INDEX IF NOT EXISTS repo_language ON repo (language)
+''')
+        # databases created before content hashes were added
+        for table in ('user', 'repo'):
+            c.execute('ALTER TABLE "{}" ADD COLUMN IF NOT EXISTS '
+                      'hash bigint'.format(table))
+        self.create_stats(c)
+        self.create_changes(c)
+        self.create_commit_hook(c)
+
+    def create_stats(self, c):
+        """ Create aggregate tables, kept up to date by triggers.
+
+            Writes to the aggregate tables would make concurrent writers
+            queue on the same rows, eg. the repos count, and could deadlock
+            when they touch the same languages in a different order.
+            Instead, statement level triggers append the aggregated changes
+            of each statement to stats_delta, which takes no shared locks,
+            and the deltas of a transaction are applied at commit, in a
+            fixed order, see :meth:`create_commit_hook`.
+        """
+        c.execute("SELECT to_regclass('progress_stats')")
+        exists = c.fetchone()[0] is not None
+
+        c.execute('''
+CREATE TABLE IF NOT EXISTS language_stats (
+    language        text        primary key,
+    repos           bigint      not null
+)
+''')
+        c.execute('''
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id         bigint      primary key,
+    repos           bigint      not null
+)
+''')
+        c.execute('''
+CREATE INDEX IF NOT EXISTS user_stats_repos
+    ON user_stats (repos DESC, user_id DESC)
+''')
+        c.execute('''
+CREATE TABLE IF NOT EXISTS progress_stats (
+    name            text        primary key,
+    value           bigint      not null
+)
+''')
+        c.execute('''
+CREATE TABLE IF NOT EXISTS stats_delta (
+    txid            bigint      not null default txid_current(),
+    stat            text        not null,
+    key             text        not null,
+    n               bigint      not null
+)
+''')
+        c.execute('''
+CREATE INDEX IF NOT EXISTS stats_delta_txid ON stats_delta (txid)
+''')
+        c.execute('''
+CREATE OR REPLACE FUNCTION repo_stats() RETURNS trigger AS $$
+DECLARE
+    delta text;
+BEGIN
+    -- new rows count +1 and old rows -1, so updates which don't change
+    -- user_id or language cancel out
+    IF TG_OP = 'INSERT' THEN
+        delta := 'SELECT user_id, language, 1 AS n FROM new_rows';
+    ELSIF TG_OP = 'DELETE' THEN
+        delta := 'SELECT user_id, language, -1 AS n FROM old_rows';
+    ELSE
+        delta := 'SELECT user_id, language, 1 AS n FROM new_rows '
+                 || 'UNION ALL SELECT user_id, language, -1 FROM old_rows';
+    END IF;
+    EXECUTE format($q$
+INSERT INTO stats_delta (stat, key, n)
+    SELECT 'language', coalesce(language, ''), sum(n) FROM (%1$s) d
+        GROUP BY 2 HAVING sum(n) <> 0
+    UNION ALL
+    SELECT 'user', user_id::text, sum(n) FROM (%1$s) d
+        GROUP BY 2 HAVING sum(n) <> 0
+    UNION ALL
+    SELECT 'progress', 'repos', sum(n) FROM (%1$s) d
+        HAVING sum(n) <> 0
+$q$, delta);
+    PERFORM defer_commit();
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+''')
+        c.execute('''
+CREATE OR REPLACE FUNCTION user_stats() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO stats_delta (stat, key, n)
+            SELECT 'progress', 'users', count(*) FROM new_rows
+            HAVING count(*) > 0;
+    ELSE
+        INSERT INTO stats_delta (stat, key, n)
+            SELECT 'progress', 'users', -count(*) FROM old_rows
+            HAVING count(*) > 0;
+    END IF;
+    PERFORM defer_commit();
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+''')
+        c.execute('''
+CREATE OR REPLACE FUNCTION apply_stats_delta(tx bigint) RETURNS void AS $$
+DECLARE
+    d record;
+BEGIN
+    INSERT INTO language_stats
+        SELECT key, sum(n) FROM stats_delta
+        WHERE txid = tx AND stat = 'language'
+        GROUP BY key HAVING sum(n) <> 0 ORDER BY key
+        ON CONFLICT (language)
+        DO UPDATE SET repos = language_stats.repos + EXCLUDED.repos;
+    INSERT INTO user_stats
+        SELECT key::bigint, sum(n) FROM stats_delta
+        WHERE txid = tx AND stat = 'user'
+        GROUP BY key::bigint HAVING sum(n) <> 0 ORDER BY 1
+        ON CONFLICT (user_id)
+        DO UPDATE SET repos = user_stats.repos + EXCLUDED.repos;
+    FOR d IN SELECT key, sum(n) AS n FROM stats_delta
+             WHERE txid = tx AND stat = 'progress'
+             GROUP BY key HAVING sum(n) <> 0 ORDER BY key LOOP
+        UPDATE progress_stats SET value = value + d.n WHERE name = d.key;
+    END LOOP;
+    DELETE FROM stats_delta WHERE txid = tx;
+END
+$$ LANGUAGE plpgsql
+''')
+        # triggers of earlier versions
+        c.execute('DROP TRIGGER IF EXISTS repo_stats ON repo')
+        c.execute('DROP TRIGGER IF EXISTS user_stats ON "user"')
+        create_statement_triggers(c, 'repo', 'stats',
+                                  ('insert', 'update', 'delete'),
+                                  'repo_stats()')
+        create_statement_triggers(c, 'user', 'stats',
+                                  ('insert', 'delete'), 'user_stats()')
+
+        if not exists:
+            self._rebuild_stats(c)
+
+    def create_changes(self, c):
+        """ Create change log, filled by triggers. There is a single entry
+            per object, which gets a new sequence number on every write.
+
+            A sequence number taken while writing could be committed after
+            a greater one, and a consumer which already moved past it would
+            miss the change. So changes are written with the id of their
+            transaction and a provisional number, and get their final
+            number at commit, in commit order, by the stamp_changes
+            function.
+        """
+        c.execute("SELECT to_regclass('change')")
+        exists = c.fetchone()[0] is not None
+
+        c.execute('''
+CREATE TABLE IF NOT EXISTS change (
+    seq             bigserial   primary key,
+    kind            text        not null,
+    obj_id          bigint      not null,
+    deleted         boolean     not null default false
+)
+''')
+        # databases created before changes were stamped at commit
+        c.execute('ALTER TABLE change ADD COLUMN IF NOT EXISTS '
+                  'txid bigint')
+        c.execute('''
+CREATE UNIQUE INDEX IF NOT EXISTS change_obj ON change (kind, obj_id)
+''')
+        c.execute('''
+CREATE INDEX IF NOT EXISTS change_txid ON change (txid)
+    WHERE txid IS NOT NULL
+''')
+        c.execute('''
+CREATE OR REPLACE FUNCTION record_change() RETURNS trigger AS $$
+BEGIN
+    -- ordered, so that writers of the same objects lock them in the same
+    -- order
+    IF TG_OP = 'DELETE' THEN
+        INSERT INTO change (kind, obj_id, deleted, txid)
+            SELECT TG_ARGV[0], id, true, txid_current() FROM old_rows
+            ORDER BY id
+            ON CONFLICT (kind, obj_id)
+            DO UPDATE SET seq = DEFAULT, deleted = EXCLUDED.deleted,
+                          txid = EXCLUDED.txid;
+    ELSE
+        INSERT INTO change (kind, obj_id, deleted, txid)
+            SELECT TG_ARGV[0], id, false, txid_current() FROM new_rows
+            ORDER BY id
+            ON CONFLICT (kind, obj_id)
+            DO UPDATE SET seq = DEFAULT, deleted = EXCLUDED.deleted,
+                          txid = EXCLUDED.txid;
+    END IF;
+    PERFORM defer_commit();
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+''')
+        c.execute('''
+CREATE OR REPLACE FUNCTION stamp_changes(tx bigint) RETURNS void AS $$
+BEGIN
+    -- held until the transaction ends, so the next transaction only takes
+    -- numbers once these changes are visible
+    PERFORM pg_advisory_xact_lock(hashtext('change'));
+    UPDATE change c
+        SET seq = nextval(pg_get_serial_sequence('change', 'seq')),
+            txid = NULL
+        FROM (SELECT seq FROM change WHERE txid = tx ORDER BY seq) p
+        WHERE c.seq = p.seq;
+END
+$$ LANGUAGE plpgsql
+''')
+        for table in ('user', 'repo'):
+            # row triggers of earlier versions
+            c.execute('DROP TRIGGER IF EXISTS {0}_change ON "{0}"'
+                      .format(table))
+            create_statement_triggers(
+                c, table, 'change', ('insert', 'update', 'delete'),
+                "record_change('{}')".format(table))
+
+        if not exists:
+            c.execute("INSERT INTO change (kind, obj_id) "
+                      "SELECT 'user', id FROM \"user\" ORDER BY id")
+            c.execute("INSERT INTO change (kind, obj_id) "
+                      "SELECT 'repo', id FROM repo ORDER BY id")
+
+    def create_commit_hook(self, c):
+        """ Create a deferred trigger, which runs once when a transaction
+            which wrote users or repositories commits, to apply its stats
+            deltas and stamp its changes.
+
+            Stats are applied first, so that their row locks are always
+            taken before the change lock, and writers can't deadlock.
+        """
+        c.execute('''
+CREATE TABLE IF NOT EXISTS pending_commit (
+    txid            bigint      primary key
+)
+''')
+        c.execute('''
+CREATE OR REPLACE FUNCTION defer_commit() RETURNS void AS $$
+BEGIN
+    INSERT INTO pending_commit VALUES (txid_current()) ON CONFLICT DO NOTHING;
+END
+$$ LANGUAGE plpgsql
+''')
+        c.execute('''
+CREATE OR REPLACE FUNCTION on_commit() RETURNS trigger AS $$
+BEGIN
+    PERFORM apply_stats_delta(NEW.txid);
+    PERFORM stamp_changes(NEW.txid);
+    DELETE FROM pending_commit WHERE txid = NEW.txid;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+''')
+        c.execute('DROP TRIGGER IF EXISTS on_commit ON pending_commit')
+        c.execute('''
+CREATE CONSTRAINT TRIGGER on_commit AFTER INSERT ON pending_commit
+    DEFERRABLE INITIALLY DEFERRED FOR EACH ROW EXECUTE PROCEDURE on_commit()
+''')
+
+    def rebuild_stats(self):
+        """ Recompute aggregate tables from scratch
+        """
+        with self.cursor() as c:
+            self._rebuild_stats(c)
+
+    def _rebuild_stats(self, c):
+        c.execute('TRUNCATE language_stats, user_stats, progress_stats, '
+                  'stats_delta')
+        c.execute('''
+INSERT INTO language_stats
+    SELECT coalesce(language, ''), count(*) FROM repo
+    GROUP BY coalesce(language, '')
+''')
+        c.execute('''
+INSERT INTO user_stats SELECT user_id, count(*) FROM repo GROUP BY user_id
+''')
+        c.execute('''
+INSERT INTO progress_stats
+    SELECT 'users', count(*) FROM "user"
+    UNION ALL SELECT 'repos', count(*) FROM repo
+''')
+
+    def _put_users(self, rows: List[tuple]) -> int:
+        with self.cursor() as c:
+            staging = self._stage(c, User, 'user', rows)
+            # logins are unique, but may be taken over by another account
+            c.execute('DELETE FROM "user" u USING {} s '
+                      'WHERE u.login = s.login AND u.id <> s.id'
+                      .format(staging))
+            return self._merge(c, User, 'user', staging)
+
+    def _put_repos(self, rows: List[tuple]) -> int:
+        with self.cursor() as c:
+            staging = self._stage(c, Repo, 'repo', rows)
+            return self._merge(c, Repo, 'repo', staging)
+
+    def _stage(self, c, model, table: str, rows: List[tuple]) -> str:
+        """ Load rows into a temporary staging table and return its name.
+            Rows are deduplicated by id, the last one wins.
+        """
+        rows = add_row_hashes({row[0]: row for row in rows}.values())
+        staging = '{}_staging'.format(table)
+        fields = model._fields + ('hash',)
+        columns = ', '.join(fields)
+        c.execute('CREATE TEMP TABLE IF NOT EXISTS {} '
+                  '(LIKE "{}" INCLUDING DEFAULTS)'.format(staging, table))
+        c.execute('TRUNCATE {}'.format(staging))
+
+        if len(rows) < self.copy_threshold:
+            c.executemany('INSERT INTO {} ({}) VALUES ({})'.format(
+                staging, columns, ', '.join(['%s'] * len(fields))),
+                rows)
+        else:
+            buf = io.StringIO()
+            for row in rows:
+                buf.write('\t'.join(copy_value(v) for v in row))
+                buf.write('\n')
+            buf.seek(0)
+            c.copy_expert('COPY {} ({}) FROM STDIN'.format(staging, columns),
+                          buf)
+        return staging
+
+    def _merge(self, c, model, table: str, staging: str) -> int:
+        """ Upsert rows from the staging table into table, skipping rows
+            whose content hash did not change, and return number of rows
+            written
+        """
+        columns = ', '.join(model._fields + ('hash',))
+        updates = ', '.join('{0} = EXCLUDED.{0}'.format(name)
+                            for name in model._fields + ('hash',)
+                            if name != 'id')
+        c.execute('INSERT INTO "{0}" ({1}) SELECT {1} FROM {2} '
+                  'ON CONFLICT (id) DO UPDATE SET {3} '
+                  'WHERE "{0}".hash IS DISTINCT FROM EXCLUDED.hash'.format(
+                      table, columns, staging, updates))
+        return c.rowcount
+
+    def _fetchall(self, raw: str, values: list) -> List[tuple]:
+        with self.cursor() as c:
+            c.execute(raw, values)
+            return c.fetchall()
+
+    def _build_limit_expr(self, offset: int = None, limit: int = None) -> str:
+        """ Returns LIMIT expr based on offset and limit
+        """
+        if limit is None:
+            return ''
+        else:
+            if offset is None:
+                offset = 0
+            return ' LIMIT {} OFFSET {}'.format(limit, offset)
+
+
+def create_statement_triggers(c, table: str, name: str, events: tuple,
+                              procedure: str):
+    """ Create AFTER ... FOR EACH STATEMENT triggers <table>_<name>_<event>
+        calling procedure, with the new_rows and old_rows transition tables
+    """
+    tables = {
+        'insert': 'NEW TABLE AS new_rows',
+        'update': 'OLD TABLE AS old_rows NEW TABLE AS new_rows',
+        'delete': 'OLD TABLE AS old_rows',
+    }
+    for event in events:
+        c.execute('DROP TRIGGER IF EXISTS {0}_{1}_{2} ON "{0}"'.format(
+            table, name, event))
+        c.execute('''
+CREATE TRIGGER {0}_{1}_{2} AFTER {2} ON "{0}" REFERENCING {3}
+    FOR EACH STATEMENT EXECUTE PROCEDURE {4}
+'''.format(table, name, event, tables[event], procedure))
+
+
+def get_schema_version(c) -> int:
+    """ Returns the version of the schema, 0 if it predates versions
+    """
+    c.execute("SELECT to_regclass('schema_version')")
+    if c.fetchone()[0] is None:
+        return 0
+    c.execute('SELECT max(version) FROM schema_version')
+    return c.fetchone()[0] or 0
+
+
+def copy_value(value) -> str:
+    """ Returns value encoded for COPY text format
+    """
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\')
+                      .replace('\t', '\\t')
+                      .replace('\n', '\\n')
+                      .replace('\r', '\\r'))
@@ -0,0 +1,286 @@
+from functools import lru_cache
+from typing import FrozenSet, Iterable, Tuple
+
+import sys
+
+
+class Q:
+    """ Q function allows building basic queries using a pythonic approach.
+
+        Comparisons return new Q objects, which can be combined with `&` and
+        `|`, eg. ``(Q('id') > 10) & Q('language').in_(['ruby', 'python'])``
+    """
+    EQ = '='
+    NE = '!='
+    LT = '<'
+    LE = '<='
+    GT = '>'
+    GE = '>='
+    IN = 'IN'
+    PREFIX = 'PREFIX'
+    CONTAINS = 'CONTAINS'
+    ISNULL = 'ISNULL'
+
+    def __init__(self, name, op=None, value=None):
+        self.name = name
+        self.op = op
+        self.value = value
+
+    def __eq__(self, value):
+        if value is None:
+            return self.is_null()
+        return Q(self.name, self.EQ, value)
+
+    def __ne__(self, value):
+        if value is None:
+            return self.is_null(False)
+        return Q(self.name, self.NE, value)
+
+    def __gt__(self, value):
+        return Q(self.name, self.GT, value)
+
+    def __ge__(self, value):
+        return Q(self.name, self.GE, value)
+
+    def __lt__(self, value):
+        return Q(self.name, self.LT, value)
+
+    def __le__(self, value):
+        return Q(self.name, self.LE, value)
+
+    def in_(self, values: Iterable):
+        return Q(self.name, self.IN, tuple(values))
+
+    def startswith(self, prefix: str):
+        return Q(self.name, self.PREFIX, prefix)
+
+    def contains(self, text: str):
+        return Q(self.name, self.CONTAINS, text)
+
+    def is_null(self, value: bool = True):
+        return Q(self.name, self.ISNULL, value)
+
+    def __and__(self, other):
+        return QGroup(QGroup.AND, [self, other])
+
+    def __or__(self, other):
+        return QGroup(QGroup.OR, [self, other])
+
+    def __repr__(self):
+        return 'Q({!r}, {!r}, {!r})'.format(self.name, self.op, self.value)
+
+
+class QGroup:
+    """ AND/OR composition of Q objects and other groups
+    """
+    AND = 'AND'
+    OR = 'OR'
+
+    def __init__(self, connector: str, children: list):
+        self.connector = connector
+        self.children = []
+        for child in children:
+            if isinstance(child, QGroup) and child.connector == connector:
+                self.children.extend(child.children)
+            else:
+                self.children.append(child)
+
+    def __and__(self, other):
+        return QGroup(self.AND, [self, other])
+
+    def __or__(self, other):
+        return QGroup(self.OR, [self, other])
+
+    def __repr__(self):
+        return 'QGroup({!r}, {!r})'.format(self.connector, self.children)
+
+
+def compile_lookup(lookup: Iterable, *,
+                   columns: FrozenSet[str] = None,
+                   placeholder: str = '?',
+                   like_operator: str = 'like',
+                   collation: str = None) -> Tuple[str, list]:
+    """ Returns WHERE clause and VALUES for the given lookup. The lookup is a
+        list of Q objects, groups and dicts, which are joined with AND. In
+        dicts, strings match anywhere in the column and other values must be
+        equal.
+
+        The SQL is compiled once per query shape, that is the lookup without
+        its values, and reused afterwards.
+
+        :param columns: if given, only these columns can be queried
+        :param collation: collation of prefix ranges, which must order
+                          strings by code point, eg. "C" in PostgreSQL
+    """
+    lookup = clean_lookup(lookup)
+    shape = get_lookup_shape(lookup)
+    if not shape:
+        return ('', [])
+
+    where_clause = compile_shape(shape, columns, placeholder, like_operator,
+                                 collation)
+    return (where_clause, get_lookup_values(lookup))
+
+
+def clean_lookup(lookup: Iterable) -> list:
+    """ Returns lookup without empty dicts, which do not filter anything
+    """
+    return [clause for clause in lookup
+            if not isinstance(clause, dict) or clause]
+
+
+def get_lookup_shape(lookup: Iterable) -> tuple:
+    """ Returns a hashable description of lookup without its values
+    """
+    return tuple(get_shape(clause) for clause in lookup)
+
+
+def get_lookup_values(lookup: Iterable) -> list:
+    """ Returns values of lookup, in the order of its shape
+    """
+    values = []
+    for clause in lookup:
+        collect_values(clause, values)
+    return values
+
+
+def get_shape(clause) -> tuple:
+    """ Returns a hashable description of clause without its values
+    """
+    if isinstance(clause, Q):
+        if clause.op == Q.IN:
+            return (Q, clause.name, clause.op, len(clause.value))
+        elif clause.op == Q.PREFIX:
+            return (Q, clause.name, clause.op, get_prefix_shape(clause.value))
+        elif clause.op == Q.ISNULL:
+            return (Q, clause.name, clause.op, bool(clause.value))
+        return (Q, clause.name, clause.op, None)
+    elif isinstance(clause, QGroup):
+        return (QGroup, clause.connector,
+                tuple(get_shape(child) for child in clause.children))
+    elif isinstance(clause, dict):
+        return (dict, tuple(
+            (key, Q.CONTAINS if isinstance(value, str) else Q.EQ, None)
+            for key, value in clause.items()))
+    else:
+        raise NotImplementedError  # pragma: nocover
+
+
+def collect_values(clause, values: list):
+    """ Append values of clause to values, in the order of its shape
+    """
+    if isinstance(clause, Q):
+        if clause.op == Q.IN:
+            values.extend(clause.value)
+        elif clause.op == Q.PREFIX:
+            if clause.value:
+                values.append(clause.value)
+                upper_bound = get_prefix_upper_bound(clause.value)
+                if upper_bound is not None:
+                    values.append(upper_bound)
+        elif clause.op == Q.CONTAINS:
+            values.append(escape_contains(clause.value))
+        elif clause.op != Q.ISNULL:
+            values.append(clause.value)
+    elif isinstance(clause, QGroup):
+        for child in clause.children:
+            collect_values(child, values)
+    else:
+        for value in clause.values():
+            if isinstance(value, str):
+                values.append(escape_contains(value))
+            else:
+                values.append(value)
+
+
+@lru_cache(maxsize=256)
+def compile_shape(shape: tuple,
+                  columns: FrozenSet[str],
+                  placeholder: str,
+                  like_operator: str,
+                  collation: str = None) -> str:
+    """ Returns WHERE clause for the given query shape
+    """
+    def check(name):
+        if not name.isidentifier() or (columns is not None and
+                                       name not in columns):
+            raise ValueError('unknown column: {}'.format(name))
+        return name
+
+    def compile_q(name, op, arg):
+        name = check(name)
+        if op in (Q.EQ, Q.NE, Q.LT, Q.LE, Q.GT, Q.GE):
+            return '{} {} {}'.format(name, op, placeholder)
+        elif op == Q.IN:
+            if not arg:
+                return '1 = 0'
+            return '{} IN ({})'.format(name, ', '.join([placeholder] * arg))
+        elif op == Q.PREFIX:
+            # a range instead of LIKE, so that indexes can be used
+            if arg is None:
+                return '{} IS NOT NULL'.format(name)
+            if collation is not None:
+                name = '{} COLLATE "{}"'.format(name, collation)
+                value = '{} COLLATE "{}"'.format(placeholder, collation)
+            else:
+                value = placeholder
+            if arg == PREFIX_UNBOUNDED:
+                return '{} >= {}'.format(name, value)
+            return '({0} >= {1} AND {0} < {1})'.format(name, value)
+        elif op == Q.CONTAINS:
+            return '{} {} {}'.format(name, like_operator, placeholder)
+        elif op == Q.ISNULL:
+            return '{} IS {}NULL'.format(name, '' if arg else 'NOT ')
+        else:
+            raise NotImplementedError  # pragma: nocover
+
+    def compile_clause(clause, nested):
+        kind, *args = clause
+        if kind is QGroup:
+            connector, children = args
+            sql = ' {} '.format(connector).join(
+                compile_clause(child, True) for child in children)
+            return '({})'.format(sql) if nested else sql
+        elif kind is dict:
+            sql = ' AND '.join(compile_q(*item) for item in args[0])
+            return '({})'.format(sql) if nested and len(args[0]) > 1 else sql
+        else:
+            return compile_q(*args)
+
+    nested = len(shape) > 1
+    where = [compile_clause(clause, nested) for clause in shape]
+    return ' WHERE {}'.format(' AND '.join(where))
+
+
+PREFIX_RANGE = 'range'
+PREFIX_UNBOUNDED = 'unbounded'
+
+
+def get_prefix_shape(prefix: str) -> str:
+    """ Returns how a prefix is matched: None for any value, a range, or
+        only a lower bound if it has no upper bound
+    """
+    if not prefix:
+        return None
+    if get_prefix_upper_bound(prefix) is None:
+        return PREFIX_UNBOUNDED
+    return PREFIX_RANGE
+
+
+def get_prefix_upper_bound(prefix: str) -> str:
+    """ Returns the smallest string greater than every string starting with
+        prefix, in code point order, or None if there isn't one, ie. the
+        prefix only has U+10FFFF characters
+    """
+    prefix = prefix.rstrip(chr(sys.maxunicode))
+    if not prefix:
+        return None
+    code = ord(prefix[-1]) + 1
+    if 0xD800 <= code <= 0xDFFF:
+        # surrogates can't be encoded
+        code = 0xE000
+    return prefix[:-1] + chr(code)
+
+
+def escape_contains(value: str) -> str:
+    return '%{}%'.format(value.replace('%', '%%'))
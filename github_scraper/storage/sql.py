@@ -0,0 +1,243 @@
+from . import Storage
+from .cache import UserCache
+from .query import (Q, clean_lookup, compile_lookup, get_lookup_shape,
+                    get_lookup_values)
+from ..models import (Batch, Change, LanguageStats, User, UserStats,
+                      Repo)
+
+from collections import OrderedDict
+from threading import Lock
+
+import hashlib
+from typing import FrozenSet, Iterable, List, Tuple, Union
+
+
+class SQLStorage(Storage):
+    """ Base class for SQL storages. Query building is shared between
+        backends, which only have to implement the database access methods.
+
+        Built queries are cached by their shape (table, lookup without values,
+        order, offset and limit), so hot lookups skip query building and hit
+        the same prepared statement. Cache usage is kept in
+        `query_cache_stats`. Users fetched by id or login are also kept in
+        a :class:`cache.UserCache`.
+
+    :param query_cache_size: number of query shapes to cache, 0 disables it
+    :param user_cache_size: number of users to cache, 0 disables it
+    """
+    placeholder = '?'
+    like_operator = 'like'
+    # prefix ranges need code point order, SQLite's default
+    prefix_collation = None
+
+    def __init__(self, *,
+                 query_cache_size: int = 256,
+                 user_cache_size: int = 1024):
+        self.query_cache = OrderedDict()
+        self.query_cache_size = query_cache_size
+        self.query_cache_stats = {'hits': 0, 'misses': 0}
+        # storages may be shared between threads, eg. SnapshotStorage
+        self.query_cache_lock = Lock()
+        self.user_cache = UserCache(user_cache_size)
+
+    def put_user(self, obj: User) -> bool:
+        return self.put_users([obj]) > 0
+
+    def put_users(self, objs: Union[Batch, Iterable[User]]) -> int:
+        rows = get_rows(objs)
+        written = self._put_users(rows)
+        for row in rows:
+            self.user_cache.discard(row[0], row[1])
+        return written
+
+    def _put_users(self, rows: List[tuple]) -> int:
+        """ Upsert rows, skipping unchanged ones, and return number of rows
+            written
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def get_user(self, *lookup) -> User:
+        key = self.user_cache.get_key(lookup)
+        if key is not None:
+            user = self.user_cache.get(*key)
+            if user is not None:
+                return user
+        user = self._get(self.list_users, lookup)
+        if user is not None and key is not None:
+            self._cache_user(user)
+        return user
+
+    def _cache_user(self, user: User):
+        """ Put a user read by get_user in the user cache
+        """
+        self.user_cache.put(user)
+
+    def get_last_user(self) -> User:
+        return self._get(self.list_users, {}, order_by='id DESC')
+
+    def list_users(self,
+                   *lookup,
+                   order_by: str = None,
+                   offset: int = None,
+                   limit: int = None,
+                   batch: bool = False) -> Union[Batch, List[User]]:
+        return self._list(User, 'user', lookup, order_by=order_by,
+                          offset=offset, limit=limit, batch=batch)
+
+    def put_repo(self, obj: Repo) -> bool:
+        return self.put_repos([obj]) > 0
+
+    def put_repos(self, objs: Union[Batch, Iterable[Repo]]) -> int:
+        return self._put_repos(get_rows(objs))
+
+    def _put_repos(self, rows: List[tuple]) -> int:
+        """ Upsert rows, skipping unchanged ones, and return number of rows
+            written
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def get_repo(self, *lookup) -> Repo:
+        return self._get(self.list_repos, lookup)
+
+    def list_repos(self,
+                   *lookup,
+                   order_by: str = None,
+                   offset: int = None,
+                   limit: int = None,
+                   batch: bool = False) -> Union[Batch, List[Repo]]:
+        return self._list(Repo, 'repo', lookup, order_by=order_by,
+                          offset=offset, limit=limit, batch=batch)
+
+    def list_language_stats(self, limit: int = None) -> List[LanguageStats]:
+        raw = ('SELECT language, repos FROM language_stats WHERE repos > 0 '
+               'ORDER BY repos DESC, language{}'.format(
+                   self._build_limit_expr(None, limit)))
+        return [LanguageStats(language or None, repos)
+                for language, repos in self._fetchall(raw, [])]
+
+    def list_top_users(self, limit: int = None) -> List[UserStats]:
+        raw = ('SELECT s.user_id, u.login, s.repos FROM user_stats s '
+               'LEFT JOIN "user" u ON u.id = s.user_id WHERE s.repos > 0 '
+               'ORDER BY s.repos DESC, s.user_id DESC{}'.format(
+                   self._build_limit_expr(None, limit)))
+        return [UserStats(*row) for row in self._fetchall(raw, [])]
+
+    def get_progress(self) -> dict:
+        progress = dict(self._fetchall('SELECT name, value FROM '
+                                       'progress_stats', []))
+        last_user = self.get_last_user()
+        progress['last_user_id'] = last_user.id if last_user else None
+        return progress
+
+    def list_changes(self, since: int = 0, limit: int = None) -> List[Change]:
+        raw = ('SELECT seq, kind, obj_id, deleted FROM change WHERE seq > {} '
+               'ORDER BY seq{}'.format(self.placeholder,
+                                       self._build_limit_expr(None, limit)))
+        changes = self._fetchall(raw, [since])
+
+        objs = {}
+        for kind, list_method in (('user', self.list_users),
+                                  ('repo', self.list_repos)):
+            ids = [obj_id for _, k, obj_id, deleted in changes
+                   if k == kind and not deleted]
+            if ids:
+                for obj in list_method(Q('id').in_(ids)):
+                    objs[kind, obj.id] = obj
+
+        return [Change(seq, kind, obj_id, bool(deleted),
+                       objs.get((kind, obj_id)))
+                for seq, kind, obj_id, deleted in changes]
+
+    def _fetchall(self, raw: str, values: list) -> List[tuple]:
+        """ Execute query and return all rows
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def _get(self, list_method: callable, lookup, *, order_by=None):
+        """ Return first result of list_method
+        """
+        result = list_method(order_by=order_by, limit=1, *lookup)
+        return result[0] if result else None
+
+    def _list(self, model, table: str, lookup, *,
+              order_by: str = None,
+              offset: int = None,
+              limit: int = None,
+              batch: bool = False):
+        """ Returns list of `model` objects according filtered by lookup, or
+            a :class:`models.Batch` of rows if batch is true
+        """
+        if order_by is None:
+            order_by = 'id ASC'
+
+        lookup = clean_lookup(lookup)
+        key = (table, get_lookup_shape(lookup), order_by, offset, limit)
+        with self.query_cache_lock:
+            raw = self.query_cache.get(key)
+            if raw is None:
+                self.query_cache_stats['misses'] += 1
+            else:
+                self.query_cache_stats['hits'] += 1
+                self.query_cache.move_to_end(key)
+
+        if raw is None:
+            where_clause, values = self._build_where_clause(
+                lookup, frozenset(model._fields))
+            limit_expr = self._build_limit_expr(offset, limit)
+            raw = 'SELECT {} FROM "{}"{} ORDER BY {}{}'.format(
+                ', '.join(model._fields), table, where_clause, order_by,
+                limit_expr)
+            if self.query_cache_size > 0:
+                with self.query_cache_lock:
+                    self.query_cache[key] = raw
+                    if len(self.query_cache) > self.query_cache_size:
+                        self.query_cache.popitem(last=False)
+        else:
+            values = get_lookup_values(lookup)
+
+        rows = self._fetchall(raw, values)
+        if batch:
+            return Batch(model, rows)
+        return [model(*row) for row in rows]
+
+    def _build_limit_expr(self, offset: int = None, limit: int = None) -> str:
+        """ Returns LIMIT expr based on offset and limit
+        """
+        if limit is None:
+            return ''
+        else:
+            if offset is None:
+                offset = 0
+            return ' LIMIT {},{}'.format(offset, limit)
+
+    def _build_where_clause(self,
+                            lookup: list,
+                            columns: FrozenSet[str] = None,
+                            ) -> Tuple[str, list]:
+        """ Returns WHERE clause and VALUES for the given lookup
+        """
+        return compile_lookup(lookup, columns=columns,
+                              placeholder=self.placeholder,
+                              like_operator=self.like_operator,
+                              collation=self.prefix_collation)
+
+
+def get_rows(objs: Union[Batch, Iterable[tuple]]) -> List[tuple]:
+    """ Returns rows of a batch or a list of model objects
+    """
+    if isinstance(objs, Batch):
+        return objs.rows
+    return list(objs)
+
+
+def get_row_hash(row: tuple) -> int:
+    """ Returns a 64 bits hash of the row content
+    """
+    digest = hashlib.blake2b(repr(tuple(row)).encode('utf-8'), digest_size=8)
+    return int.from_bytes(digest.digest(), 'big', signed=True)
+
+
+def add_row_hashes(rows: List[tuple]) -> List[tuple]:
+    """ Returns rows with their content hash appended
+    """
+    return [tuple(row) + (get_row_hash(row),) for row in rows]
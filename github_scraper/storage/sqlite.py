@@ -1,19 +1,59 @@
-from . import Storage, Q
+from . import Q  # noqa
+from .sql import SQLStorage, add_row_hashes
 from ..models import User, Repo
 
-from typing import List, Tuple
+from typing import List
 
+import os
+import pathlib
+import shutil
 import sqlite3
+import tempfile
+import threading
+import time
 
 
-class SQLiteStorage(Storage):
+# INSERT ... ON CONFLICT DO UPDATE, used by upserts and stats triggers
+MIN_SQLITE_VERSION = (3, 24, 0)
+
+CHANGE_TRIGGER = '''
+CREATE TRIGGER {table}_change_{name} AFTER {event} ON {table}
+BEGIN
+    DELETE FROM change WHERE kind = '{table}' AND obj_id = {row}.id;
+    INSERT INTO change (kind, obj_id, deleted)
+        VALUES ('{table}', {row}.id, {deleted});
+END
+'''
+
+
+class SQLiteStorage(SQLStorage):
     """ SQLite Storage
 
     :param database: database path
+    :param cached_statements: size of sqlite3's prepared statement cache
+    :param query_cache_size: number of query shapes to cache
+    :param user_cache_size: number of users to cache
     """
-    def __init__(self, database: str):
-        self.conn = sqlite3.connect(database)
+    # bump when the schema changes, so that existing databases are upgraded
+    # the next time they're opened, see create_tables
+    schema_version = 1
+
+    def __init__(self, database: str, *,
+                 cached_statements: int = 256,
+                 query_cache_size: int = 256,
+                 user_cache_size: int = 1024):
+        super(SQLiteStorage, self).__init__(query_cache_size=query_cache_size,
+                                            user_cache_size=user_cache_size)
+        check_sqlite_version()
+        self.database = database
+        self.conn = sqlite3.connect(database,
+                                    cached_statements=cached_statements)
+        # makes INSERT OR REPLACE fire delete triggers, see create_stats
+        self.conn.execute('PRAGMA recursive_triggers = ON')
+        # readers, like the API or snapshots, don't block the scraper
+        self.conn.execute('PRAGMA journal_mode = WAL')
         self.closed = False
+        self.publish_lock = threading.Lock()
         self.create_tables()
 
     def close(self):
@@ -27,12 +67,20 @@ class SQLiteStorage(Storage):
         self.close()
 
     def create_tables(self):
+        """ Create the schema, or upgrade it if it's older than
+            schema_version, which is kept in SQLite's user_version. Opening
+            a current database doesn't write to it.
+        """
         c = self.conn.cursor()
+        c.execute('PRAGMA user_version')
+        if c.fetchone()[0] >= self.schema_version:
+            return
         c.execute('''
 CREATE TABLE IF NOT EXISTS user (
     id          integer     primary key,
     login       text,
-    user_url    text
+    user_url    text,
+    hash        integer
 )
 ''')
         c.execute('''
@@ -46,112 +94,380 @@ CREATE TABLE IF NOT EXISTS repo (
     name            text,
     description     text,
     language        text,
+    hash            integer,
     FOREIGN KEY (user_id) REFERENCES user (id)
 )
 ''')
+        c.execute('''
+CREATE INDEX IF NOT EXISTS repo_user_id ON repo (user_id)
+''')
+        c.execute('''
+CREATE INDEX IF NOT EXISTS repo_language ON repo (language)
+''')
+        for table in ('user', 'repo'):
+            # databases created before content hashes were added
+            c.execute('PRAGMA table_info({})'.format(table))
+            if 'hash' not in [row[1] for row in c.fetchall()]:
+                c.execute('ALTER TABLE {} ADD COLUMN hash integer'
+                          .format(table))
+        self.create_stats()
+        self.create_changes()
+        c.execute('PRAGMA user_version = {:d}'.format(self.schema_version))
 
-    def put_user(self, obj: User):
+    def create_stats(self):
+        """ Create aggregate tables, kept up to date by triggers
+        """
         c = self.conn.cursor()
-        c.execute('INSERT OR REPLACE INTO user VALUES (?, ?, ?)', obj)
+        c.execute("SELECT 1 FROM sqlite_master WHERE name = 'progress_stats'")
+        exists = c.fetchone() is not None
+
+        c.execute('''
+CREATE TABLE IF NOT EXISTS language_stats (
+    language        text        primary key,
+    repos           integer     not null
+)
+''')
+        c.execute('''
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id         integer     primary key,
+    repos           integer     not null
+)
+''')
+        c.execute('''
+CREATE INDEX IF NOT EXISTS user_stats_repos ON user_stats (repos)
+''')
+        c.execute('''
+CREATE TABLE IF NOT EXISTS progress_stats (
+    name            text        primary key,
+    value           integer     not null
+)
+''')
+        c.execute('''
+CREATE TRIGGER IF NOT EXISTS repo_stats_insert AFTER INSERT ON repo
+BEGIN
+    INSERT INTO language_stats VALUES (coalesce(NEW.language, ''), 1)
+        ON CONFLICT (language) DO UPDATE SET repos = repos + 1;
+    INSERT INTO user_stats VALUES (NEW.user_id, 1)
+        ON CONFLICT (user_id) DO UPDATE SET repos = repos + 1;
+    UPDATE progress_stats SET value = value + 1 WHERE name = 'repos';
+END
+''')
+        c.execute('''
+CREATE TRIGGER IF NOT EXISTS repo_stats_delete AFTER DELETE ON repo
+BEGIN
+    UPDATE language_stats SET repos = repos - 1
+        WHERE language = coalesce(OLD.language, '');
+    UPDATE user_stats SET repos = repos - 1 WHERE user_id = OLD.user_id;
+    UPDATE progress_stats SET value = value - 1 WHERE name = 'repos';
+END
+''')
+        c.execute('''
+CREATE TRIGGER IF NOT EXISTS repo_stats_update
+AFTER UPDATE OF user_id, language ON repo
+BEGIN
+    UPDATE language_stats SET repos = repos - 1
+        WHERE language = coalesce(OLD.language, '');
+    UPDATE user_stats SET repos = repos - 1 WHERE user_id = OLD.user_id;
+    INSERT INTO language_stats VALUES (coalesce(NEW.language, ''), 1)
+        ON CONFLICT (language) DO UPDATE SET repos = repos + 1;
+    INSERT INTO user_stats VALUES (NEW.user_id, 1)
+        ON CONFLICT (user_id) DO UPDATE SET repos = repos + 1;
+END
+''')
+        c.execute('''
+CREATE TRIGGER IF NOT EXISTS user_stats_insert AFTER INSERT ON user
+BEGIN
+    UPDATE progress_stats SET value = value + 1 WHERE name = 'users';
+END
+''')
+        c.execute('''
+CREATE TRIGGER IF NOT EXISTS user_stats_delete AFTER DELETE ON user
+BEGIN
+    UPDATE progress_stats SET value = value - 1 WHERE name = 'users';
+END
+''')
         self.conn.commit()
 
-    def get_user(self, *lookup) -> User:
-        return self._get(self.list_users, lookup)
+        if not exists:
+            self.rebuild_stats()
 
-    def get_last_user(self) -> User:
-        return self._get(self.list_users, {}, order_by='id DESC')
+    def create_changes(self):
+        """ Create change log, filled by triggers. There is a single entry
+            per object, which gets a new sequence number on every write.
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT 1 FROM sqlite_master WHERE name = 'change'")
+        exists = c.fetchone() is not None
 
-    def list_users(self,
-                   *lookup,
-                   order_by: str = None,
-                   offset: int = None,
-                   limit: int = None) -> List[Repo]:
-        return self._list(User, 'user', lookup, order_by=order_by,
-                          offset=offset, limit=limit)
+        c.execute('''
+CREATE TABLE IF NOT EXISTS change (
+    seq             integer     primary key autoincrement,
+    kind            text        not null,
+    obj_id          integer     not null,
+    deleted         integer     not null default 0
+)
+''')
+        c.execute('''
+CREATE UNIQUE INDEX IF NOT EXISTS change_obj ON change (kind, obj_id)
+''')
+        for table in ('user', 'repo'):
+            for event, row, deleted in (('INSERT', 'NEW', 0),
+                                        ('UPDATE', 'NEW', 0),
+                                        ('DELETE', 'OLD', 1)):
+                c.execute('DROP TRIGGER IF EXISTS {}_change_{}'.format(
+                    table, event.lower()))
+                c.execute(CHANGE_TRIGGER.format(table=table,
+                                                name=event.lower(),
+                                                event=event,
+                                                row=row,
+                                                deleted=deleted))
 
-    def put_repo(self, obj: Repo):
+        if not exists:
+            c.execute("INSERT INTO change (kind, obj_id) "
+                      "SELECT 'user', id FROM user ORDER BY id")
+            c.execute("INSERT INTO change (kind, obj_id) "
+                      "SELECT 'repo', id FROM repo ORDER BY id")
+        self.conn.commit()
+
+    def rebuild_stats(self):
+        """ Recompute aggregate tables from scratch
+        """
         c = self.conn.cursor()
-        c.execute('INSERT OR REPLACE INTO repo VALUES (?, ?, ?, ?, ?, ?)', obj)
+        c.execute('DELETE FROM language_stats')
+        c.execute('DELETE FROM user_stats')
+        c.execute('DELETE FROM progress_stats')
+        c.execute('''
+INSERT INTO language_stats
+    SELECT coalesce(language, ''), count(*) FROM repo
+    GROUP BY coalesce(language, '')
+''')
+        c.execute('''
+INSERT INTO user_stats SELECT user_id, count(*) FROM repo GROUP BY user_id
+''')
+        c.execute('''
+INSERT INTO progress_stats
+    SELECT 'users', count(*) FROM user
+    UNION ALL SELECT 'repos', count(*) FROM repo
+''')
         self.conn.commit()
 
-    def get_repo(self, *lookup) -> Repo:
-        return self._get(self.list_repos, lookup)
+    def _put_users(self, rows: List[tuple]) -> int:
+        rows = add_row_hashes(rows)
+        c = self.conn.cursor()
+        try:
+            c.executemany(self._build_upsert(User, 'user'), rows)
+        except sqlite3.IntegrityError:
+            # logins are unique, but may be taken over by another account
+            self.conn.rollback()
+            c.executemany('DELETE FROM user WHERE login = ? AND id != ?',
+                          [(row[1], row[0]) for row in rows])
+            c.executemany(self._build_upsert(User, 'user'), rows)
+        self.conn.commit()
+        return c.rowcount
 
-    def list_repos(self,
-                   *lookup,
-                   order_by: str = None,
-                   offset: int = None,
-                   limit: int = None) -> List[Repo]:
-        return self._list(Repo, 'repo', lookup, order_by=order_by,
-                          offset=offset, limit=limit)
+    def _put_repos(self, rows: List[tuple]) -> int:
+        rows = add_row_hashes(rows)
+        c = self.conn.cursor()
+        c.executemany(self._build_upsert(Repo, 'repo'), rows)
+        self.conn.commit()
+        return c.rowcount
 
-    def _get(self, list_method: callable, lookup, *, order_by=None):
-        """ Return first result of list_method
+    def _build_upsert(self, model, table: str) -> str:
+        """ Returns statement inserting a row, or updating it only when its
+            content hash changed
         """
-        result = list_method(order_by=order_by, limit=1, *lookup)
-        return result[0] if result else None
-
-    def _list(self, model, table: str, lookup, *,
-              order_by: str = None,
-              offset: int = None,
-              limit: int = None):
-        """ Returns list of `model` objects according filtered by lookup
+        return (
+            'INSERT INTO {table} ({columns}, hash) VALUES ({values}) '
+            'ON CONFLICT (id) DO UPDATE SET {updates}, hash = excluded.hash '
+            'WHERE {table}.hash IS NOT excluded.hash'.format(
+                table=table,
+                columns=', '.join(model._fields),
+                values=', '.join(['?'] * (len(model._fields) + 1)),
+                updates=', '.join('{0} = excluded.{0}'.format(name)
+                                  for name in model._fields if name != 'id'),
+            ))
+
+    def _fetchall(self, raw: str, values: list) -> List[tuple]:
+        return self.conn.execute(raw, values).fetchall()
+
+    def publish_snapshot(self, path: str):
+        """ Copy the database to path with the SQLite backup API, and then
+            atomically replace the previous snapshot, which readers that
+            already opened it keep reading.
+
+            The copy uses its own connection, so it can run in another
+            thread, and doesn't block writers thanks to WAL. Concurrent calls
+            wait for each other.
         """
-        if order_by is None:
-            order_by = 'id ASC'
+        if self.database == ':memory:':
+            raise ValueError('in-memory databases cannot be published')
+        with self.publish_lock:
+            self._publish_snapshot(path)
 
-        where_clause, values = self._build_where_clause(lookup)
-        limit_expr = self._build_limit_expr(offset, limit)
-        raw = 'SELECT * FROM {}{} ORDER BY {}{}'.format(table, where_clause,
-                                                        order_by, limit_expr)
-        c = self.conn.cursor()
-        c.execute(raw, values)
+    def _publish_snapshot(self, path: str):
+        # unique, so that other processes publishing to path don't write
+        # to, or clean up, the same copy
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=os.path.basename(path) + '.', suffix='.tmp',
+            dir=os.path.dirname(os.path.abspath(path)))
+        os.close(fd)
+        source = sqlite3.connect(get_uri(self.database, 'mode=ro'), uri=True)
+        try:
+            # mkstemp creates the file only readable by its owner
+            shutil.copymode(self.database, tmp_path)
+            target = sqlite3.connect(tmp_path)
+            try:
+                source.backup(target)
+                # snapshots are opened immutable, which doesn't go with WAL
+                target.execute('PRAGMA journal_mode = DELETE')
+            finally:
+                target.close()
+            os.replace(tmp_path, path)
+        except BaseException:
+            # eg. disk full, don't leave partial copies behind
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        finally:
+            source.close()
+
+
+class SnapshotStorage(SQLiteStorage):
+    """ Read-only storage serving a snapshot published with
+        :func:`SQLiteStorage.publish_snapshot`, so that reads never wait for
+        the scraper.
+
+        Snapshots are opened immutable, which skips locking, and memory
+        mapped. Connections are pooled between threads. When a new snapshot
+        replaces the file, which is checked at most every `check_interval`
+        seconds, connections to the previous one are closed once they're
+        released and the user cache is cleared.
+
+    :param path: snapshot path
+    :param check_interval: seconds between checks for a new snapshot
+    :param mmap_size: maximum number of bytes to memory map
+    :param cached_statements: size of sqlite3's prepared statement cache
+    :param query_cache_size: number of query shapes to cache
+    :param user_cache_size: number of users to cache
+    """
+    def __init__(self, path: str, *,
+                 check_interval: float = 1,
+                 mmap_size: int = 1 << 30,
+                 cached_statements: int = 256,
+                 query_cache_size: int = 256,
+                 user_cache_size: int = 1024):
+        SQLStorage.__init__(self, query_cache_size=query_cache_size,
+                            user_cache_size=user_cache_size)
+        self.database = path
+        self.check_interval = check_interval
+        self.mmap_size = mmap_size
+        self.cached_statements = cached_statements
+        self.closed = False
 
-        return [model(*row) for row in c.fetchall()]
+        self.lock = threading.Lock()
+        self.idle = []
+        self.version = None
+        self.generation = 0
+        # generation of the connection each thread last read from
+        self.local = threading.local()
+        self.next_check = 0
+        self.check_snapshot()
 
-    def _build_limit_expr(self, offset: int = None, limit: int = None) -> str:
-        """ Returns LIMIT expr based on offset and limit
+    def get_user(self, *lookup) -> User:
+        # the user cache must not outlive the snapshot it was filled from
+        self._check_snapshot_due()
+        return super(SnapshotStorage, self).get_user(*lookup)
+
+    def check_snapshot(self):
+        """ Look for a new snapshot, which replaced the file
         """
-        if limit is None:
-            return ''
-        else:
-            if offset is None:
-                offset = 0
-            return ' LIMIT {},{}'.format(offset, limit)
-
-    def _build_where_clause(self, lookup: list) -> Tuple[str, list]:
-        """ Returns WHERE clause and VALUES for the given lookup
+        stat = os.stat(self.database)
+        version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        idle = []
+        with self.lock:
+            self.next_check = time.monotonic() + self.check_interval
+            if version != self.version:
+                self.version = version
+                self.generation += 1
+                self.user_cache.clear()
+                idle, self.idle = self.idle, []
+        for _, conn in idle:
+            conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for _, conn in idle:
+            conn.close()
+        self.closed = True
+
+    def _fetchall(self, raw: str, values: list) -> List[tuple]:
+        generation, conn = self._acquire()
+        self.local.generation = generation
+        try:
+            return conn.execute(raw, values).fetchall()
+        finally:
+            self._release(generation, conn)
+
+    def _cache_user(self, user: User):
+        # read from a previous snapshot if another thread found a new one
+        # in the meantime, which already cleared the cache
+        with self.lock:
+            if self.local.generation == self.generation:
+                self.user_cache.put(user)
+
+    def _put_users(self, rows: List[tuple]) -> int:
+        raise sqlite3.OperationalError('snapshots are read-only')
+
+    def _put_repos(self, rows: List[tuple]) -> int:
+        raise sqlite3.OperationalError('snapshots are read-only')
+
+    def _check_snapshot_due(self):
+        if time.monotonic() >= self.next_check:
+            self.check_snapshot()
+
+    def _acquire(self):
+        """ Returns an idle connection to the latest snapshot, or a new one,
+            with its generation
         """
-        if not lookup:
-            return ('', [])
-
-        where = []
-        values = []
-
-        for clause in lookup:
-            if isinstance(clause, Q):
-                if clause.op in ('<', '>'):
-                    where.append('{} {} ?'.format(clause.name, clause.op))
-                    values.append(clause.value)
-                else:
-                    raise NotImplementedError  # pragma: nocover
-            elif isinstance(clause, dict):
-                for key, value in clause.items():
-                    if isinstance(value, str):
-                        where.append('{} like ?'.format(key))
-                        values.append('%{}%'.format(value.replace('%', '%%')))
-                    else:
-                        where.append('{} = ?'.format(key))
-                        values.append(value)
-            else:
-                raise NotImplementedError  # pragma: nocover
-
-        where_clause = ' WHERE {}'.format(' AND '.join(where))
-        return (where_clause, values)
+        self._check_snapshot_due()
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+            generation = self.generation
+        conn = sqlite3.connect(get_uri(self.database, 'immutable=1'),
+                               uri=True,
+                               cached_statements=self.cached_statements,
+                               check_same_thread=False)
+        conn.execute('PRAGMA mmap_size = {:d}'.format(self.mmap_size))
+        return generation, conn
+
+    def _release(self, generation: int, conn: sqlite3.Connection):
+        with self.lock:
+            if generation == self.generation and not self.closed:
+                self.idle.append((generation, conn))
+                return
+        conn.close()
 
 
 class LocMemStorage(SQLiteStorage):
     """ In-memory database, used for testing
     """
-    def __init__(self):
-        super(LocMemStorage, self).__init__(':memory:')
+    def __init__(self, **kwargs):
+        super(LocMemStorage, self).__init__(':memory:', **kwargs)
+
+
+def check_sqlite_version():
+    """ Raise RuntimeError if the SQLite library Python was built with is
+        older than MIN_SQLITE_VERSION
+    """
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        raise RuntimeError('SQLite {} or newer is required, found {}'.format(
+            '.'.join(map(str, MIN_SQLITE_VERSION)), sqlite3.sqlite_version))
+
+
+def get_uri(path: str, query: str) -> str:
+    """ Returns SQLite URI for path, with characters which have a meaning in
+        URIs, like ?, # and %, escaped
+    """
+    return '{}?{}'.format(pathlib.Path(path).resolve().as_uri(), query)
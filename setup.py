@@ -16,8 +16,9 @@ setup(
         'License :: Public Domain',
         'Natural Language :: English',
         'Operating System :: OS Independent',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
     ],
+    python_requires='>=3.7',
     packages=find_packages(exclude=['tests']),
     setup_requires=['pytest-runner'],
     tests_require=[
@@ -33,6 +34,10 @@ setup(
         'Flask==0.12.2',
         'Flask-RESTful==0.3.6',
     ],
+    extras_require={
+        'postgres': ['psycopg2==2.7.4'],
+        'speedups': ['orjson==3.8.3', 'brotli==1.0.9', 'uvloop==0.17.0'],
+    },
     entry_points={
         'console_scripts': [
             'github-scraper=github_scraper.cli:main',
@@ -4,10 +4,17 @@ from flask import Flask
 from github_scraper.storage.sqlite import LocMemStorage
 from github_scraper.models import User, Repo
 from github_scraper.api import get_app
+from github_scraper.api import serializers
 
+import gzip
 import json
 
 
+def post_json(app, url, body):
+    return app.post(url, data=json.dumps(body),
+                    content_type='application/json')
+
+
 class APITest(TestCase):
     def setUp(self):
         self.storage = LocMemStorage()
@@ -50,6 +57,10 @@ class APITest(TestCase):
             'user_url': 'http://github.com/mojombo',
         }
 
+    def test_get_user_exact(self):
+        app = get_app(self.storage).test_client()
+        assert app.get('/users/mojo').status_code == 404
+
     def test_get_user_not_found(self):
         app = get_app(self.storage).test_client()
         assert app.get('/users/unknown').status_code == 404
@@ -74,3 +85,124 @@ class APITest(TestCase):
         assert app.get('/users/mojombo/repos', data=data1).data != b'[]\n'
         assert app.get('/users/mojombo/repos', data=data2).data == b'[]\n'
         assert app.get('/users/mojombo/repos', data=data3).data != b'[]\n'
+
+    def test_list_repos_filter_index(self):
+        self.storage.put_repo(Repo(3, 1, 'http://github.com/mojombo/z', 'z',
+                                   'testing 3', 'go'))
+        self.storage.put_repo(Repo(4, 1, 'http://github.com/mojombo/w', 'w',
+                                   'testing 4', 'c'))
+        app = get_app(self.storage).test_client()
+
+        def ids(query):
+            return [r['id'] for r in json.loads(
+                app.get('/users/mojombo/repos?' + query).data)]
+
+        assert ids('languages=ruby,go') == [1, 3]
+        assert ids('since=1') == [3, 4]
+        assert ids('since=1&languages=c,ruby') == [4]
+
+    def test_compression(self):
+        self.storage.put_repos(
+            Repo(i, 1, 'http://github.com/mojombo/{}'.format(i), str(i),
+                 'testing {}'.format(i), 'ruby') for i in range(3, 100))
+        app = get_app(self.storage).test_client()
+        headers = {'Accept-Encoding': 'gzip'}
+
+        with mock.patch.object(serializers, 'brotli', None):
+            response = app.get('/users/mojombo/repos', headers=headers)
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert len(json.loads(gzip.decompress(response.data))) == 98
+
+        # small responses are not compressed
+        response = app.get('/users/mojombo', headers=headers)
+        assert 'Content-Encoding' not in response.headers
+        assert json.loads(response.data)['login'] == 'mojombo'
+
+    def test_get_encoding(self):
+        with mock.patch.object(serializers, 'brotli', None):
+            assert serializers.get_encoding('br, gzip') == 'gzip'
+            assert serializers.get_encoding('br') is None
+        with mock.patch.object(serializers, 'brotli', object()):
+            assert serializers.get_encoding('gzip, br') == 'br'
+            assert serializers.get_encoding('gzip, br;q=0') == 'gzip'
+        assert serializers.get_encoding('') is None
+        assert serializers.get_encoding('gzip;q=0') is None
+
+    def test_stats(self):
+        app = get_app(self.storage).test_client()
+        assert json.loads(app.get('/stats').data) == {
+            'users': 2,
+            'repos': 2,
+            'last_user_id': 2,
+        }
+        assert json.loads(app.get('/stats/languages').data) == [
+            {'language': 'python', 'repos': 1},
+            {'language': 'ruby', 'repos': 1},
+        ]
+        assert json.loads(app.get('/stats/languages?limit=1').data) == [
+            {'language': 'python', 'repos': 1},
+        ]
+        assert json.loads(app.get('/stats/users/top?limit=1').data) == [
+            {'id': 2, 'login': 'defunkt', 'repos': 1},
+        ]
+
+    def test_batch_users(self):
+        app = get_app(self.storage).test_client()
+        response = post_json(app, '/users:batch',
+                             {'logins': ['defunkt', 'unknown'], 'ids': [1]})
+        assert [u['login'] for u in json.loads(response.data)] == [
+            'mojombo', 'defunkt',
+        ]
+
+    def test_batch_repos(self):
+        app = get_app(self.storage).test_client()
+
+        def ids(body):
+            return [r['id'] for r in json.loads(
+                post_json(app, '/repos:batch', body).data)]
+
+        assert ids({'logins': ['defunkt']}) == [2]
+        assert ids({'logins': ['unknown']}) == []
+        assert ids({'user_ids': [1], 'ids': [2]}) == [1, 2]
+
+    def test_batch_errors(self):
+        app = get_app(self.storage).test_client()
+        too_many = {'ids': list(range(501))}
+        assert post_json(app, '/users:batch', {}).status_code == 400
+        assert post_json(app, '/users:batch', too_many).status_code == 400
+        assert post_json(app, '/repos:batch',
+                         {'ids': ['x']}).status_code == 400
+
+    def test_batch_queries(self):
+        app = get_app(self.storage).test_client()
+        statements = []
+        self.storage.conn.set_trace_callback(statements.append)
+        post_json(app, '/repos:batch', {'logins': ['mojombo', 'defunkt']})
+        assert len([s for s in statements if s.startswith('SELECT')]) == 2
+
+    def test_changes(self):
+        app = get_app(self.storage).test_client()
+        result = json.loads(app.get('/changes?limit=3').data)
+        assert [(c['type'], c['id']) for c in result['changes']] == [
+            ('user', 1), ('user', 2), ('repo', 1),
+        ]
+        assert result['changes'][0] == {
+            'seq': result['changes'][0]['seq'],
+            'type': 'user',
+            'id': 1,
+            'deleted': False,
+            'object': {'id': 1,
+                       'login': 'mojombo',
+                       'user_url': 'http://github.com/mojombo'},
+        }
+
+        self.storage.put_user(User(1, 'mojombo', 'http://github.com/x'))
+        result = json.loads(app.get('/changes?since={}'.format(
+            result['next'])).data)
+        assert [(c['type'], c['id']) for c in result['changes']] == [
+            ('repo', 2), ('user', 1),
+        ]
+
+        last = json.loads(app.get('/changes?since={}'.format(
+            result['next'])).data)
+        assert last == {'changes': [], 'next': result['next']}
@@ -0,0 +1,80 @@
+from unittest import TestCase
+
+from github_scraper.scraper import Archive
+
+import os
+import shutil
+import tempfile
+
+
+class ArchiveTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.archive = Archive(self.path)
+
+    def tearDown(self):
+        self.archive.close()
+        shutil.rmtree(self.path)
+
+    def test_put_get(self):
+        digest = self.archive.put('http://x/1', b'[1, 2, 3]')
+        assert self.archive.get(digest) == b'[1, 2, 3]'
+        with self.assertRaises(KeyError):
+            self.archive.get('unknown')
+
+    def test_deduplicate(self):
+        digest1 = self.archive.put('http://x/1', b'[]', fetched_at=1)
+        digest2 = self.archive.put('http://x/2', b'[]', fetched_at=2)
+        assert digest1 == digest2
+
+        segment = os.path.join(self.path, Archive.segment_name.format(0))
+        size = os.path.getsize(segment)
+        self.archive.put('http://x/3', b'[]', fetched_at=3)
+        assert os.path.getsize(segment) == size
+
+    def test_segments(self):
+        self.archive.segment_size = 1
+        self.archive.put('http://x/1', b'1')
+        self.archive.put('http://x/2', b'2')
+        assert self.archive.segment == 1
+        assert self.archive.latest('http://x/1') == b'1'
+        assert self.archive.latest('http://x/2') == b'2'
+
+    def test_latest(self):
+        self.archive.put('http://x/1', b'old', fetched_at=1)
+        self.archive.put('http://x/1', b'new', fetched_at=2)
+        assert self.archive.latest('http://x/1') == b'new'
+        assert self.archive.latest('http://x/2') is None
+
+    def test_replay(self):
+        self.archive.put('http://x/users/1', b'a', fetched_at=1)
+        self.archive.put('http://x/users/1', b'b', fetched_at=3)
+        self.archive.put('http://x/users/2', b'c', fetched_at=2)
+        self.archive.put('http://x/repos/1', b'd', fetched_at=4)
+
+        latest = [(e.url, e.body)
+                  for e in self.archive.replay('http://x/users/')]
+        every = [(e.url, e.body)
+                 for e in self.archive.replay('http://x/users/',
+                                              latest=False)]
+
+        assert latest == [('http://x/users/2', b'c'),
+                          ('http://x/users/1', b'b')]
+        assert every == [('http://x/users/1', b'a'),
+                         ('http://x/users/2', b'c'),
+                         ('http://x/users/1', b'b')]
+
+    def test_reopen(self):
+        self.archive.segment_size = 1
+        self.archive.put('http://x/1', b'1')
+        self.archive.put('http://x/2', b'2')
+        self.archive.close()
+
+        self.archive = Archive(self.path)
+        assert self.archive.segment == 1
+        assert self.archive.latest('http://x/1') == b'1'
+
+    def test_context_manager(self):
+        with self.archive:
+            assert not self.archive.closed
+        assert self.archive.closed
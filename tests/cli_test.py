@@ -1,24 +1,167 @@
 from unittest import TestCase, mock
 
 from github_scraper.cli import main
+from github_scraper.scraper import GraphQLScraper, Scraper
+from github_scraper.storage.sqlite import SnapshotStorage
 
+import os
+import shutil
+import subprocess
 import sys
+import tempfile
 
 
 class CLITest(TestCase):
+    def setUp(self):
+        # so that commands don't write data.sqlite in the working directory
+        self.path = tempfile.mkdtemp()
+        self.database = os.path.join(self.path, 'data.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
     def test_scrape(self):
-        with mock.patch.object(sys, 'argv', ['', 'scrape']):
-            with mock.patch('github_scraper.cli.run_scraper') as run_scraper:
+        argv = ['', 'scrape', '--db', self.database]
+        with mock.patch.object(sys, 'argv', argv):
+            with mock.patch('github_scraper.scraper.run_scraper') as run:
+                main()
+                assert run.called
+
+    def test_scrape_engine(self):
+        argv = ['', 'scrape', '--db', self.database]
+        with mock.patch.object(sys, 'argv', argv):
+            with mock.patch('github_scraper.scraper.run_scraper') as run:
+                main()
+                _, kwargs = run.call_args
+                assert kwargs['scraper_class'] is Scraper
+
+        argv = ['', 'scrape', '--db', self.database, '--engine=graphql',
+                '--token=secret']
+        with mock.patch.object(sys, 'argv', argv):
+            with mock.patch('github_scraper.scraper.run_scraper') as run:
+                main()
+                _, kwargs = run.call_args
+                assert kwargs['scraper_class'] is GraphQLScraper
+                assert kwargs['token'] == 'secret'
+
+        argv = ['', 'scrape', '--db', self.database, '--engine=graphql']
+        with mock.patch.object(sys, 'argv', argv):
+            with mock.patch.dict(os.environ, {'GITHUB_TOKEN': 'env'}):
+                with mock.patch('github_scraper.scraper.run_scraper') as run:
+                    main()
+                    _, kwargs = run.call_args
+                    assert kwargs['token'] == 'env'
+
+            with mock.patch.dict(os.environ, clear=True):
+                with self.assertRaises(SystemExit):
+                    main()
+
+        argv = ['', 'scrape', '--db', self.database, '--uvloop']
+        with mock.patch.object(sys, 'argv', argv):
+            with mock.patch('github_scraper.scraper.run_scraper') as run:
+                main()
+                _, kwargs = run.call_args
+                assert kwargs['uvloop']
+
+        argv = ['', 'scrape', '--db', self.database, '--engine=x']
+        with mock.patch.object(sys, 'argv', argv):
+            with self.assertRaises(SystemExit):
                 main()
-                assert run_scraper.called
 
     def test_api(self):
-        with mock.patch.object(sys, 'argv', ['', 'api']):
-            with mock.patch('github_scraper.cli.get_app') as get_app:
+        argv = ['', 'api', '--db', self.database]
+        with mock.patch.object(sys, 'argv', argv):
+            with mock.patch('github_scraper.api.get_app') as get_app:
                 main()
                 assert get_app.called
 
+    def test_snapshot(self):
+        path = tempfile.mkdtemp()
+        database = os.path.join(path, 'data.sqlite')
+        snapshot = os.path.join(path, 'snapshot.sqlite')
+        try:
+            argv = ['', 'scrape', '--db', database, '--snapshot', snapshot,
+                    '--snapshot-interval', '5']
+            with mock.patch.object(sys, 'argv', argv):
+                with mock.patch('github_scraper.scraper.run_scraper') as run:
+                    main()
+                    _, kwargs = run.call_args
+                    assert kwargs['snapshot'] == snapshot
+                    assert kwargs['snapshot_interval'] == 5
+                    kwargs['storage'].publish_snapshot(snapshot)
+
+            argv = ['', 'api', '--snapshot', snapshot]
+            with mock.patch.object(sys, 'argv', argv):
+                with mock.patch('github_scraper.api.get_app') as get_app:
+                    main()
+                    storage, = get_app.call_args[0]
+                    assert isinstance(storage, SnapshotStorage)
+
+            argv = ['', 'api', '--snapshot', database + '.missing']
+            with mock.patch.object(sys, 'argv', argv):
+                with self.assertRaises(SystemExit):
+                    main()
+        finally:
+            shutil.rmtree(path)
+
+        argv = ['', 'scrape', '--db', 'postgresql://localhost/x',
+                '--snapshot', snapshot]
+        with mock.patch.object(sys, 'argv', argv):
+            with mock.patch('github_scraper.cli.get_storage') as get_storage:
+                with self.assertRaises(SystemExit):
+                    main()
+                assert get_storage.called
+
     def test_main(self):
         with mock.patch('github_scraper.cli.main') as main:
             __import__('github_scraper.__main__')
             assert main.called
+
+
+def get_import_times(code: str) -> dict:
+    """ Returns cumulative import time in microseconds of every module
+        imported by running code, using python -X importtime
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            stderr=subprocess.PIPE, universal_newlines=True,
+                            check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return times
+
+
+class ImportTimeTest(TestCase):
+    """ Short-lived invocations should only import what they use
+    """
+    heavy_modules = ('flask', 'flask_restful', 'aiohttp', 'tenacity')
+
+    def test_cli(self):
+        times = get_import_times('import github_scraper.cli')
+        assert 'github_scraper.cli' in times
+        for name in self.heavy_modules:
+            assert name not in times, name
+
+    def test_version(self):
+        times = get_import_times(
+            'import sys; sys.argv = ["", "--version"]\n'
+            'try:\n'
+            '    import github_scraper.__main__\n'
+            'except SystemExit:\n'
+            '    pass')
+        for name in self.heavy_modules:
+            assert name not in times, name
+
+    def test_scraper(self):
+        times = get_import_times('import github_scraper.scraper')
+        assert 'aiohttp' in times
+        assert 'flask' not in times
+
+    def test_api(self):
+        times = get_import_times('import github_scraper.api')
+        assert 'flask' in times
+        assert 'aiohttp' not in times
+        assert 'tenacity' not in times
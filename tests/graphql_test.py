@@ -0,0 +1,258 @@
+from unittest import TestCase, mock
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from tenacity import wait_none
+
+from github_scraper.scraper import Archive, GraphQLScraper
+from github_scraper.scraper.exceptions import GraphQLError
+from github_scraper.scraper.graphql import build_repos_query, get_archive_key
+from github_scraper.storage import Q
+from github_scraper.storage.sqlite import LocMemStorage
+from github_scraper.models import User, Repo
+
+import asyncio
+import json
+import shutil
+import tempfile
+
+
+class FakeGitHub:
+    """ Fake GitHub serving the REST user list and GraphQL repositories of
+        `users`, a dict of login to number of repositories. Logins in `orgs`
+        are organizations.
+    """
+    def __init__(self, users: dict, orgs: set = frozenset()):
+        self.users = users
+        self.orgs = orgs
+        self.requests = []
+        self.errors = None
+
+    def get_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/users', self.list_users)
+        app.router.add_post('/graphql', self.graphql)
+        return app
+
+    def get_user_id(self, login: str) -> int:
+        return list(self.users).index(login) + 1
+
+    async def list_users(self, request):
+        self.requests.append(('GET', request.path, None))
+        return web.json_response([
+            {'id': self.get_user_id(login),
+             'login': login,
+             'type': 'Organization' if login in self.orgs else 'User',
+             'html_url': 'http://github.com/{}'.format(login)}
+            for login in self.users])
+
+    async def graphql(self, request):
+        payload = await request.json()
+        self.requests.append(('POST', request.path, payload))
+        if request.headers.get('Authorization') != 'token secret':
+            return web.json_response({'message': 'Bad credentials'},
+                                     status=401)
+        if self.errors is not None:
+            return web.json_response({'data': None, 'errors': self.errors})
+
+        query = payload['query']
+        variables = payload['variables']
+        first = variables['first']
+        data = {}
+        errors = []
+        i = 0
+        while 'login{}'.format(i) in variables:
+            # user(login:) is null for organizations
+            assert 'u{0}: repositoryOwner(login: $login{0})'.format(i) in query
+            assert '... on Organization' in query
+            login = variables['login{}'.format(i)]
+            offset = int(variables['after{}'.format(i)] or 0)
+            if login not in self.users:
+                data['u{}'.format(i)] = None
+                errors.append({
+                    'type': 'NOT_FOUND',
+                    'path': ['u{}'.format(i)],
+                    'message': 'Could not resolve to a RepositoryOwner with '
+                               'the login of \'{}\'.'.format(login),
+                })
+            else:
+                data['u{}'.format(i)] = self.get_repos(login, offset, first)
+            i += 1
+        if errors:
+            return web.json_response({'data': data, 'errors': errors})
+        return web.json_response({'data': data})
+
+    def get_repos(self, login: str, offset: int, first: int) -> dict:
+        user_id = self.get_user_id(login)
+        count = self.users[login]
+        end = min(count, offset + first)
+        return {
+            'databaseId': user_id,
+            'repositories': {
+                'pageInfo': {
+                    'hasNextPage': end < count,
+                    'endCursor': str(end),
+                },
+                'nodes': [{
+                    'databaseId': user_id * 1000 + n,
+                    'url': 'http://github.com/{}/{}'.format(login, n),
+                    'name': str(n),
+                    'description': None,
+                    'primaryLanguage': {'name': 'ruby'} if n % 2 else None,
+                } for n in range(offset, end)],
+            },
+        }
+
+
+class GraphQLScraperTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.storage = LocMemStorage()
+        self.scraper = GraphQLScraper(storage=self.storage, verbosity=0,
+                                      token='secret')
+        self.scraper.async_get.retry.wait = wait_none()
+        self.scraper.async_query.retry.wait = wait_none()
+
+    def tearDown(self):
+        self.storage.close()
+        self.loop.close()
+
+    def run_scraper(self, github: FakeGitHub):
+        async def run():
+            server = TestServer(github.get_app())
+            await server.start_server()
+            try:
+                self.scraper.api_users_endpoint = str(
+                    server.make_url('/users')) + '?since={}'
+                self.scraper.api_graphql_endpoint = str(
+                    server.make_url('/graphql'))
+                await self.scraper.async_fetch_users_and_repos()
+            finally:
+                await server.close()
+
+        self.loop.run_until_complete(run())
+
+    def test_fetch(self):
+        github = FakeGitHub({'mojombo': 2, 'defunkt': 1})
+        self.run_scraper(github)
+
+        assert self.storage.list_users() == [
+            User(1, 'mojombo', 'http://github.com/mojombo'),
+            User(2, 'defunkt', 'http://github.com/defunkt'),
+        ]
+        assert self.storage.list_repos() == [
+            Repo(1000, 1, 'http://github.com/mojombo/0', '0', None, None),
+            Repo(1001, 1, 'http://github.com/mojombo/1', '1', None, 'ruby'),
+            Repo(2000, 2, 'http://github.com/defunkt/0', '0', None, None),
+        ]
+        assert self.scraper.stats['u'] == 2
+        assert self.scraper.stats['r'] == 3
+
+    def test_fetch_organization(self):
+        github = FakeGitHub({'mojombo': 1, 'github': 2}, orgs={'github'})
+        self.run_scraper(github)
+
+        # organizations are listed as users, like with the REST engine
+        assert [(repo.user_id, repo.name)
+                for repo in self.storage.list_repos()] == [
+            (1, '0'), (2, '0'), (2, '1')]
+        assert self.scraper.stats['e'] == 0
+
+    def test_fetch_batches(self):
+        github = FakeGitHub({'user{}'.format(i): 3 for i in range(100)})
+        self.run_scraper(github)
+
+        # one request for the user list and one query per 25 users,
+        # instead of one request per user
+        assert len(github.requests) == 5
+        assert len(self.storage.list_repos()) == 300
+
+    def test_fetch_pagination(self):
+        self.scraper.repos_per_user = 2
+        github = FakeGitHub({'mojombo': 5, 'defunkt': 1, 'pjhyett': 3})
+        self.run_scraper(github)
+
+        queries = [payload['variables'] for _, _, payload in github.requests
+                   if payload is not None]
+        assert [sorted(v for k, v in q.items() if k.startswith('login'))
+                for q in queries] == [
+            ['defunkt', 'mojombo', 'pjhyett'],
+            ['mojombo', 'pjhyett'],
+            ['mojombo'],
+        ]
+        assert queries[1]['after0'] == '2'
+        assert len(self.storage.list_repos(Q('user_id') == 1)) == 5
+        assert len(self.storage.list_repos()) == 9
+
+    def test_fetch_missing_user(self):
+        github = FakeGitHub({'mojombo': 1, 'defunkt': 1})
+
+        async def list_users(request):
+            return web.json_response([
+                {'id': 1, 'login': 'mojombo', 'html_url': ''},
+                {'id': 3, 'login': 'gone', 'html_url': ''},
+            ])
+        github.list_users = list_users
+        with mock.patch.object(self.scraper, 'report_error') as report:
+            self.run_scraper(github)
+
+        assert [repo.user_id for repo in self.storage.list_repos()] == [1]
+        # missing owners are counted and reported, not skipped silently
+        assert self.scraper.stats['e'] == 1
+        error, = report.call_args[0]
+        assert isinstance(error, GraphQLError)
+        assert error.messages == [
+            "Could not resolve to a RepositoryOwner with the login of 'gone'."]
+
+    def test_query_error(self):
+        github = FakeGitHub({'mojombo': 1})
+        github.errors = [{'message': 'Something went wrong'}]
+        with mock.patch.object(self.scraper, 'report_error') as report:
+            self.run_scraper(github)
+        assert self.scraper.stats['e'] == 1
+        error, = report.call_args[0]
+        assert isinstance(error, GraphQLError)
+        assert error.messages == ['Something went wrong']
+
+    def test_archive(self):
+        path = tempfile.mkdtemp()
+        self.scraper.archive = Archive(path)
+        try:
+            github = FakeGitHub({'user{}'.format(i): 2 for i in range(30)})
+            self.run_scraper(github)
+
+            # one entry per batch of 25 users, instead of a single one for
+            # the endpoint
+            endpoint = self.scraper.api_graphql_endpoint
+            entries = list(self.scraper.archive.replay(endpoint))
+            assert len(entries) == 2
+            assert entries[0].url != entries[1].url
+            repos = set()
+            for entry in entries:
+                assert entry.url.startswith(endpoint + '#')
+                assert self.scraper.archive.latest(entry.url) == entry.body
+                for user in json.loads(entry.body)['data'].values():
+                    repos.update(repo['databaseId'] for repo in
+                                 user['repositories']['nodes'])
+            assert repos == {repo.id for repo in self.storage.list_repos()}
+            assert len(repos) == 60
+        finally:
+            self.scraper.archive.close()
+            shutil.rmtree(path)
+
+    def test_get_archive_key(self):
+        payload = {'query': 'q', 'variables': {'login0': 'x', 'first': 10}}
+        key = get_archive_key('http://x/graphql', payload)
+        assert key.startswith('http://x/graphql#')
+        assert key == get_archive_key('http://x/graphql', {
+            'variables': {'first': 10, 'login0': 'x'}, 'query': 'q'})
+        assert key != get_archive_key('http://x/graphql', {
+            'query': 'q', 'variables': {'login0': 'y', 'first': 10}})
+
+    def test_build_repos_query(self):
+        query, variables = build_repos_query([('x', None), ('y', 'abc')], 10)
+        assert variables == {'first': 10,
+                             'login0': 'x', 'after0': None,
+                             'login1': 'y', 'after1': 'abc'}
+        assert '$login1: String!, $after1: String' in query
+        assert 'u1: repositoryOwner(login: $login1)' in query
+        assert build_repos_query([('z', None), ('w', None)], 10)[0] is query
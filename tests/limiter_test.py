@@ -0,0 +1,225 @@
+from unittest import TestCase
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from tenacity import wait_none
+
+from github_scraper.scraper import AdaptiveLimiter, Scraper
+from github_scraper.scraper.exceptions import ServerError
+from github_scraper.storage.sqlite import LocMemStorage
+
+import aiohttp
+import asyncio
+import random
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeServer:
+    """ Server that handles `capacity` requests at a time, with a random
+        latency. Extra requests are queued, or rejected with a 503 if
+        `reject` is true.
+    """
+    def __init__(self, capacity: int, *, reject: bool = False,
+                 latency: tuple = (0.004, 0.008)):
+        self.capacity = capacity
+        self.reject = reject
+        self.latency = latency
+        self.in_flight = 0
+        self.peak = 0
+        self.rejected = 0
+        self.workers = None
+
+    async def handle(self, request):
+        if self.workers is None:
+            self.workers = asyncio.Semaphore(self.capacity)
+        if self.reject and self.in_flight >= self.capacity:
+            self.rejected += 1
+            return web.Response(status=503)
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            async with self.workers:
+                await asyncio.sleep(random.uniform(*self.latency))
+        finally:
+            self.in_flight -= 1
+        return web.json_response([])
+
+
+class AdaptiveLimiterTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_round(self, limiter, latency, *, requests=None, error=None):
+        """ Run concurrent requests under the limiter, all taking latency
+            seconds. By default as many requests as the limit are run.
+        """
+        if requests is None:
+            requests = limiter.current_limit
+
+        async def run():
+            done = asyncio.Event()
+
+            async def request():
+                async with limiter.slot():
+                    await done.wait()
+                    if error is not None:
+                        raise error
+
+            tasks = [asyncio.ensure_future(request())
+                     for _ in range(requests)]
+            await asyncio.sleep(0)
+            self.clock.now += latency
+            done.set()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        self.loop.run_until_complete(run())
+        assert limiter.in_flight == 0
+
+    def test_increase(self):
+        limiter = AdaptiveLimiter(2, clock=self.clock)
+        for _ in range(10):
+            self.run_round(limiter, 0.1)
+        assert limiter.current_limit == 7
+
+    def test_increase_max(self):
+        limiter = AdaptiveLimiter(2, max_limit=4, clock=self.clock)
+        for _ in range(5):
+            self.run_round(limiter, 0.1)
+        assert limiter.current_limit == 4
+
+    def test_no_increase_unused(self):
+        limiter = AdaptiveLimiter(8, clock=self.clock)
+        for _ in range(5):
+            self.run_round(limiter, 0.1, requests=1)
+        assert limiter.current_limit == 8
+
+    def test_decrease_latency(self):
+        limiter = AdaptiveLimiter(8, max_limit=8, clock=self.clock)
+        for _ in range(5):
+            self.run_round(limiter, 0.1)
+        self.run_round(limiter, 1)
+        assert limiter.current_limit == 5
+        self.run_round(limiter, 1)
+        assert limiter.current_limit == 3
+
+    def test_decrease_overload(self):
+        limiter = AdaptiveLimiter(8, min_limit=3, clock=self.clock,
+                                  overload_errors=(ServerError,))
+        self.run_round(limiter, 0.1, error=ServerError())
+        assert limiter.current_limit == 5
+        for _ in range(3):
+            self.run_round(limiter, 0.1, error=ServerError())
+        assert limiter.current_limit == 3
+
+        # other errors are ignored
+        self.run_round(limiter, 0.1, error=ValueError())
+        assert limiter.current_limit == 3
+
+    def test_acquire_waits(self):
+        limiter = AdaptiveLimiter(2, max_limit=2)
+        peak = 0
+
+        async def run():
+            nonlocal peak
+            async with limiter.slot():
+                peak = max(peak, limiter.in_flight)
+                await asyncio.sleep(0.001)
+
+        async def run_all():
+            await asyncio.gather(*[run() for _ in range(10)])
+
+        self.loop.run_until_complete(run_all())
+        assert peak == 2
+        assert limiter.in_flight == 0
+        assert not limiter.waiters
+
+    def test_acquire_cancel(self):
+        limiter = AdaptiveLimiter(1, max_limit=1)
+
+        async def run():
+            async with limiter.slot():
+                await asyncio.sleep(0.01)
+
+        async def cancel():
+            first = asyncio.ensure_future(run())
+            second = asyncio.ensure_future(run())
+            third = asyncio.ensure_future(run())
+            await asyncio.sleep(0)
+            second.cancel()
+            await asyncio.gather(first, third)
+
+        self.loop.run_until_complete(cancel())
+        assert limiter.in_flight == 0
+        assert not limiter.waiters
+
+
+class ScraperLimiterTest(TestCase):
+    """ Run the scraper against a fake server with variable latency
+    """
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.storage = LocMemStorage()
+
+    def tearDown(self):
+        self.storage.close()
+        self.loop.close()
+
+    def fetch(self, server, limiter, requests):
+        scraper = Scraper(storage=self.storage, verbosity=0,
+                          limiter=limiter)
+        scraper.async_get.retry.wait = wait_none()
+
+        async def run():
+            app = web.Application()
+            app.router.add_get('/', server.handle)
+            test_server = TestServer(app)
+            await test_server.start_server()
+            try:
+                url = str(test_server.make_url('/'))
+                async with aiohttp.ClientSession() as session:
+                    return await asyncio.gather(
+                        *[scraper.async_get(session, url)
+                          for _ in range(requests)])
+            finally:
+                await test_server.close()
+
+        result = self.loop.run_until_complete(run())
+        assert result == [[]] * requests
+        return scraper
+
+    def test_increase(self):
+        server = FakeServer(64)
+        limiter = AdaptiveLimiter(2)
+        scraper = self.fetch(server, limiter, 300)
+        assert limiter.current_limit > 8
+        assert scraper.stats['c'] == limiter.current_limit
+
+    def test_decrease_latency(self):
+        server = FakeServer(16)
+        limiter = AdaptiveLimiter(8)
+        self.fetch(server, limiter, 300)
+        limit = limiter.current_limit
+        assert limit > 8
+
+        # the server slows down
+        server.capacity = 2
+        server.workers = None
+        self.fetch(server, limiter, 300)
+        assert limiter.current_limit < limit / 2
+
+    def test_decrease_server_error(self):
+        server = FakeServer(4, reject=True)
+        limiter = AdaptiveLimiter(64, overload_errors=(ServerError,))
+        self.fetch(server, limiter, 300)
+        assert server.rejected > 0
+        assert limiter.current_limit < 16
@@ -0,0 +1,63 @@
+from unittest import TestCase, mock
+
+from github_scraper.scraper import loop
+from github_scraper.scraper.loop import LagMonitor, use_uvloop
+
+import asyncio
+import time
+
+
+class LagMonitorTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_blocked(self):
+        report = mock.Mock()
+        monitor = LagMonitor(interval=0.01, threshold=0.05, report=report)
+
+        async def run():
+            monitor.start(self.loop)
+            await asyncio.sleep(0.05)
+            time.sleep(0.1)
+            await asyncio.sleep(0.05)
+            monitor.stop()
+
+        self.loop.run_until_complete(run())
+        assert monitor.stats['blocked'] == 1
+        assert monitor.stats['max'] >= 0.05
+        assert monitor.stats['samples'] > 5
+        assert 0 < monitor.mean_lag < monitor.stats['max']
+        assert report.call_count == 1
+        assert report.call_args[0][0] == monitor.stats['max']
+
+    def test_not_blocked(self):
+        monitor = LagMonitor(interval=0.01, threshold=0.05)
+        assert monitor.mean_lag == 0
+
+        async def run():
+            monitor.start(self.loop)
+            await asyncio.sleep(0.05)
+            monitor.stop()
+            monitor.stop()
+
+        self.loop.run_until_complete(run())
+        assert monitor.stats['blocked'] == 0
+        assert monitor.stats['samples'] > 0
+
+
+class UVLoopTest(TestCase):
+    def test_use_uvloop(self):
+        uvloop = mock.Mock()
+        with mock.patch.object(loop, 'uvloop', uvloop):
+            with mock.patch('asyncio.set_event_loop_policy') as set_policy:
+                use_uvloop()
+                set_policy.assert_called_with(
+                    uvloop.EventLoopPolicy.return_value)
+
+    def test_use_uvloop_missing(self):
+        with mock.patch.object(loop, 'uvloop', None):
+            with self.assertRaises(ImportError):
+                use_uvloop()
@@ -1,13 +1,20 @@
 from unittest import TestCase, mock
+from email.utils import formatdate
 from aioresponses import aioresponses
 from tenacity import wait_none
 
-from github_scraper.scraper import Scraper, run_scraper
+from github_scraper.scraper import Archive, Scraper, run_scraper
+from github_scraper.scraper.scraper import get_retry_after
 from github_scraper.storage.sqlite import LocMemStorage
 from github_scraper.models import User, Repo
 
 import asyncio
 import aiohttp
+import json
+import os
+import shutil
+import signal
+import tempfile
 import time
 
 
@@ -71,12 +78,24 @@ RESPONSES = {
     'invalid_error': {
         'status': 500,
     },
+    'invalid_secondary_limit': {
+        'status': 403,
+        'headers': {
+            'retry-after': '0',
+        },
+    },
+    'invalid_secondary_limit_date': {
+        'status': 429,
+        'headers': {
+            'retry-after': formatdate(time.time() - 5, usegmt=True),
+        },
+    },
 }
 
 
 class ScraperTest(TestCase):
     def setUp(self):
-        self.loop = asyncio.get_event_loop()
+        self.loop = asyncio.new_event_loop()
         self.storage = LocMemStorage()
         self.scraper = Scraper(storage=self.storage, verbosity=1)
 
@@ -85,6 +104,7 @@ class ScraperTest(TestCase):
 
     def tearDown(self):
         self.storage.close()
+        self.loop.close()
 
     def run_in_loop(self, method, *args, iterate=True):
         """ Test helper that allows running async method inside asyncio loop
@@ -139,6 +159,65 @@ class ScraperTest(TestCase):
                                       url,
                                       iterate=False)
             assert result
+        assert self.scraper.limiter.current_limit == 5
+
+    def test_async_get_secondary_limit(self):
+        """ Test secondary rate limits are retried and make the scraper
+            back off
+        """
+        with aioresponses() as mocked:
+            url = self.scraper.api_users_endpoint.format(0)
+            mocked.get(url, **RESPONSES['invalid_secondary_limit'])
+            mocked.get(url, **RESPONSES['user_valid'])
+            result = self.run_in_loop(self.scraper.async_get,
+                                      url,
+                                      iterate=False)
+            assert result
+        assert self.scraper.limiter.current_limit == 5
+        assert self.scraper.stats['c'] == 5
+
+    def test_async_get_secondary_limit_date(self):
+        """ Test secondary rate limits with a Retry-After date are retried
+        """
+        with aioresponses() as mocked:
+            url = self.scraper.api_users_endpoint.format(0)
+            mocked.get(url, **RESPONSES['invalid_secondary_limit_date'])
+            mocked.get(url, **RESPONSES['user_valid'])
+            result = self.run_in_loop(self.scraper.async_get,
+                                      url,
+                                      iterate=False)
+            assert result
+        assert self.scraper.limiter.current_limit == 5
+
+    def test_get_retry_after(self):
+        """ Test Retry-After headers in seconds and as HTTP dates
+        """
+        assert get_retry_after('30') == 30
+        assert get_retry_after(None) == 60
+        assert get_retry_after('soon') == 60
+        assert get_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0
+        retry_after = get_retry_after(formatdate(time.time() + 30,
+                                                 usegmt=True))
+        assert 28 < retry_after <= 30
+        retry_after = get_retry_after(formatdate(time.time() + 30))
+        assert 28 < retry_after <= 30
+
+    def test_async_get_archive(self):
+        """ Test raw responses are archived
+        """
+        path = tempfile.mkdtemp()
+        self.scraper.archive = Archive(path)
+        try:
+            with aioresponses() as mocked:
+                url = self.scraper.api_users_endpoint.format(0)
+                mocked.get(url, **RESPONSES['user_valid'])
+                result = self.run_in_loop(self.scraper.async_get,
+                                          url,
+                                          iterate=False)
+            assert json.loads(self.scraper.archive.latest(url)) == result
+        finally:
+            self.scraper.archive.close()
+            shutil.rmtree(path)
 
     def test_fetch_user_list_success(self):
         """ Test fetch users
@@ -157,7 +236,7 @@ class ScraperTest(TestCase):
         self.storage.put_user(User(42, 'mojombo', 'http://github.com/mojombo'))
         last_id = 42
         with mock.patch.object(self.scraper, 'async_get') as async_get:
-            result = asyncio.Future()
+            result = self.loop.create_future()
             result.set_result([])
             async_get.return_value = result
             with aioresponses():
@@ -175,6 +254,16 @@ class ScraperTest(TestCase):
                              'mojombo',
                              iterate=False)
 
+        # fetching again must not rewrite the unchanged repo
+        with aioresponses() as mocked:
+            url = self.scraper.api_repos_endpoint.format('mojombo')
+            mocked.get(url, **RESPONSES['repo_valid_1'])
+            self.run_in_loop(self.scraper.async_fetch_repos,
+                             'mojombo',
+                             iterate=False)
+        assert self.scraper.stats['r'] == 2
+        assert self.scraper.stats['s'] == 1
+
         result = self.storage.list_repos()
         assert result == [
             Repo(id=1,
@@ -205,6 +294,126 @@ class ScraperTest(TestCase):
         assert len(self.storage.list_users()) == 2
         assert len(self.storage.list_repos()) == 2
 
+    def test_fetch_errors(self):
+        """ Test a failed user doesn't stop the other ones
+        """
+        with aioresponses() as mocked:
+            mocked.get(self.scraper.api_users_endpoint.format(0),
+                       **RESPONSES['user_valid'])
+            mocked.get(self.scraper.api_repos_endpoint.format('mojombo'),
+                       status=404)
+            mocked.get(self.scraper.api_repos_endpoint.format('defunkt'),
+                       **RESPONSES['repo_valid_2'])
+            with mock.patch('github_scraper.scraper.scraper.log') as log:
+                self.scraper.run()
+
+        assert len(self.storage.list_repos()) == 1
+        assert self.scraper.stats['e'] == 1
+        assert any('404' in str(call) for call in log.mock_calls)
+
+    def run_stopped(self, fetch):
+        """ Run the scraper with fetch instead of fetching users and repos
+        """
+        with mock.patch.object(self.scraper, 'async_fetch_users_and_repos',
+                               fetch):
+            self.loop.run_until_complete(self.scraper.async_run())
+
+    def test_stop_drain(self):
+        """ Test running requests finish when stopped, but new ones are not
+            started
+        """
+        async def fetch():
+            self.scraper.stop()
+            await asyncio.sleep(0.01)
+            fetched.append(1)
+            await self.scraper.async_get(None, 'http://localhost/')
+            fetched.append(2)
+
+        fetched = []
+        self.run_stopped(fetch)
+        assert self.scraper.stopping
+        assert fetched == [1]
+
+    def test_stop_twice(self):
+        """ Test stopping again cancels running requests
+        """
+        async def fetch():
+            self.scraper.stop()
+            self.scraper.stop()
+            await asyncio.sleep(10)
+
+        started = time.time()
+        self.run_stopped(fetch)
+        assert time.time() - started < 1
+
+    def test_stop_timeout(self):
+        """ Test running requests are cancelled after drain_timeout
+        """
+        async def fetch():
+            self.scraper.stop()
+            await asyncio.sleep(10)
+
+        self.scraper.drain_timeout = 0.01
+        started = time.time()
+        self.run_stopped(fetch)
+        assert time.time() - started < 1
+
+    def test_stop_signal(self):
+        """ Test SIGINT and SIGTERM stop the scraper
+        """
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            async def fetch():
+                os.kill(os.getpid(), signum)
+                await asyncio.sleep(0.01)
+
+            self.scraper.stopping = False
+            self.run_stopped(fetch)
+            assert self.scraper.stopping
+
+        # handlers are removed afterwards
+        assert signal.getsignal(signal.SIGINT) is signal.default_int_handler
+
+    def test_snapshot(self):
+        """ Test snapshots are published periodically and when done
+        """
+        async def fetch():
+            await asyncio.sleep(0.1)
+
+        self.scraper.snapshot = '/tmp/snapshot.sqlite'
+        self.scraper.snapshot_interval = 0.02
+        with mock.patch.object(self.storage, 'publish_snapshot') as publish:
+            self.run_stopped(fetch)
+            calls = publish.call_count
+            assert calls > 2
+            assert publish.call_args == mock.call('/tmp/snapshot.sqlite')
+
+            # no more snapshots once done
+            self.loop.run_until_complete(asyncio.sleep(0.05))
+            assert publish.call_count == calls
+
+    def test_snapshot_in_progress(self):
+        """ Test the final snapshot waits for one still being copied
+        """
+        async def fetch():
+            await asyncio.sleep(0.05)
+
+        running = []
+        overlaps = []
+
+        def publish(path):
+            running.append(path)
+            overlaps.append(len(running))
+            time.sleep(0.1)
+            running.remove(path)
+
+        self.scraper.snapshot = '/tmp/snapshot.sqlite'
+        self.scraper.snapshot_interval = 0.01
+        with mock.patch.object(self.storage, 'publish_snapshot', publish):
+            self.run_stopped(fetch)
+        # the periodic copy started before the end and the final one
+        assert overlaps == [1, 1]
+        assert not running
+
     def test_report_obj(self):
         """ Test logging report
         """
@@ -241,6 +450,14 @@ class ScraperTest(TestCase):
                 assert run.called
                 assert mock.call(0) in exit.mock_calls
 
+        # test uvloop
+        with mock.patch('{}.sys.exit'.format(module)):
+            with mock.patch('{}.Scraper.run'.format(module)):
+                with mock.patch('{}.use_uvloop'.format(module)) as use:
+                    run_scraper(storage=LocMemStorage(), verbosity=1,
+                                uvloop=True)
+                    assert use.called
+
         # test interrupt
         with mock.patch('{}.sys.exit'.format(module)) as exit:
             def _interrupt():
@@ -1,7 +1,23 @@
-from unittest import TestCase
+from unittest import TestCase, mock, skipUnless
 
-from github_scraper.models import User, Repo
-from github_scraper.storage.sqlite import LocMemStorage, Q
+from github_scraper.models import (Batch, Change, LanguageStats, User,
+                                   UserStats, Repo)
+from github_scraper.storage import get_storage
+from github_scraper.storage.cache import UserCache
+from github_scraper.storage.query import (compile_lookup, compile_shape,
+                                          get_prefix_upper_bound)
+from github_scraper.storage.sqlite import (LocMemStorage, SnapshotStorage,
+                                           SQLiteStorage, Q)
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+
+
+POSTGRES_URL = os.environ.get('GITHUB_SCRAPER_POSTGRES_URL')
 
 
 class SQLiteStorageTest(TestCase):
@@ -45,6 +61,52 @@ class SQLiteStorageTest(TestCase):
         assert obj.description == 'y'
         assert obj.language == 'z'
 
+    def test_put_unchanged(self):
+        users = [User(1, 'x', 'http://github.com/x'),
+                 User(2, 'y', 'http://github.com/y')]
+        repo = Repo(1, 1, 'http://github.com/x/x', 'x', 'y', 'z')
+
+        assert self.storage.put_users(users) == 2
+        assert self.storage.put_users(users) == 0
+        assert self.storage.put_users(users[:1] + [
+            User(2, 'y', 'http://github.com/z')]) == 1
+        assert self.storage.put_repo(repo)
+        assert not self.storage.put_repo(repo)
+        assert self.storage.put_repo(repo._replace(language=None))
+
+        seq = self.storage.list_changes()[-1].seq
+        self.storage.put_users(users[:1])
+        assert self.storage.list_changes(seq) == []
+
+    def test_put_legacy_schema(self):
+        path = tempfile.mkdtemp()
+        database = os.path.join(path, 'data.sqlite')
+        try:
+            conn = sqlite3.connect(database)
+            conn.execute('CREATE TABLE user (id integer primary key, '
+                         'login text, user_url text)')
+            conn.execute("INSERT INTO user VALUES (1, 'x', 'http://x')")
+            conn.commit()
+            conn.close()
+
+            with SQLiteStorage(database) as storage:
+                assert storage.put_user(User(1, 'x', 'http://x'))
+                assert not storage.put_user(User(1, 'x', 'http://x'))
+                assert storage.list_users() == [User(1, 'x', 'http://x')]
+        finally:
+            shutil.rmtree(path)
+
+    def test_put_bulk(self):
+        self.storage.put_users([User(1, 'x', 'http://github.com/x'),
+                                User(2, 'y', 'http://github.com/y')])
+        self.storage.put_repos([Repo(1, 1, 'http://github.com/x/x', 'x',
+                                     'y', 'z'),
+                                Repo(2, 2, 'http://github.com/y/y', 'y',
+                                     'y', 'z')])
+
+        assert [u.login for u in self.storage.list_users()] == ['x', 'y']
+        assert [r.id for r in self.storage.list_repos({'user_id': 2})] == [2]
+
     def test_context_manager(self):
         with self.storage:
             assert not self.storage.closed
@@ -62,6 +124,252 @@ class SQLiteStorageTest(TestCase):
         assert int_test == (' WHERE x = ?', [162])
         assert q_ltgt_test == (' WHERE x < ? AND y > ?', [1, 2])
 
+    def test_build_where_clause_operators(self):
+        q_test = self.storage._build_where_clause([
+            Q('a') == 1, Q('b') != 2, Q('c') <= 3, Q('d') >= 4,
+            Q('e').in_([5, 6]), Q('f').startswith('ab'), Q('g') == None,  # noqa
+            Q('h') != None, Q('i').contains('x'), Q('j').in_([]),  # noqa
+        ])
+        group_test = self.storage._build_where_clause([
+            (Q('x') == 1) | (Q('y') == 2) & (Q('z') == 3),
+        ])
+        nested_test = self.storage._build_where_clause([
+            {'a': 1}, (Q('x') == 1) | (Q('y') == 2),
+        ])
+
+        assert q_test == (' WHERE a = ? AND b != ? AND c <= ? AND d >= ? '
+                          'AND e IN (?, ?) AND (f >= ? AND f < ?) '
+                          'AND g IS NULL AND h IS NOT NULL AND i like ? '
+                          'AND 1 = 0',
+                          [1, 2, 3, 4, 5, 6, 'ab', 'ac', '%x%'])
+        assert group_test == (' WHERE x = ? OR (y = ? AND z = ?)', [1, 2, 3])
+        assert nested_test == (' WHERE a = ? AND (x = ? OR y = ?)',
+                               [1, 1, 2])
+
+    def test_build_where_clause_columns(self):
+        columns = frozenset(['id', 'login'])
+        with self.assertRaises(ValueError):
+            self.storage._build_where_clause([Q('x') == 1], columns)
+        with self.assertRaises(ValueError):
+            self.storage._build_where_clause([{'id; DROP TABLE x': 1}])
+
+        assert self.storage._build_where_clause([Q('id') == 1], columns) == (
+            ' WHERE id = ?', [1])
+
+    def test_build_where_clause_prefix(self):
+        top = chr(sys.maxunicode)
+        assert self.storage._build_where_clause([
+            Q('x').startswith(top * 2)]) == (' WHERE x >= ?', [top * 2])
+        assert compile_lookup([Q('x').startswith('a')], collation='C') == (
+            ' WHERE (x COLLATE "C" >= ? COLLATE "C" AND '
+            'x COLLATE "C" < ? COLLATE "C")', ['a', 'b'])
+
+    def test_prefix_upper_bound(self):
+        top = chr(sys.maxunicode)
+        assert get_prefix_upper_bound('ab') == 'ac'
+        assert get_prefix_upper_bound('a' + top) == 'b'
+        assert get_prefix_upper_bound('\ud7ff') == '\ue000'
+        assert get_prefix_upper_bound(top) is None
+
+    def test_compile_cache(self):
+        compile_shape.cache_clear()
+        compile_lookup([Q('id').in_([1, 2])])
+        compile_lookup([Q('id').in_([3, 4])])
+        compile_lookup([Q('id').in_([3, 4, 5])])
+
+        info = compile_shape.cache_info()
+        assert (info.hits, info.misses) == (1, 2)
+
+    def test_query_cache(self):
+        self.storage.put_user(User(1, 'x', 'http://github.com/x'))
+        self.storage.put_user(User(2, 'y', 'http://github.com/y'))
+
+        assert self.storage.get_user(Q('login') == 'x').id == 1
+        assert self.storage.get_user(Q('login') == 'y').id == 2
+        assert self.storage.get_user(Q('login') == 'z') is None
+        assert self.storage.list_users(Q('login') == 'x') != []
+        assert self.storage.query_cache_stats == {'hits': 2, 'misses': 2}
+
+    def test_query_cache_size(self):
+        storage = LocMemStorage(query_cache_size=1)
+        storage.get_user(Q('login') == 'x')
+        storage.get_user(Q('id') == 1)
+        storage.get_user(Q('login') == 'x')
+        assert len(storage.query_cache) == 1
+        assert storage.query_cache_stats == {'hits': 0, 'misses': 3}
+
+        storage = LocMemStorage(query_cache_size=0)
+        storage.get_user(Q('login') == 'x')
+        storage.get_user(Q('login') == 'x')
+        assert len(storage.query_cache) == 0
+        assert storage.query_cache_stats == {'hits': 0, 'misses': 2}
+
+    def test_user_cache(self):
+        self.storage.put_user(User(1, 'x', 'http://github.com/x'))
+
+        assert self.storage.get_user(Q('login') == 'x').id == 1
+        assert self.storage.get_user(Q('login') == 'x').id == 1
+        assert self.storage.get_user(Q('id') == 1).login == 'x'
+        assert self.storage.get_user({'id': 1}).login == 'x'
+        assert self.storage.user_cache.stats == {'hits': 3, 'misses': 1}
+
+        # substring lookups are not cached
+        assert self.storage.get_user({'login': 'x'}).id == 1
+        assert self.storage.user_cache.stats == {'hits': 3, 'misses': 1}
+
+    def test_user_cache_invalidate(self):
+        self.storage.put_user(User(1, 'x', 'http://github.com/x'))
+        assert self.storage.get_user(Q('login') == 'x').id == 1
+
+        # login taken over by another account
+        self.storage.put_user(User(2, 'x', 'http://github.com/x'))
+        assert self.storage.get_user(Q('login') == 'x').id == 2
+        assert self.storage.get_user(Q('id') == 1) is None
+
+        self.storage.put_user(User(2, 'y', 'http://github.com/y'))
+        assert self.storage.get_user(Q('id') == 2).login == 'y'
+        assert self.storage.get_user(Q('login') == 'x') is None
+
+    def test_list_batch(self):
+        batch = Batch(User)
+        batch.append((1, 'x', 'http://github.com/x'))
+        batch.append((2, 'y', 'http://github.com/y'))
+        self.storage.put_users(batch)
+
+        result = self.storage.list_users(batch=True)
+        assert isinstance(result, Batch)
+        assert len(result) == 2
+        assert list(result) == self.storage.list_users()
+        assert result.to_dicts() == [
+            {'id': 1, 'login': 'x', 'user_url': 'http://github.com/x'},
+            {'id': 2, 'login': 'y', 'user_url': 'http://github.com/y'},
+        ]
+
+    def test_stats(self):
+        self.storage.put_users([User(1, 'x', 'http://github.com/x'),
+                                User(2, 'y', 'http://github.com/y')])
+        self.storage.put_repos([
+            Repo(1, 1, 'http://github.com/x/a', 'a', '', 'ruby'),
+            Repo(2, 1, 'http://github.com/x/b', 'b', '', 'python'),
+            Repo(3, 1, 'http://github.com/x/c', 'c', '', None),
+            Repo(4, 2, 'http://github.com/y/d', 'd', '', 'ruby'),
+        ])
+        # rewrites must not be counted twice
+        self.storage.put_repo(Repo(2, 1, 'http://github.com/x/b', 'b', '',
+                                   'ruby'))
+        self.storage.put_user(User(2, 'y', 'http://github.com/y'))
+
+        assert self.storage.list_language_stats() == [
+            LanguageStats('ruby', 3),
+            LanguageStats(None, 1),
+        ]
+        assert self.storage.list_language_stats(limit=1) == [
+            LanguageStats('ruby', 3),
+        ]
+        assert self.storage.list_top_users() == [
+            UserStats(1, 'x', 3),
+            UserStats(2, 'y', 1),
+        ]
+        assert self.storage.get_progress() == {
+            'users': 2,
+            'repos': 4,
+            'last_user_id': 2,
+        }
+
+    def test_stats_rebuild(self):
+        path = tempfile.mkdtemp()
+        database = os.path.join(path, 'data.sqlite')
+        try:
+            with SQLiteStorage(database) as storage:
+                storage.put_user(User(1, 'x', 'http://github.com/x'))
+                storage.put_repo(Repo(1, 1, 'http://github.com/x/a', 'a', '',
+                                      'ruby'))
+                storage.conn.execute('DROP TABLE progress_stats')
+                # as created before the schema had a version
+                storage.conn.execute('PRAGMA user_version = 0')
+                storage.conn.execute('DELETE FROM language_stats')
+                storage.conn.commit()
+
+            with SQLiteStorage(database) as storage:
+                assert storage.list_language_stats() == [
+                    LanguageStats('ruby', 1),
+                ]
+                assert storage.get_progress()['repos'] == 1
+        finally:
+            shutil.rmtree(path)
+
+    def test_schema_current(self):
+        path = tempfile.mkdtemp()
+        database = os.path.join(path, 'data.sqlite')
+        try:
+            SQLiteStorage(database).close()
+            writer = sqlite3.connect(database)
+            try:
+                writer.execute('BEGIN IMMEDIATE')
+                # opening a current database doesn't wait to write to it
+                with SQLiteStorage(database) as storage:
+                    assert storage.list_users() == []
+            finally:
+                writer.close()
+        finally:
+            shutil.rmtree(path)
+
+    def test_changes(self):
+        self.storage.put_user(User(1, 'x', 'http://github.com/x'))
+        self.storage.put_user(User(2, 'y', 'http://github.com/y'))
+        self.storage.put_repo(Repo(1, 1, 'http://github.com/x/a', 'a', '',
+                                   'ruby'))
+        seq = self.storage.list_changes()[-1].seq
+
+        self.storage.put_user(User(1, 'x', 'http://github.com/z'))
+        # login taken over by another account
+        self.storage.put_user(User(3, 'y', 'http://github.com/y'))
+
+        changes = self.storage.list_changes(seq)
+        assert [c._replace(seq=None) for c in changes] == [
+            Change(None, 'user', 1, False,
+                   User(1, 'x', 'http://github.com/z')),
+            Change(None, 'user', 2, True, None),
+            Change(None, 'user', 3, False,
+                   User(3, 'y', 'http://github.com/y')),
+        ]
+        assert seq < changes[0].seq < changes[1].seq < changes[2].seq
+        assert [(c.kind, c.id) for c in self.storage.list_changes()] == [
+            ('repo', 1), ('user', 1), ('user', 2), ('user', 3),
+        ]
+        assert len(self.storage.list_changes(limit=1)) == 1
+
+    def test_changes_backfill(self):
+        path = tempfile.mkdtemp()
+        database = os.path.join(path, 'data.sqlite')
+        try:
+            with SQLiteStorage(database) as storage:
+                storage.put_user(User(1, 'x', 'http://github.com/x'))
+                storage.conn.execute('DROP TABLE change')
+                storage.conn.execute('PRAGMA user_version = 0')
+
+            with SQLiteStorage(database) as storage:
+                assert [c.id for c in storage.list_changes()] == [1]
+        finally:
+            shutil.rmtree(path)
+
+    def test_list_lookup(self):
+        self.storage.put_users([User(1, 'ab', 'http://github.com/ab'),
+                                User(2, 'abc', 'http://github.com/abc'),
+                                User(3, 'b', 'http://github.com/b')])
+
+        def ids(*lookup):
+            return [u.id for u in self.storage.list_users(*lookup)]
+
+        assert ids(Q('login') == 'ab') == [1]
+        assert ids(Q('login').startswith('ab')) == [1, 2]
+        assert ids(Q('login').startswith('')) == [1, 2, 3]
+        assert ids((Q('id') >= 2) & (Q('id') <= 3)) == [2, 3]
+        assert ids(Q('id').in_([1, 3])) == [1, 3]
+        assert ids((Q('login') == 'b') | (Q('id') == 1)) == [1, 3]
+        with self.assertRaises(ValueError):
+            self.storage.list_users(Q('name') == 'x')
+
     def test_build_limit_expr(self):
         empty = self.storage._build_limit_expr(offset=None, limit=None)
         offset_only = self.storage._build_limit_expr(offset=10, limit=None)
@@ -72,3 +380,482 @@ class SQLiteStorageTest(TestCase):
         assert offset_only == ''
         assert limit_only == ' LIMIT 0,10'
         assert limit_offset == ' LIMIT 10,12'
+
+
+class SQLiteVersionTest(TestCase):
+    def test_old_version(self):
+        with mock.patch('sqlite3.sqlite_version_info', (3, 11, 0)):
+            with mock.patch('sqlite3.sqlite_version', '3.11.0'):
+                with self.assertRaises(RuntimeError) as cm:
+                    LocMemStorage()
+        assert str(cm.exception) == \
+            'SQLite 3.24.0 or newer is required, found 3.11.0'
+
+
+class SnapshotStorageTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.snapshot = os.path.join(self.path, 'snapshot.sqlite')
+        self.storage = SQLiteStorage(os.path.join(self.path, 'data.sqlite'))
+        self.storage.put_user(User(1, 'x', 'http://github.com/x'))
+        self.storage.put_repo(Repo(1, 1, 'http://github.com/x/x', 'x', '',
+                                   'python'))
+        self.storage.publish_snapshot(self.snapshot)
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.path)
+
+    def test_read(self):
+        with SnapshotStorage(self.snapshot) as snapshot:
+            assert snapshot.get_user(Q('login') == 'x') == \
+                User(1, 'x', 'http://github.com/x')
+            assert snapshot.list_repos({'language': 'python'})[0].id == 1
+            assert snapshot.list_language_stats() == [
+                LanguageStats('python', 1)]
+            assert snapshot.get_progress() == {
+                'users': 1, 'repos': 1, 'last_user_id': 1}
+
+    def test_wal(self):
+        mode = self.storage.conn.execute('PRAGMA journal_mode').fetchone()
+        assert mode == ('wal',)
+        conn = sqlite3.connect(self.snapshot)
+        assert conn.execute('PRAGMA journal_mode').fetchone() == ('delete',)
+        conn.close()
+
+    def test_read_only(self):
+        with SnapshotStorage(self.snapshot) as snapshot:
+            with self.assertRaises(sqlite3.OperationalError):
+                snapshot.put_user(User(2, 'y', 'http://github.com/y'))
+
+    def test_reload(self):
+        with SnapshotStorage(self.snapshot, check_interval=0) as snapshot:
+            assert snapshot.get_user(Q('id') == 1).login == 'x'
+            self.storage.put_user(User(1, 'y', 'http://github.com/y'))
+            self.storage.put_user(User(2, 'z', 'http://github.com/z'))
+
+            # the snapshot doesn't change until a new one is published
+            assert snapshot.get_user(Q('id') == 1).login == 'x'
+            assert len(snapshot.list_users()) == 1
+
+            self.storage.publish_snapshot(self.snapshot)
+            assert snapshot.get_user(Q('id') == 1).login == 'y'
+            assert len(snapshot.list_users()) == 2
+            assert len(snapshot.idle) == 1
+
+    def test_reload_user_cache(self):
+        with SnapshotStorage(self.snapshot, check_interval=60) as snapshot:
+            acquire = snapshot._acquire
+
+            def acquire_then_reload():
+                # another thread finds a new snapshot while this one reads
+                # from the previous one
+                generation, conn = acquire()
+                self.storage.put_user(User(1, 'y', 'http://github.com/y'))
+                self.storage.publish_snapshot(self.snapshot)
+                snapshot.check_snapshot()
+                return generation, conn
+
+            with mock.patch.object(snapshot, '_acquire',
+                                   acquire_then_reload):
+                assert snapshot.get_user(Q('id') == 1).login == 'x'
+            # the stale user wasn't cached for the new snapshot
+            assert snapshot.get_user(Q('id') == 1).login == 'y'
+
+    def test_reload_interval(self):
+        with SnapshotStorage(self.snapshot, check_interval=60) as snapshot:
+            assert len(snapshot.list_users()) == 1
+            self.storage.put_user(User(2, 'z', 'http://github.com/z'))
+            self.storage.publish_snapshot(self.snapshot)
+            assert len(snapshot.list_users()) == 1
+
+            snapshot.next_check = 0
+            assert len(snapshot.list_users()) == 2
+
+    def test_threads(self):
+        results = []
+        with SnapshotStorage(self.snapshot) as snapshot:
+            def read():
+                results.append(snapshot.list_users())
+
+            threads = [threading.Thread(target=read) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        assert results == [[User(1, 'x', 'http://github.com/x')]] * 4
+
+    def test_threads_query_cache(self):
+        errors = []
+        with SnapshotStorage(self.snapshot, query_cache_size=2) as snapshot:
+            def read():
+                try:
+                    for i in range(500):
+                        # a few shapes, so that the cache keeps evicting
+                        snapshot.list_users(limit=i % 4 + 1)
+                except Exception as e:  # pragma: no cover
+                    errors.append(e)
+
+            interval = sys.getswitchinterval()
+            sys.setswitchinterval(1e-6)
+            try:
+                threads = [threading.Thread(target=read) for _ in range(8)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            finally:
+                sys.setswitchinterval(interval)
+
+            assert errors == []
+            assert sum(snapshot.query_cache_stats.values()) == 4000
+            assert len(snapshot.query_cache) <= 2
+
+    def test_missing(self):
+        with self.assertRaises(FileNotFoundError):
+            SnapshotStorage(os.path.join(self.path, 'missing.sqlite'))
+
+    def test_publish_memory(self):
+        with self.assertRaises(ValueError):
+            LocMemStorage().publish_snapshot(self.snapshot)
+
+    def test_publish_uri_characters(self):
+        # characters which have a meaning in URIs
+        path = os.path.join(self.path, 'a?b#c%20d')
+        os.mkdir(path)
+        snapshot = os.path.join(path, 'snapshot.sqlite')
+        with SQLiteStorage(os.path.join(path, 'data.sqlite')) as storage:
+            storage.put_user(User(2, 'y', 'http://github.com/y'))
+            storage.publish_snapshot(snapshot)
+        with SnapshotStorage(snapshot) as snapshot:
+            assert snapshot.list_users() == [
+                User(2, 'y', 'http://github.com/y')]
+
+    def test_publish_concurrent(self):
+        errors = []
+        # a second storage doesn't share the lock, only the snapshot path
+        other = SQLiteStorage(self.storage.database)
+
+        def publish(storage):
+            try:
+                for _ in range(5):
+                    storage.publish_snapshot(self.snapshot)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=publish, args=(storage,))
+                   for storage in [self.storage, other] * 2]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        other.close()
+        assert errors == []
+        assert not [name for name in os.listdir(self.path)
+                    if name.endswith('.tmp')]
+        with SnapshotStorage(self.snapshot) as snapshot:
+            assert len(snapshot.list_users()) == 1
+
+    def test_publish_mode(self):
+        os.chmod(self.storage.database, 0o640)
+        self.storage.publish_snapshot(self.snapshot)
+        assert os.stat(self.snapshot).st_mode & 0o777 == 0o640
+
+    def test_publish_error(self):
+        connect = sqlite3.connect
+
+        def connect_closed(database, **kwargs):
+            conn = connect(database, **kwargs)
+            if not kwargs.get('uri'):
+                # backing up to the snapshot fails
+                conn.close()
+            return conn
+
+        with mock.patch('sqlite3.connect', connect_closed):
+            with self.assertRaises(sqlite3.ProgrammingError):
+                self.storage.publish_snapshot(self.snapshot)
+        assert sorted(os.listdir(self.path)) == [
+            'data.sqlite', 'data.sqlite-shm', 'data.sqlite-wal',
+            'snapshot.sqlite']
+
+
+class UserCacheTest(TestCase):
+    def test_lru(self):
+        cache = UserCache(maxsize=2)
+        cache.put(User(1, 'a', 'http://github.com/a'))
+        cache.put(User(2, 'b', 'http://github.com/b'))
+        assert cache.get('id', 1).login == 'a'
+        cache.put(User(3, 'c', 'http://github.com/c'))
+
+        assert cache.get('login', 'b') is None
+        assert cache.get('login', 'a').id == 1
+        assert cache.get('login', 'c').id == 3
+        assert cache.by_login == {'a': 1, 'c': 3}
+
+    def test_ttl(self):
+        cache = UserCache(ttl=-1)
+        cache.put(User(1, 'a', 'http://github.com/a'))
+        assert cache.get('id', 1) is None
+
+    def test_get_key(self):
+        cache = UserCache()
+        assert cache.get_key((Q('id') == 1,)) == ('id', 1)
+        assert cache.get_key((Q('login') == 'x',)) == ('login', 'x')
+        assert cache.get_key(({'id': 1},)) == ('id', 1)
+        assert cache.get_key(({'login': 'x'},)) is None
+        assert cache.get_key((Q('id') > 1,)) is None
+        assert cache.get_key((Q('id') == 1, Q('login') == 'x')) is None
+        assert UserCache(maxsize=0).get_key((Q('id') == 1,)) is None
+
+
+@skipUnless(POSTGRES_URL, 'GITHUB_SCRAPER_POSTGRES_URL is not set')
+class PostgresStorageTest(TestCase):
+    def setUp(self):
+        self.storage = get_storage(POSTGRES_URL)
+        with self.storage.cursor() as c:
+            c.execute('TRUNCATE "user", repo, change')
+        self.storage.rebuild_stats()
+
+    def tearDown(self):
+        self.storage.close()
+
+    def test_put_user(self):
+        self.storage.put_user(User(1, 'x', 'http://github.com/x'))
+        self.storage.put_user(User(1, 'y', 'http://github.com/x'))
+
+        assert self.storage.list_users() == [
+            User(1, 'y', 'http://github.com/x'),
+        ]
+
+    def test_put_unchanged(self):
+        user = User(1, 'x', 'http://github.com/x')
+        assert self.storage.put_user(user)
+        assert not self.storage.put_user(user)
+        assert self.storage.put_user(user._replace(login='y'))
+
+    def test_put_user_login_taken(self):
+        self.storage.put_user(User(1, 'x', 'http://github.com/x'))
+        self.storage.put_user(User(2, 'x', 'http://github.com/x'))
+
+        assert self.storage.list_users() == [
+            User(2, 'x', 'http://github.com/x'),
+        ]
+
+    def test_put_bulk(self):
+        self.storage.copy_threshold = 1
+        users = [User(i, 'u{}'.format(i), 'http://github.com/u{}'.format(i))
+                 for i in range(1, 11)]
+        repos = [Repo(i, 1, 'http://github.com/u1/{}'.format(i),
+                      'r{}'.format(i), 'tab\there\nand\\', None)
+                 for i in range(1, 11)]
+        self.storage.put_users(users)
+        self.storage.put_repos(repos)
+        self.storage.put_repos(repos[:1])
+
+        assert self.storage.list_users() == users
+        assert self.storage.list_repos() == repos
+
+    def test_lookup(self):
+        self.storage.put_users([User(1, 'Mojombo', 'http://github.com/x'),
+                                User(2, 'defunkt', 'http://github.com/y')])
+
+        assert self.storage.get_user({'login': 'mojo'}).id == 1
+        assert self.storage.get_last_user().id == 2
+        assert self.storage.list_users(Q('id') > 1) == [
+            User(2, 'defunkt', 'http://github.com/y'),
+        ]
+        assert self.storage.list_users(offset=1, limit=1) == [
+            User(2, 'defunkt', 'http://github.com/y'),
+        ]
+
+    def test_lookup_prefix(self):
+        top = chr(sys.maxunicode)
+        self.storage.put_users([
+            User(i, login, 'http://github.com/x')
+            for i, login in enumerate(['ab', 'abc', 'ac', top, top + 'x'], 1)])
+
+        def logins(prefix):
+            return [u.login for u in self.storage.list_users(
+                Q('login').startswith(prefix))]
+
+        assert logins('ab') == ['ab', 'abc']
+        assert logins(top) == [top, top + 'x']
+
+    def test_lookup_prefix_collation(self):
+        # ICU collations sort case-insensitively first, so ab < AB < ac and
+        # a plain range would match AB
+        from psycopg2 import NotSupportedError
+        try:
+            with self.storage.cursor() as c:
+                c.execute('ALTER TABLE "user" ALTER COLUMN login '
+                          'TYPE text COLLATE "unicode"')
+        except NotSupportedError:
+            self.skipTest('ICU collations are not supported')
+        try:
+            self.storage.put_users([
+                User(i, login, 'http://github.com/x')
+                for i, login in enumerate(['ab', 'AB', 'abc', 'aB', 'ac'], 1)])
+
+            assert [u.login for u in self.storage.list_users(
+                Q('login').startswith('ab'))] == ['ab', 'abc']
+        finally:
+            with self.storage.cursor() as c:
+                c.execute('ALTER TABLE "user" ALTER COLUMN login '
+                          'TYPE text COLLATE "default"')
+
+    def test_stats(self):
+        self.storage.put_users([User(1, 'x', 'http://github.com/x'),
+                                User(2, 'y', 'http://github.com/y')])
+        self.storage.put_repos([
+            Repo(1, 1, 'http://github.com/x/a', 'a', '', 'ruby'),
+            Repo(2, 1, 'http://github.com/x/b', 'b', '', 'python'),
+            Repo(3, 2, 'http://github.com/y/c', 'c', '', None),
+        ])
+        self.storage.put_repo(Repo(2, 1, 'http://github.com/x/b', 'b', '',
+                                   'ruby'))
+
+        assert self.storage.list_language_stats() == [
+            LanguageStats('ruby', 2),
+            LanguageStats(None, 1),
+        ]
+        assert self.storage.list_top_users(limit=1) == [UserStats(1, 'x', 2)]
+        assert self.storage.get_progress() == {
+            'users': 2,
+            'repos': 3,
+            'last_user_id': 2,
+        }
+
+    def test_stats_concurrent(self):
+        self.storage.put_repos([
+            Repo(1, 1, 'http://github.com/x/a', 'a', '', 'ruby'),
+            Repo(2, 2, 'http://github.com/y/b', 'b', '', 'python'),
+        ])
+        conns = [self.storage.pool.getconn() for _ in range(2)]
+        try:
+            cursors = [conn.cursor() for conn in conns]
+            for c in cursors:
+                # writers used to block each other on the stats rows
+                c.execute("SET lock_timeout = '2s'")
+
+            # interleaved writers, touching languages in opposite orders
+            for c, (repo_id, language, other) in zip(cursors, [
+                    (1, 'python', 'ruby'), (2, 'ruby', 'python')]):
+                c.execute('UPDATE repo SET language = %s WHERE id = %s',
+                          (language, repo_id))
+                c.execute("INSERT INTO repo (id, user_id, language) "
+                          "VALUES (%s, 3, %s)", (repo_id + 10, other))
+            for conn in conns:
+                conn.commit()
+        finally:
+            for conn in conns:
+                self.storage.pool.putconn(conn)
+
+        assert self.storage.list_language_stats() == [
+            LanguageStats('python', 2),
+            LanguageStats('ruby', 2),
+        ]
+        assert self.storage.list_top_users(limit=1) == [UserStats(3, None, 2)]
+        assert self.storage.get_progress()['repos'] == 4
+        with self.storage.cursor() as c:
+            c.execute('SELECT count(*) FROM stats_delta')
+            assert c.fetchone()[0] == 0
+
+    def test_changes(self):
+        self.storage.put_users([User(1, 'x', 'http://github.com/x'),
+                                User(2, 'y', 'http://github.com/y')])
+        seq = self.storage.list_changes()[-1].seq
+        self.storage.put_user(User(1, 'x', 'http://github.com/z'))
+        self.storage.put_user(User(3, 'y', 'http://github.com/y'))
+
+        changes = self.storage.list_changes(seq)
+        assert [(c.id, c.deleted, c.obj) for c in changes] == [
+            (1, False, User(1, 'x', 'http://github.com/z')),
+            (2, True, None),
+            (3, False, User(3, 'y', 'http://github.com/y')),
+        ]
+        assert changes[0].seq > seq
+
+    def test_schema_current(self):
+        opened = []
+        conn = self.storage.pool.getconn()
+        thread = threading.Thread(
+            target=lambda: opened.append(get_storage(POSTGRES_URL)))
+        # a running write, which replacing triggers would wait for
+        conn.cursor().execute('INSERT INTO repo (id, user_id) VALUES (1, 1)')
+        thread.start()
+        try:
+            thread.join(5)
+            assert opened
+        finally:
+            conn.rollback()
+            self.storage.pool.putconn(conn)
+            thread.join()
+            for storage in opened:
+                storage.close()
+
+    def test_schema_upgrade(self):
+        with self.storage.cursor() as c:
+            c.execute('DROP TRIGGER repo_stats_insert ON repo')
+            c.execute('UPDATE schema_version SET version = 0')
+
+        opened = []
+        errors = []
+
+        def open_storage():
+            try:
+                opened.append(get_storage(POSTGRES_URL))
+            except Exception as e:
+                errors.append(e)
+
+        # processes starting together upgrade it one at a time
+        threads = [threading.Thread(target=open_storage) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for storage in opened:
+            storage.close()
+        assert errors == []
+
+        self.storage.put_repo(Repo(1, 1, 'http://github.com/x/a', 'a', '',
+                                   'ruby'))
+        assert self.storage.list_language_stats() == [
+            LanguageStats('ruby', 1)]
+
+    def test_changes_concurrent(self):
+        conns = [self.storage.pool.getconn() for _ in range(2)]
+        try:
+            first, second = [conn.cursor() for conn in conns]
+            # the first writer takes a number, then the second one commits
+            first.execute('''INSERT INTO "user" VALUES (1, 'x', '')''')
+            second.execute('''INSERT INTO "user" VALUES (2, 'y', '')''')
+            conns[1].commit()
+
+            changes = self.storage.list_changes()
+            assert [c.id for c in changes] == [2]
+
+            # the consumer moved past the second change, but still gets the
+            # first one once committed
+            conns[0].commit()
+            assert [c.id for c in self.storage.list_changes(
+                changes[-1].seq)] == [1]
+        finally:
+            for conn in conns:
+                self.storage.pool.putconn(conn)
+
+        with self.storage.cursor() as c:
+            c.execute('SELECT count(*) FROM change WHERE txid IS NOT NULL')
+            assert c.fetchone()[0] == 0
+            c.execute('SELECT count(*) FROM pending_commit')
+            assert c.fetchone()[0] == 0
+
+    def test_context_manager(self):
+        with self.storage:
+            assert not self.storage.closed
+        assert self.storage.closed
+
+
+class GetStorageTest(TestCase):
+    def test_sqlite(self):
+        with get_storage(':memory:') as storage:
+            assert isinstance(storage, SQLiteStorage)